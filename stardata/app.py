@@ -1,14 +1,32 @@
+import argparse
+import gzip
 import json
 import os
+import threading
+import time
 import webbrowser
 
-from database import query, upload_table
-from flask import Flask, render_template, request
+from cache import cache_stats, invalidate_star, invalidate_table
+from census import reset_census, run_census
+from crossmatch import MATCH_COLUMNS, cross_match, has_cross_match
+from database import fetch_array, query, refresh_table
+from flask import Flask, Response, jsonify, redirect, render_template, request
 """from flask_session import Session"""
-from starcalcs import calculate_distance, create_star, get_nearby, select_id, update_position
+from matrix import matrix_csv, matrix_json, matrix_npy
+from jobs import job_queue
+from metrics import instrument, render_metrics, span
+from motion import MAX_CELLS, closest_approach, distance_curves, find_passes, star_motion, year_range
+from planner import plan_route, reset_graphs
+from region import read_shape, region_csv, region_ndjson, region_query
+from search import changed_search_indexes, reset_search, search_prefix, set_search_index
+from snapshot import check_snapshot, forget_snapshot, load_snapshot, reset_snapshot, write_snapshot
+from spatial import INDEX_COLUMNS, INDEX_WHERE, build_index, changed_index, get_index, index_rows, set_index
+from starcalcs import calculate_distance, create_star, create_stars, get_nearby, get_nearest, index_table, locate_stars, select_id, star_position, update_position
+from tiles import get_tile, get_tile_index, write_tiles
 
 # Configure application
 app = Flask(__name__)
+instrument(app)
 """
 # Configure session
 app.config["SESSION_PERMANENT"] = False
@@ -27,16 +45,220 @@ if os.path.isfile(file_path):
 else:
     raise SystemExit("catalogues.json not found.")
 
-# Create star lists for each catalogue
-star_lists = {}
-for key, value in catalogues.items():
-    rows = query(db, value["list_query"], ())
-    # Convert result to list of strings
-    row_list = []
-    for row in rows:
-        row_list.append(dict(row))
-    star_list = [str(x) for x in list(map(lambda d: d.get(key, "-"), row_list))]
-    star_lists[key] = star_list
+# Largest number of stars returned by a closest stars search, and results per page of the /nearby route
+MAX_NEAREST = 10000
+MAX_PAGE = 1000
+
+# Column identifying each row when a table is refreshed from new csv files
+TABLE_KEYS = {"catalogue": "id", "habitable": "HIP"}
+
+# Requests handled at once by the production server
+SERVER_THREADS = 8
+
+# Set once prepare_database has run
+prepared = threading.Event()
+prepare_lock = threading.Lock()
+
+
+@app.before_request
+def prepare_database():
+# Loads the catalogue indexes and brings a database created by an earlier version up to date. Runs once, before the
+# first request is answered or when the application is started with python app.py, so importing the application
+# does not read or write the database.
+    if prepared.is_set():
+        return
+    with prepare_lock:
+        if prepared.is_set():
+            return
+
+        # Load the catalogue snapshot for nearby star searches and identifier search,
+        # or build the spatial index from the catalogue table if there is no current snapshot
+        result = load_snapshot(db)
+        if result != True:
+            print(f"Catalogue snapshot not loaded: {result}")
+            build_index(db)
+
+        # Match the habitable table to the catalogue if this database was created before the cross-match was added
+        if not has_cross_match(db):
+            result = cross_match(db)
+            if not isinstance(result, dict):
+                print(f"Habitable cross-match failed: {result}")
+
+        # Write the star map tiles in the background if they have not been written yet (the tile routes answer
+        # 404 until the job has finished)
+        if get_tile_index(db) == None:
+            submit_job({"kind": "tiles"})
+
+        prepared.set()
+
+
+@app.before_request
+def check_catalogue():
+# Picks up a catalogue snapshot written by another process, or a catalogue table it is changing (see check_snapshot)
+    check_snapshot(db)
+
+
+def census_job(job, radius, workers, restart):
+# Background job running the neighbour census (see census.py). Returns {"message", "stars"} or the error value.
+    def progress(blocks_done, blocks, stars_done, stars):
+        job.update(f"Counted neighbours of {stars_done} of {stars} stars ({blocks_done} of {blocks} blocks).", blocks_done / blocks if blocks else 1.0)
+
+    result = run_census(db, radius, None, workers, restart, progress, job.cancelled)
+    if not isinstance(result, int):
+        return result
+    return {"message": f"Census of {result} stars finished.", "stars": result}
+
+
+def load_job(job, table_name):
+# Background job for the Update Database page: refreshes a table from its csv files, then rebuilds everything that
+# depends on it. Returns {"message", "rows", "timings"} for the page, or an error message.
+    file_path = os.path.dirname(os.path.abspath(__file__)) + r"\table_data\\" + table_name
+
+    # Load the new data into a staging table and apply the differences to the live table in one transaction.
+    # The job can be cancelled until the live table is changed; after that it runs to the end.
+    job.update(f"Loading the new {table_name} data.")
+    if table_name == "catalogue":
+        result = refresh_table(db, file_path, table_name, TABLE_KEYS[table_name], MATCH_COLUMNS, job.cancelled, prepare_catalogue)
+    else:
+        result = refresh_table(db, file_path, table_name, TABLE_KEYS[table_name], cancelled = job.cancelled)
+    if not isinstance(result, dict):
+        return result if job.cancelled() else f"Could not update {table_name} table: {result}"
+    timings = {f"{table_name} {phase}": value["seconds"] for phase, value in result.items()}
+    rows = {f"{table_name} {phase}": value["rows"] for phase, value in result.items()}
+    replaced = "replace" in result
+
+    # Create indexes if the table was replaced rather than updated
+    if replaced:
+        job.update(f"Creating indexes for the {table_name} table.")
+        result = index_table(db, table_name, catalogues)
+        if not isinstance(result, dict):
+            return f"Could not create indexes for {table_name} table: {result}"
+        timings.update(result)
+
+    # Match the habitable stars to the catalogue again
+    job.update("Matching habitable stars to the catalogue.")
+    result = cross_match(db)
+    if not isinstance(result, dict):
+        return f"Could not match habitable stars to the catalogue: {result}"
+    timings.update({f"habitable {phase}": value["seconds"] for phase, value in result.items()})
+    rows.update({f"habitable {phase}": value["rows"] for phase, value in result.items()})
+
+    if table_name == "catalogue":
+        # The neighbour census is out of date
+        result = reset_census(db)
+        if result != True:
+            return f"Could not reset neighbour census: {result}"
+
+        # Write a snapshot of the new catalogue and load the spatial and search indexes from it in place of the ones
+        # updated by prepare_catalogue
+        job.update("Writing the catalogue snapshot.")
+        result = write_snapshot(db, catalogues)
+        if not isinstance(result, float):
+            return f"Could not write snapshot of {table_name} table: {result}"
+        timings["catalogue snapshot"] = result
+        start = time.perf_counter()
+        result = load_snapshot(db)
+        if result != True:
+            return f"Could not load snapshot of {table_name} table: {result}"
+        timings["spatial index"] = time.perf_counter() - start
+
+        # Rewrite the star map tiles that have changed
+        job.update("Writing star map tiles.")
+        result = write_tiles(db)
+        if not isinstance(result, dict):
+            return f"Could not write star map tiles: {result}"
+        timings["star map tiles"] = result["seconds"]
+        rows["star map tiles"] = result["written"]
+
+    # Route graphs and cached results are rebuilt from the new tables on next use
+    reset_graphs(db)
+    invalidate_table(db, table_name)
+    return {"message": f"{table_name} table updated.", "rows": rows, "timings": timings}
+
+
+def prepare_catalogue(connection, replaced):
+# Called by refresh_table in the transaction that changes the catalogue table. Removes the snapshot stamp and builds
+# the new spatial and search indexes from the changed rows (or the spatial index from the whole table if it was
+# replaced), then returns the function that swaps them in as soon as the changes are committed, so searches do not
+# use indexes of the old rows with the new table.
+    result = reset_snapshot(db, connection)
+    if result != True:
+        return result
+
+    if replaced:
+        index = index_rows(fetch_array(connection.cursor(), f"SELECT rowid, {INDEX_COLUMNS} FROM catalogue WHERE {INDEX_WHERE} ORDER BY rowid;"))
+        search = None
+    else:
+        removed = fetch_array(connection.cursor(), "SELECT row FROM temp.refresh_old UNION SELECT row FROM temp.refresh_new;")
+        data = fetch_array(connection.cursor(), f"SELECT row, {INDEX_COLUMNS} FROM temp.refresh_new WHERE {INDEX_WHERE} ORDER BY row;")
+        index = changed_index(get_index(db), removed[:, 0], data)
+        search = changed_search_indexes(db, catalogues, connection, "temp.refresh_old", "temp.refresh_new")
+
+    def swap():
+        set_index(db, index)
+        forget_snapshot(db)
+        if search == None:
+            reset_search(db)
+        else:
+            for key, value in search.items():
+                set_search_index(db, key, value)
+
+    return swap
+
+
+def read_filters(values):
+# Returns the star filters from form, query or JSON values: habitable only, spectral class, apparent and absolute
+# magnitude ranges and distance sources (a list, or text separated by commas)
+    filters = {}
+    if values.get("habitable") in [True, "true", "on", "1"]:
+        filters["habitable"] = True
+    if values.get("spect"):
+        filters["spect"] = values.get("spect").strip()
+    for name in ["min_mag", "max_mag", "min_absmag", "max_absmag"]:
+        if values.get(name) not in [None, ""]:
+            filters[name] = float(values.get(name))
+    if values.get("dist_src"):
+        sources = values.get("dist_src")
+        if isinstance(sources, str):
+            sources = sources.split(",")
+        filters["dist_src"] = tuple(str(source).strip() for source in sources if str(source).strip())
+    return filters
+
+
+def submit_job(values):
+# Queues the background job described by form or JSON values and returns it, or raises ValueError. Jobs are
+# {"kind": "load", "table": "catalogue" or "habitable"}, {"kind": "census", "radius": pc, "workers": processes,
+# "restart": true or false} and {"kind": "tiles"}. Asking for a job that is already queued or running returns it.
+    kind = values.get("kind")
+    if kind == "load":
+        table_name = values.get("table")
+        if table_name not in TABLE_KEYS:
+            raise ValueError(f"Invalid table name {table_name} supplied.")
+        return job_queue.submit(kind, f"Update {table_name} table", load_job, table_name, key = (kind, table_name))
+    elif kind == "census":
+        radius = float(values.get("radius", 5))
+        if not radius > 0:
+            raise ValueError("radius must be more than zero.")
+        # Worker processes each map the snapshot, so at most one per processor can be asked for
+        workers = int(values.get("workers")) if values.get("workers") not in [None, ""] else None
+        if workers != None and not 1 <= workers <= (os.cpu_count() or 1):
+            raise ValueError(f"workers must be between 1 and {os.cpu_count() or 1}.")
+        restart = values.get("restart") in [True, "true", "on", "1"]
+        return job_queue.submit(kind, f"Neighbour census within {radius:g} pc", census_job, radius, workers, restart, key = (kind,))
+    elif kind == "tiles":
+        return job_queue.submit(kind, "Write star map tiles", tiles_job, key = (kind,))
+    raise ValueError(f"Unknown job kind {kind}.")
+
+
+def tiles_job(job):
+# Background job rewriting the star map tiles that have changed. Returns the write_tiles report or an error message.
+    job.update("Writing star map tiles.")
+    result = write_tiles(db)
+    if not isinstance(result, dict):
+        return f"Could not write star map tiles: {result}"
+    result["message"] = f"Wrote {result['written']} of {result['tiles']} star map tiles."
+    return result
+
 
 # Define routes
 @app.route("/", methods = ["GET", "POST"])
@@ -60,58 +282,441 @@ def index():
         # Create star objects
         stars = []
         try:
-            for input in inputs:
-                stars.append(create_star(input, catalogues, db))
+            with span("create_star"):
+                for input in inputs:
+                    stars.append(create_star(input, catalogues, db))
         except:
             return render_template("error.html", error = "Unable to create star object.")
         
-        # Calculate positions for provided year
-        xyz = []
-        for star in stars:
-            xyz.append(update_position(star.xyz, epoch))
+        with span("calculate_distance"):
+            # Calculate positions for provided year, moving copies so the stars (which may be cached) keep their J2000.0 positions
+            xyz = []
+            for star in stars:
+                xyz.append(update_position(dict(star.xyz), epoch))
 
-        # Calculate distance between stars
-        distance = calculate_distance(xyz)
+            # Calculate distance between stars
+            distance = calculate_distance(xyz)
+
+        with span("approach"):
+            # Find when the stars are closest, assuming they keep moving in straight lines
+            closest_years, closest_distances = closest_approach(star_motion(stars[0]), star_motion(stars[1]))
  
         # Return page with star data
-        result = f"The distance between {stars[0].ref} and {stars[1].ref} in {epoch} is {distance: .3f} parsecs."
-        return render_template("index.html", catalogues = catalogues, datalists = star_lists, message = result, starL = stars[0].__dict__, starR = stars[1].__dict__)
+        result = (f"The distance between {stars[0].ref} and {stars[1].ref} in {epoch} is {distance: .3f} parsecs. "
+                  f"They are closest in {closest_years[0]:.0f} at {closest_distances[0]: .3f} parsecs.")
+        with span("render"):
+            return render_template("index.html", catalogues = catalogues, message = result, starL = stars[0], starR = stars[1])
     
     else: # request method == "GET"
     # Return page without star data
-        return render_template("index.html", catalogues = catalogues, datalists = star_lists, message = "", starL = "", starR = "")
+        return render_template("index.html", catalogues = catalogues, message = "", starL = "", starR = "")
     
 
+@app.route("/cache")
+def cache():
+# Return hit and miss counters for the star and nearby result caches as JSON
+    return jsonify(cache_stats())
+
+
+@app.route("/distances", methods = ["POST"])
+def distances():
+# Return the distance matrix between a list of stars as JSON, CSV or .npy.
+# Expects a JSON body such as {"stars": [["Sol", "proper"], ["Sirius", "proper"]], "epoch": 2000, "format": "json"}
+    data = request.get_json(silent = True)
+    try:
+        stars = [(str(item[0]), str(item[1])) for item in data["stars"]]
+        epoch = int(data.get("epoch", 2000))
+        output = request.args.get("format", data.get("format", "json"))
+    except:
+        return jsonify(error = "Inputs not found."), 400
+
+    if output not in ["json", "csv", "npy"]:
+        return jsonify(error = f"Unknown format {output}."), 400
+
+    # Find positions of all stars for provided year
+    try:
+        with span("locate_stars"):
+            refs, ids, positions = locate_stars(stars, catalogues, db, epoch)
+    except ValueError as err:
+        return jsonify(error = str(err)), 404
+    except Exception as err:
+        return jsonify(error = f"Unable to find stars: {err}"), 500
+
+    # Stream the matrix back one block of rows at a time
+    if output == "csv":
+        return Response(matrix_csv(refs, positions), mimetype = "text/csv",
+                        headers = {"Content-Disposition": "attachment; filename=distances.csv"})
+    elif output == "npy":
+        return Response(matrix_npy(positions), mimetype = "application/octet-stream",
+                        headers = {"Content-Disposition": "attachment; filename=distances.npy"})
+    return Response(matrix_json(refs, ids, epoch, positions), mimetype = "application/json")
+
+
+@app.route("/nearby")
+def nearby():
+# Return the stars within a range of a star, or the closest stars to it, as paginated JSON.
+# e.g. /nearby?star=Sol&cat=proper&range=3.5 or /nearby?star=Sol&cat=proper&count=20&spect=G&page=2&per_page=10
+    try:
+        input = (request.args["star"], request.args.get("cat", "proper"))
+        epoch = int(request.args.get("year", 2000))
+        if request.args.get("count"):
+            count = int(request.args.get("count"))
+            if count < 1 or count > MAX_NEAREST:
+                return jsonify(error = f"count must be between 1 and {MAX_NEAREST}."), 400
+        else:
+            count = None
+            radius = float(request.args.get("range", 10))
+            if not radius >= 0:
+                return jsonify(error = "range must be zero or more."), 400
+        filters = read_filters(request.args)
+        page = max(int(request.args.get("page", 1)), 1)
+        per_page = min(max(int(request.args.get("per_page", 100)), 1), MAX_PAGE)
+    except:
+        return jsonify(error = "Inputs not found."), 400
+
+    try:
+        with span("create_star"):
+            star = create_star(input, catalogues, db)
+    except:
+        return jsonify(error = f"{input[0]} not found in {input[1]} catalogue."), 404
+
+    with span("get_nearby"):
+        if count != None:
+            nearby_list = get_nearest(star, count, db, epoch, filters)
+        else:
+            nearby_list = get_nearby(star, radius, db, epoch, filters)
+
+    # Return one page of results
+    results = nearby_list[(page - 1) * per_page:page * per_page]
+    data = {
+        "star": star.ref,
+        "id": star.ids["id"],
+        "epoch": epoch,
+        "filters": filters,
+        "total": len(nearby_list),
+        "page": page,
+        "per_page": per_page,
+        "pages": (len(nearby_list) + per_page - 1) // per_page,
+        "results": [{"star": item[0], "distance": item[1], "id": item[2]} for item in results]
+        }
+    if count != None:
+        data["count"] = count
+    else:
+        data["range"] = radius
+    return jsonify(data)
+
+
+@app.route("/approach", methods = ["GET", "POST"])
+def approach():
+# Return the distance between one star and one or more others over a range of years, and their closest approach, as JSON.
+# e.g. /approach?starA=Sol&catA=proper&starB=Sirius&catB=proper&start=-50000&end=50000&step=1000, or POST a JSON body
+# such as {"star": ["Sol", "proper"], "stars": [["Sirius", "proper"], ["Vega", "proper"]], "start": 0, "end": 4000, "step": 100}
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent = True)
+            inputs = [(str(data["star"][0]), str(data["star"][1]))] + [(str(item[0]), str(item[1])) for item in data["stars"]]
+        else:
+            data = request.args
+            inputs = [(data["starA"], data.get("catA", "proper")), (data["starB"], data.get("catB", "proper"))]
+        start = float(data.get("start", 2000))
+        end = float(data.get("end", start + 100000))
+        step = float(data.get("step", (end - start) / 100 or 1))
+        years = year_range(start, end, step)
+    except ValueError as err:
+        return jsonify(error = str(err)), 400
+    except:
+        return jsonify(error = "Inputs not found."), 400
+
+    if len(inputs) < 2:
+        return jsonify(error = "At least one star to compare is required."), 400
+    if (len(inputs) - 1) * len(years) > MAX_CELLS:
+        return jsonify(error = f"At most {MAX_CELLS} distances can be calculated at once."), 400
+
+    with span("create_star"):
+        stars = create_stars(inputs, catalogues, db)
+    for input, star in zip(inputs, stars):
+        if star == None:
+            return jsonify(error = f"{input[0]} not found in {input[1]} catalogue."), 404
+
+    # Calculate all distance curves and closest approaches at once
+    with span("approach"):
+        origin = star_motion(stars[0])
+        motions = [star_motion(star) for star in stars[1:]]
+        targets = ([motion[0] for motion in motions], [motion[1] for motion in motions])
+        curves = distance_curves(origin, targets, years)
+        closest_years, closest_distances = closest_approach(origin, targets)
+        range_years, range_distances = closest_approach(origin, targets, start, end)
+
+    return jsonify({
+        "star": stars[0].ref,
+        "id": stars[0].ids["id"],
+        "years": years.tolist(),
+        "results": [{
+            "star": star.ref,
+            "id": star.ids["id"],
+            "distances": curves[i].tolist(),
+            "closest": {"year": float(closest_years[i]), "distance": float(closest_distances[i])},
+            "closest_in_range": {"year": float(range_years[i]), "distance": float(range_distances[i])}
+            } for i, star in enumerate(stars[1:])]
+        })
+
+
+@app.route("/passes")
+def passes():
+# Return the stars that pass within a distance of a star (Sol by default) in the next N years as paginated JSON.
+# e.g. /passes?within=1&years=100000 or /passes?star=Sirius&cat=proper&within=2&start=-50000&years=100000
+    try:
+        input = (request.args.get("star", "Sol"), request.args.get("cat", "proper"))
+        within = float(request.args.get("within", 1))
+        start = float(request.args.get("start", 2000))
+        years = float(request.args.get("years", 100000))
+        if not within >= 0 or not years >= 0:
+            return jsonify(error = "within and years must be zero or more."), 400
+        page = max(int(request.args.get("page", 1)), 1)
+        per_page = min(max(int(request.args.get("per_page", 100)), 1), MAX_PAGE)
+    except:
+        return jsonify(error = "Inputs not found."), 400
+
+    try:
+        with span("create_star"):
+            star = create_star(input, catalogues, db)
+    except:
+        return jsonify(error = f"{input[0]} not found in {input[1]} catalogue."), 404
+
+    with span("find_passes"):
+        pass_list = find_passes(star, within, start, start + years, db)
+
+    # Return one page of results
+    results = pass_list[(page - 1) * per_page:page * per_page]
+    return jsonify({
+        "star": star.ref,
+        "id": star.ids["id"],
+        "within": within,
+        "start": start,
+        "end": start + years,
+        "total": len(pass_list),
+        "page": page,
+        "per_page": per_page,
+        "pages": (len(pass_list) + per_page - 1) // per_page,
+        "results": [{"star": item[0], "year": item[1], "distance": item[2], "id": item[3]} for item in results]
+        })
+
+
+@app.route("/region", methods = ["GET", "POST"])
+def region():
+# Stream the stars inside one or more shapes and matching attribute filters as NDJSON or CSV.
+# e.g. /region?shape=cone&ra=6.75&dec=-16.7&angle=5&max_distance=50&spect=G&format=csv, or POST a JSON body such as
+# {"shapes": [{"type": "sphere", "star": "Sol", "cat": "proper", "radius": 20}, {"type": "slab", "min_height": -5, "max_height": 5}],
+#  "filters": {"min_absmag": 4, "max_absmag": 6, "dist_src": ["HIP", "GJ"]}, "epoch": 2000, "format": "ndjson"}
+    try:
+        if request.method == "POST":
+            data = request.get_json(silent = True)
+            shapes = [read_shape(values) for values in data["shapes"]]
+            filters = read_filters(data.get("filters", {}))
+        else:
+            data = request.args
+            shapes = [read_shape(data)] if data.get("shape") else []
+            filters = read_filters(data)
+        epoch = int(data.get("epoch", data.get("year", 2000)))
+        output = request.args.get("format", data.get("format", "ndjson"))
+    except ValueError as err:
+        return jsonify(error = str(err)), 400
+    except:
+        return jsonify(error = "Inputs not found."), 400
+
+    if output not in ["ndjson", "csv"]:
+        return jsonify(error = f"Unknown format {output}."), 400
+    if not shapes and not filters:
+        return jsonify(error = "At least one shape or filter is required."), 400
+
+    # Centre spheres on stars in the given year, checking their catalogues before looking any of them up
+    centred = [shape for shape in shapes if shape.get("star") != None]
+    for shape in centred:
+        if shape["star"][1] not in catalogues:
+            return jsonify(error = f"Unknown catalogue {shape['star'][1]}."), 400
+    for shape in centred:
+        try:
+            with span("create_star"):
+                shape["centre"] = star_position(create_star(shape["star"], catalogues, db), epoch)
+        except:
+            return jsonify(error = f"{shape['star'][0]} not found in {shape['star'][1]} catalogue."), 404
+
+    with span("region_query"):
+        positions, points = region_query(db, shapes, filters, epoch)
+
+    # Stream the matching stars back one block of rows at a time
+    if output == "csv":
+        return Response(region_csv(db, positions, points), mimetype = "text/csv",
+                        headers = {"Content-Disposition": "attachment; filename=region.csv", "X-Total-Count": str(len(positions))})
+    return Response(region_ndjson(db, positions, points), mimetype = "application/x-ndjson",
+                    headers = {"X-Total-Count": str(len(positions))})
+
+
+@app.route("/tiles/tiles.json")
+def tile_index():
+# Return the list of star map tiles (the octree nodes with their star counts, child octants and ETags)
+    index = get_tile_index(db)
+    if index == None:
+        return jsonify(error = "Star map tiles have not been written."), 404
+    response = jsonify(index)
+    response.add_etag()
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/tiles/<key>.bin")
+def tile(key):
+# Return one binary star map tile, gzip-compressed unless the client cannot accept it.
+# Clients send the ETag back (If-None-Match) to get a 304 response when the tile has not changed. The compressed and
+# uncompressed tiles have different ETags (the latter ending in -identity) and both vary by Accept-Encoding, so caches
+# never give one in place of the other.
+    result = get_tile(db, key)
+    if result == None:
+        return jsonify(error = f"Tile {key} not found."), 404
+    data, etag = result
+    response = Response(data, mimetype = "application/octet-stream")
+    if request.accept_encodings["gzip"]:
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response.set_data(gzip.decompress(data))
+        etag = f"{etag}-identity"
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response.make_conditional(request)
+
+
 @app.route("/stardata", methods = ["GET", "POST"])
 def stardata():
 # Show form to get data on a single star
     if request.method == "POST":
     # Return page with star data
-        # Get ID and catalogue for requested star
+        # Get ID and catalogue for requested star, and either the range or the number of closest stars
         try:
-            input = (request.form.get("star"), 
-                    request.form.get("cat"), 
-                    int(request.form.get("range")))
+            input = (request.form.get("star"), request.form.get("cat"))
+            mode = request.form.get("mode", "range")
+            if mode == "nearest":
+                count = int(request.form.get("count"))
+                if count < 1 or count > MAX_NEAREST:
+                    raise ValueError
+            else:
+                radius = float(request.form.get("range"))
+                if not radius >= 0:
+                    raise ValueError
+            filters = read_filters(request.form)
         except:
             return render_template("error.html", error = "Inputs not found.")
+
+        try:
+            epoch = int(request.form.get("year"))
+        except:
+            epoch = 2000
     
         # Create star object
         try:
-            star = create_star(input, catalogues, db)
+            with span("create_star"):
+                star = create_star(input, catalogues, db)
         except:
             return render_template("error.html", error = "Unable to create star object.")
                 
-        # Get list of stars in range
-        nearby_list = get_nearby(star, input[2], db)        
+        # Get list of stars in range (or the closest stars) for provided year
+        with span("get_nearby"):
+            if mode == "nearest":
+                nearby_list = get_nearest(star, count, db, epoch, filters)
+                result = f"Closest {len(nearby_list)} stars to {star.ref} in {epoch}"
+            else:
+                nearby_list = get_nearby(star, radius, db, epoch, filters)
+                result = f"Stars within {radius:g} parsecs of {star.ref} in {epoch}"
         
         # Return page with star data
-        result = f"Stars within {input[2]} parsecs of {star.ref}"
-        return render_template("stardata.html", catalogues = catalogues, datalists = star_lists, message = result, nearby = nearby_list, star = star.__dict__)
+        with span("render"):
+            return render_template("stardata.html", catalogues = catalogues, message = result, nearby = nearby_list, star = star)
     
     else: # request method == "GET"
     # Return page without star data
         instruction = "Select catalogue and star to see data and nearby systems."
-        return render_template("stardata.html", catalogues = catalogues, datalists = star_lists, message = instruction, nearby = "", star = "")
+        return render_template("stardata.html", catalogues = catalogues, message = instruction, nearby = "", star = "")
+
+
+@app.route("/metrics")
+def metrics():
+# Return request, stage timing, database query and cache metrics in the Prometheus text format
+    return Response(render_metrics(), mimetype = "text/plain; version=0.0.4")
+
+
+@app.route("/route", methods = ["GET", "POST"])
+def route():
+# Show form to plan a route between two stars
+    if request.method == "POST":
+    # Return page with the planned route
+        # Get IDs and catalogues for requested stars and the jump range
+        try:
+            inputs = [(request.form.get("starA"), request.form.get("catA")), 
+                    (request.form.get("starB"), request.form.get("catB"))
+                    ]
+            max_jump = float(request.form.get("jump"))
+        except:
+            return render_template("error.html", error = "Inputs not found.")
+
+        try:
+            epoch = int(request.form.get("year"))
+        except:
+            epoch = 2000
+        habitable_only = request.form.get("habitable") == "true"
+
+        # Create star objects
+        stars = []
+        try:
+            with span("create_star"):
+                for input in inputs:
+                    stars.append(create_star(input, catalogues, db))
+        except:
+            return render_template("error.html", error = "Unable to create star object.")
+
+        # Find the shortest route
+        try:
+            with span("plan_route"):
+                route_list = plan_route(stars[0], stars[1], max_jump, db, epoch, habitable_only)
+        except Exception as err:
+            return render_template("error.html", error = f"Unable to plan route: {err}")
+
+        # Return page with route
+        if route_list == None:
+            result = f"No route from {stars[0].ref} to {stars[1].ref} in {epoch} with jumps of up to {max_jump} parsecs."
+            route_list = []
+        elif isinstance(route_list, str):
+            # The search gave up, so a route may still exist
+            result = f"Route from {stars[0].ref} to {stars[1].ref} in {epoch} not found: {route_list} (a route may still exist)."
+            route_list = []
+        else:
+            result = f"Route from {stars[0].ref} to {stars[1].ref} in {epoch}: {len(route_list) - 1} jumps, {route_list[-1][2]: .3f} parsecs."
+        with span("render"):
+            return render_template("route.html", catalogues = catalogues, message = result, route = route_list)
+
+    else: # request method == "GET"
+    # Return page without route
+        return render_template("route.html", catalogues = catalogues, message = "", route = [])
+
+
+@app.route("/search")
+def search():
+# Return identifiers from a catalogue that start with the typed text, as JSON
+    key = request.args.get("cat", "proper")
+    prefix = request.args.get("q", "")
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 100)
+    except:
+        limit = 20
+
+    if key not in catalogues:
+        return jsonify(error = f"Unknown catalogue {key}."), 400
+
+    try:
+        with span("search_prefix"):
+            matches = search_prefix(db, key, prefix, limit, catalogues)
+    except Exception as err:
+        return jsonify(error = str(err)), 500
+    return jsonify(matches)
 
 
 @app.route("/notebook", methods = ["GET", "POST"])
@@ -133,7 +738,7 @@ def notebook():
 
         # If no changes were made
         if input[1] == star.notes:
-            return render_template("stardata.html", message = f"No changes to notebook for {star.ref}.", catalogues = catalogues, datalists = star_lists, star = star, nearby = "")
+            return render_template("stardata.html", message = f"No changes to notebook for {star.ref}.", catalogues = catalogues, star = star, nearby = "")
     
         # Otherwise update notes for star
         note_lookup = query(db, "SELECT * FROM notebook WHERE catalogue_id = ?;", (star.ids["id"],))
@@ -143,10 +748,11 @@ def notebook():
             note_id = int(note_lookup[0]["id"])
             result = query(db, "UPDATE notebook SET notes = ? WHERE id = ?;", (input[1], note_id))
         star.notes = input[1]
+        invalidate_star(db, star.ids["id"])
 
         # Redirect to correct page
         if result == True:
-            return render_template("stardata.html", catalogues = catalogues, datalists = star_lists, message = f"Notebook updated for {star.ref}.", nearby = "", star = star)
+            return render_template("stardata.html", catalogues = catalogues, message = f"Notebook updated for {star.ref}.", nearby = "", star = star)
         else:
             return render_template("error.html", error = f"Unable to update notebook table for {star.ref}.")
     
@@ -159,12 +765,49 @@ def notebook():
         star.ref = select_id(star.ids)
 
         # Render page
-        return render_template("notebook.html", star = star.__dict__)
+        return render_template("notebook.html", star = star)
+
+
+@app.route("/jobs", methods = ["GET", "POST"])
+def jobs():
+# List the background jobs as JSON (newest first), or start one from JSON values such as {"kind": "load", "table":
+# "catalogue"}, {"kind": "census", "radius": 5} or {"kind": "tiles"} (see submit_job). Jobs run one at a time.
+    if request.method == "POST":
+        try:
+            job = submit_job(request.get_json(silent = True) or request.form)
+        except (TypeError, ValueError) as err:
+            return jsonify(error = str(err)), 400
+        return jsonify(job.status()), 202, {"Location": f"/jobs/{job.id}"}
+
+    return jsonify([job.status() for job in job_queue.list()])
+
+
+@app.route("/jobs/<int:job_id>")
+def job_status(job_id):
+# Return the state of a background job as JSON, for polling until it has finished
+    job = job_queue.get(job_id)
+    if job == None:
+        return jsonify(error = f"Job {job_id} not found."), 404
+    return jsonify(job.status())
+
+
+@app.route("/jobs/<int:job_id>/cancel", methods = ["POST"])
+def cancel_job(job_id):
+# Cancel a queued or running background job. Running jobs stop at their next check.
+    job = job_queue.cancel(job_id)
+    if job == None:
+        return jsonify(error = f"Job {job_id} not found."), 404
+
+    # The Update Database page goes back to showing the job
+    if request.form.get("page") == "load":
+        return redirect(f"/load?job={job_id}", code = 303)
+    return jsonify(job.status())
 
 
 @app.route("/load", methods = ["GET", "POST"])
 def load():
-# Update the catalogue and habitable tables in the database
+# Update the catalogue and habitable tables in the database. The update runs as a background job, so the rest of the
+# application keeps working; the page shows the job until it has finished and then its results.
     if request.method == "POST":
         # Determine which button was pressed
         try:
@@ -172,35 +815,55 @@ def load():
         except:
             return render_template("error.html", error = "Could not retrieve table name.")
 
-        if table_name != "catalogue" and table_name != "habitable":
-            return render_template("error.html", f"Invalid table name {table_name} supplied.")
-
-        # Get file path
-        file_path = os.path.dirname(os.path.abspath(__file__)) + r"\table_data\\" + table_name
+        try:
+            job = submit_job({"kind": "load", "table": table_name})
+        except ValueError as err:
+            return render_template("error.html", error = str(err))
+        return redirect(f"/load?job={job.id}", code = 303)
 
-        # Drop existing table
-        if table_name == "catalogue":
-            result = query(db, "DROP TABLE IF EXISTS catalogue;", ())
-        elif table_name == "habitable":
-            result = query(db, "DROP TABLE IF EXISTS habitable;", ())
-        if result != True: # if the transaction failed
-            return render_template("error.html", error = f"Drop table query for {table_name} returned error: {result}")
+    else: # request method == "GET"
+        recent = [job.status() for job in job_queue.list() if job.kind == "load"]
+        if not request.args.get("job"):
+            # Render page
+            prompt = "Select table to update."
+            return render_template("load.html", message = prompt, rows = {}, timings = {}, job = None, jobs = recent)
 
-        # Upload new table
-        result = upload_table(db, file_path, table_name)
-        if result != True:
-            return render_template("error.html", error = f"Could not upload {table_name} table: {result}")
+        try:
+            job = job_queue.get(int(request.args.get("job")))
+        except ValueError:
+            job = None
+        if job == None:
+            return render_template("error.html", error = f"Update job {request.args.get('job')} not found.")
+        status = job.status()
+        if status["state"] == "failed":
+            return render_template("error.html", error = status["error"])
 
-        # Render page
-        report = f"{table_name} table updated."
-        return render_template("load.html", message = report)
-    
-    else: # request method == "GET"
-        # Render page
-        prompt = "Select table to update."
-        return render_template("load.html", message = prompt)
+        # Show the results once the job has finished, or its progress until then
+        if status["state"] == "finished":
+            return render_template("load.html", message = status["result"]["message"], rows = status["result"]["rows"],
+                                   timings = status["result"]["timings"], job = status, jobs = recent)
+        return render_template("load.html", message = status["message"], rows = {}, timings = {}, job = status, jobs = recent)
 
 
 if __name__ == "__main__":
-    webbrowser.open("http://127.0.0.1:5000")
-    app.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description = "Run the Stardata web application. Run one copy per database: background jobs and the in-memory indexes belong to this process, so other processes would not see its updates.")
+    parser.add_argument("--production", action = "store_true", help = "serve requests on several threads of this one process with waitress instead of the development server (do not run several processes on the same database)")
+    parser.add_argument("--host", default = "127.0.0.1", help = "address to listen on (0.0.0.0 for every network interface)")
+    parser.add_argument("--port", type = int, default = 5000, help = "port to listen on")
+    parser.add_argument("--threads", type = int, default = SERVER_THREADS, help = "requests handled at once in production mode")
+    args = parser.parse_args()
+    prepare_database()
+
+    if args.production:
+        # waitress is optional: without it the development server is used, with one thread per request
+        try:
+            from waitress import serve
+        except ImportError:
+            print("waitress is not installed (pip install waitress), so the development server is used instead.")
+            app.run(host = args.host, port = args.port, threaded = True)
+        else:
+            print(f"Serving on http://{args.host}:{args.port} with {args.threads} threads.")
+            serve(app, host = args.host, port = args.port, threads = args.threads)
+    else:
+        webbrowser.open(f"http://{args.host}:{args.port}")
+        app.run(host = args.host, port = args.port)
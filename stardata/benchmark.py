@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from cache import nearby_cache, star_cache
+from crossmatch import cross_match
+from database import query, set_query_hook, upload_table
+from motion import find_passes
+from region import read_shape, region_query
+from search import reset_search, search_prefix
+from snapshot import load_snapshot, write_snapshot
+from spatial import build_index
+from starcalcs import create_star, create_stars, get_nearby, index_table, select_id
+from tiles import write_tiles
+
+# Benchmark for the main code paths, run against synthetic catalogues with the AT-HYG schema.
+# Usage: python benchmark.py --sizes 10000 100000 --output results.json --compare previous.json
+
+# resource is not available on Windows, where the peak memory of Python allocations is traced with tracemalloc instead
+try:
+    import resource
+except ImportError:
+    resource = None
+
+this_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Catalogue sizes used when none are given
+DEFAULT_SIZES = [10000, 100000, 1000000, 2500000]
+
+# Star density of the synthetic catalogues, similar to the solar neighbourhood (stars per cubic parsec)
+STAR_DENSITY = 0.08
+
+# Rows generated and written at a time
+GENERATE_ROWS = 100000
+
+# A stage only counts as slower if it is this many times slower and at least MIN_SECONDS slower
+DEFAULT_THRESHOLD = 1.25
+MIN_SECONDS = 0.05
+
+GREEK = ["Alp", "Bet", "Gam", "Del", "Eps", "Zet", "Eta", "The", "Iot", "Kap", "Lam", "Mu", "Nu", "Xi", "Omi", "Pi", "Rho", "Sig", "Tau", "Ups", "Phi", "Chi", "Psi", "Ome"]
+CONSTELLATIONS = ["And", "Aql", "Ari", "Aur", "Boo", "Cas", "Cen", "Cet", "Cyg", "Dra", "Eri", "Gem", "Her", "Leo", "Lyr", "Ori", "Peg", "Per", "Sco", "Tau", "UMa", "Vir"]
+SPECTRAL = ["O9 V", "B2 V", "A0 V", "A7 V", "F5 V", "G2 V", "G8 V", "K0 V", "K5 V", "M0 V", "M3.5 V", "M5 V", "K2 III", "DA"]
+
+
+def sparse(rng, values, fraction):
+# Returns values with all but the given fraction replaced by None
+    values = np.asarray(values, dtype = object)
+    values[rng.random(len(values)) >= fraction] = None
+    return values
+
+
+def generate_chunk(rng, start, count, radius, data_types):
+# Returns a DataFrame of synthetic catalogue rows with ids start + 1 to start + count
+    ids = np.arange(start + 1, start + count + 1)
+
+    # Positions spread evenly through a sphere, with velocities similar to nearby disc stars
+    direction = rng.normal(size = (count, 3))
+    direction /= np.linalg.norm(direction, axis = 1)[:, np.newaxis]
+    distance = radius * np.cbrt(rng.random(count))
+    xyz = direction * distance[:, np.newaxis]
+
+    columns = {
+        "id": ids.astype(str),
+        "tyc": sparse(rng, [f"{a}-{b}-1" for a, b in zip(rng.integers(1, 9538, count), rng.integers(1, 20000, count))], 0.8),
+        "gaia": sparse(rng, (rng.integers(10**15, 7 * 10**18, count)).astype(str), 0.9),
+        "hyg": sparse(rng, ids.astype(str), 0.05),
+        "hip": sparse(rng, ids.astype(str), 0.05),
+        "hd": sparse(rng, ids.astype(str), 0.1),
+        "hr": sparse(rng, ids.astype(str), 0.004),
+        "gl": sparse(rng, [f"Gl {i}" for i in ids], 0.002),
+        "bayer": sparse(rng, rng.choice(GREEK, count), 0.01),
+        "flam": sparse(rng, rng.integers(1, 100, count).astype(str), 0.01),
+        "con": rng.choice(CONSTELLATIONS, count),
+        "proper": sparse(rng, [f"Star {i}" for i in ids], 0.0005),
+        "ra": (np.degrees(np.arctan2(xyz[:, 1], xyz[:, 0])) % 360) / 15,
+        "dec": np.degrees(np.arcsin(np.clip(xyz[:, 2] / np.maximum(distance, 1e-9), -1, 1))),
+        "dist": distance,
+        "x0": xyz[:, 0],
+        "y0": xyz[:, 1],
+        "z0": xyz[:, 2],
+        "mag": rng.normal(12, 3, count),
+        "absmag": rng.normal(9, 4, count),
+        "ci": rng.normal(1.2, 0.5, count),
+        "rv": rng.normal(0, 30, count),
+        "pm_ra": rng.normal(0, 200, count),
+        "pm_dec": rng.normal(0, 200, count),
+        "vx": rng.normal(0, 30, count),
+        "vy": rng.normal(0, 30, count),
+        "vz": rng.normal(0, 20, count),
+        "spect": rng.choice(SPECTRAL, count)
+        }
+
+    # Make sure every bf identifier has all three parts or none
+    has_bf = columns["bayer"] != None
+    columns["flam"][~has_bf] = None
+    columns["flam"][has_bf & (columns["flam"] == None)] = "1"
+    columns["bayer"][columns["flam"] == None] = None
+
+    # Any other columns in the schema (mostly *_src) get a short source code or a random number
+    for key, value in data_types.items():
+        if key not in columns:
+            columns[key] = rng.choice(["G3", "HIP", "T", "OTHER"], count) if value == "string" else rng.normal(0, 1, count)
+
+    if start == 0:
+        # First row is Sol, like the real catalogue
+        for key in ["tyc", "gaia", "hyg", "hip", "hd", "hr", "gl", "bayer", "flam", "con"]:
+            columns[key][0] = None
+        columns["proper"][0] = "Sol"
+        for key in ["x0", "y0", "z0", "vx", "vy", "vz", "dist"]:
+            columns[key][0] = 0.0
+
+    return pd.DataFrame({key: columns[key] for key in data_types})
+
+
+def generate_catalogue(size, folder, seed = 0):
+# Writes a synthetic catalogue csv with the AT-HYG schema (plus its DTypes.json) to folder, reusing an existing one
+    csv_path = os.path.join(folder, f"synthetic-{size}.csv")
+    if os.path.isfile(csv_path):
+        return csv_path
+    os.makedirs(folder, exist_ok = True)
+
+    types_path = os.path.join(this_directory, "table_data", "catalogue", "DTypes.json")
+    with open(types_path, "r", encoding = "utf-8") as file:
+        data_types = json.load(file)
+    shutil.copy(types_path, os.path.join(folder, "DTypes.json"))
+
+    # Radius of a sphere holding size stars at STAR_DENSITY
+    radius = float(np.cbrt(3 * size / (4 * np.pi * STAR_DENSITY)))
+    rng = np.random.default_rng(seed)
+    partial_path = csv_path + ".partial"
+    for start in range(0, size, GENERATE_ROWS):
+        chunk = generate_chunk(rng, start, min(GENERATE_ROWS, size - start), radius, data_types)
+        chunk.to_csv(partial_path, mode = "w" if start == 0 else "a", header = start == 0, index = False, na_rep = "NULL")
+    os.replace(partial_path, csv_path)
+    return csv_path
+
+
+def read_peak_rss():
+# Returns the peak resident memory of this process in MB, or the peak traced by tracemalloc where resource is missing
+    if resource == None:
+        return tracemalloc.get_traced_memory()[1] / 1048576
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+# Resets the peak memory counter so each stage reports its own peak (Linux, or tracemalloc where resource is missing)
+    if resource == None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        return
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+    except OSError:
+        pass
+
+
+def measure(results, stage, db, function, *args):
+# Runs function(*args) and records its wall time, peak memory and number of query, query_batch and query_array calls
+# (counted as metrics.py does: a query_batch of several statements is one call, and bulk loads through a pooled
+# connection are not included). Only the time is compared between runs.
+    calls = [0]
+    def count(function, seconds, rows, failed):
+        calls[0] += 1
+    set_query_hook(count)
+    reset_peak_rss()
+
+    start = time.perf_counter()
+    value = function(*args)
+    seconds = time.perf_counter() - start
+
+    set_query_hook(None)
+    results[stage] = {"seconds": seconds, "peak_rss_mb": read_peak_rss(), "query_calls": calls[0]}
+    print(f"  {stage:<16} {seconds:9.3f} s {results[stage]['peak_rss_mb']:9.1f} MB {calls[0]:>10} query calls", flush = True)
+    return value
+
+
+def run_size(size, work_folder, catalogues, samples, seed):
+# Builds a database from a synthetic catalogue of the given size and times each stage against it
+    print(f"{size} stars", flush = True)
+    results = {}
+    catalogue_folder = os.path.join(work_folder, f"catalogue-{size}")
+    db = os.path.join(work_folder, f"bench-{size}.db")
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.isfile(db + suffix):
+            os.remove(db + suffix)
+
+    start = time.perf_counter()
+    generate_catalogue(size, catalogue_folder, seed)
+    print(f"  {'generate':<16} {time.perf_counter() - start:9.3f} s", flush = True)
+
+    # Loading and indexing
+    measure(results, "upload_table", db, upload_table, db, catalogue_folder, "catalogue")
+    upload_table(db, os.path.join(this_directory, "table_data", "habitable"), "habitable")
+    index_table(db, "habitable", catalogues)
+    query(db, "CREATE TABLE notebook (id INTEGER NOT NULL PRIMARY KEY, catalogue_id INTEGER NOT NULL, notes TEXT);", ())
+    index_table(db, "notebook", catalogues)
+    measure(results, "index_table", db, index_table, db, "catalogue", catalogues)
+    measure(results, "cross_match", db, cross_match, db)
+    measure(results, "build_index", db, build_index, db)
+
+    # Identifier lists for the star selection (built at startup before the search index replaced them)
+    def build_lists():
+        reset_search(db)
+        for key in catalogues:
+            search_prefix(db, key, "1", 20, catalogues)
+    measure(results, "search_index", db, build_lists)
+    def search_many():
+        for prefix in ["1", "12", "Star 1", "Sol", "Gl 4", "9"]:
+            for key in catalogues:
+                search_prefix(db, key, prefix, 20, catalogues)
+    measure(results, "search_prefix", db, search_many)
+
+    # Catalogue snapshot, used by the remaining stages as it is by the app
+    measure(results, "write_snapshot", db, write_snapshot, db, catalogues)
+    def load():
+        reset_search(db)
+        return load_snapshot(db)
+    measure(results, "load_snapshot", db, load)
+
+    # Star lookups, with the result caches emptied so every lookup reaches the database
+    rng = random.Random(seed)
+    star_ids = [str(rng.randint(1, size)) for i in range(samples)]
+    def lookup_stars():
+        star_cache.invalidate(lambda key, value: True)
+        return [create_star((star_id, "id"), catalogues, db) for star_id in star_ids]
+    stars = measure(results, "create_star", db, lookup_stars)
+    def create_batch():
+        star_cache.invalidate(lambda key, value: True)
+        return create_stars([(star_id, "id") for star_id in star_ids], catalogues, db)
+    measure(results, "create_stars", db, create_batch)
+
+    for radius in [5, 15]:
+        def nearby():
+            nearby_cache.invalidate(lambda key, value: True)
+            return sum(len(get_nearby(star, radius, db)) for star in stars)
+        measure(results, f"get_nearby_{radius}", db, nearby)
+    def nearby_epoch():
+        nearby_cache.invalidate(lambda key, value: True)
+        return sum(len(get_nearby(star, 5, db, -50000)) for star in stars)
+    measure(results, "get_nearby_epoch", db, nearby_epoch)
+    def passes():
+        return len(find_passes(stars[0], 5, 2000, 102000, db))
+    measure(results, "find_passes", db, passes)
+    shapes = [read_shape({"type": "cone", "ra": 6, "dec": 0, "angle": 30}), read_shape({"type": "slab", "min_height": -20, "max_height": 20})]
+    def region():
+        return len(region_query(db, shapes, {"max_absmag": 6})[0])
+    measure(results, "region_query", db, region)
+    measure(results, "write_tiles", db, write_tiles, db)
+
+    rows = query(db, "SELECT * FROM catalogue LIMIT 100000;", ())
+    def select_ids():
+        return [select_id(row) for row in rows]
+    measure(results, "select_id", db, select_ids)
+
+    return results
+
+
+def compare(current, previous, threshold):
+# Prints the change for every stage measured in both runs and returns a list of regressions
+    regressions = []
+    print(f"{'size':>9} {'stage':<16} {'before':>9} {'after':>9} {'ratio':>7}")
+    for size, stages in current["results"].items():
+        for stage, result in stages.items():
+            before = previous.get("results", {}).get(size, {}).get(stage)
+            if before == None:
+                continue
+            ratio = result["seconds"] / before["seconds"] if before["seconds"] > 0 else float("inf")
+            slower = ratio > threshold and result["seconds"] - before["seconds"] > MIN_SECONDS
+            if slower:
+                regressions.append((size, stage, ratio))
+            print(f"{size:>9} {stage:<16} {before['seconds']:9.3f} {result['seconds']:9.3f} {ratio:7.2f}{'  SLOWER' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark stardata against synthetic AT-HYG catalogues.")
+    parser.add_argument("--sizes", nargs = "+", type = int, default = DEFAULT_SIZES, help = "catalogue sizes (stars)")
+    parser.add_argument("--samples", type = int, default = 200, help = "stars looked up in the create_star and get_nearby stages")
+    parser.add_argument("--seed", type = int, default = 0, help = "random seed for the synthetic catalogues")
+    parser.add_argument("--work", default = os.path.join(tempfile.gettempdir(), "stardata-benchmark"), help = "folder for generated catalogues and databases")
+    parser.add_argument("--output", help = "write results to this JSON file")
+    parser.add_argument("--compare", help = "compare against results from an earlier run")
+    parser.add_argument("--threshold", type = float, default = DEFAULT_THRESHOLD, help = "slowdown ratio reported as a regression")
+    args = parser.parse_args()
+
+    with open(os.path.join(this_directory, "catalogues.json"), "r", encoding = "utf-8") as file:
+        catalogues = json.load(file)
+
+    current = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "samples": args.samples,
+        "results": {}
+        }
+    for size in args.sizes:
+        current["results"][str(size)] = run_size(size, args.work, catalogues, args.samples, args.seed)
+
+    if args.output:
+        with open(args.output, "w", encoding = "utf-8") as file:
+            json.dump(current, file, indent = 2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding = "utf-8") as file:
+            previous = json.load(file)
+        regressions = compare(current, previous, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stages slower than {args.threshold}x the earlier run.")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+# Limits for the result caches: number of entries kept and seconds before an entry expires
+STAR_CACHE_SIZE = 1024
+NEARBY_CACHE_SIZE = 256
+FILTER_CACHE_SIZE = 16
+CACHE_TTL = 600
+
+
+class LRUCache:
+# Thread-safe least recently used cache with a maximum number of entries and a time-to-live.
+# Counts hits, misses, evictions and invalidations so the limits can be sized from real use.
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+
+    def get(self, key):
+    # Returns the cached value for key, or None if it is missing or has expired
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry != None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+
+
+    def put(self, key, value):
+    # Stores value for key, evicting the least recently used entries if the cache is full
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+                self.evictions += 1
+
+
+    def invalidate(self, match):
+    # Removes every entry where match(key, value) is true
+        with self.lock:
+            keys = [key for key, entry in self.entries.items() if match(key, entry[1])]
+            for key in keys:
+                del self.entries[key]
+            self.invalidations += len(keys)
+
+
+    def stats(self):
+    # Returns the cache counters and limits as a dictionary
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+                }
+
+
+# Resolved Star objects keyed by (database, catalogue, identifier)
+star_cache = LRUCache(STAR_CACHE_SIZE, CACHE_TTL)
+
+# get_nearby and get_nearest results keyed by (database, star id, radius or count, epoch, exact mode, filters)
+nearby_cache = LRUCache(NEARBY_CACHE_SIZE, CACHE_TTL)
+
+# Nearby star filter masks (one flag per star in the spatial index) keyed by (database, filters)
+filter_cache = LRUCache(FILTER_CACHE_SIZE, CACHE_TTL)
+
+
+def invalidate_star(db, star_id):
+# Removes cached copies of one star, e.g. after its notes change
+    star_cache.invalidate(lambda key, star: key[0] == db and star.ids["id"] == star_id)
+
+
+def invalidate_table(db, table_name):
+# Removes cached results that depend on a table that has been replaced
+    star_cache.invalidate(lambda key, star: key[0] == db)
+    filter_cache.invalidate(lambda key, mask: key[0] == db)
+    if table_name == "catalogue" or table_name == "habitable":
+        nearby_cache.invalidate(lambda key, nearby: key[0] == db)
+
+
+def cache_stats():
+# Returns the counters for all result caches
+    return {"stars": star_cache.stats(), "nearby": nearby_cache.stats(), "filters": filter_cache.stats()}
@@ -0,0 +1,273 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from database import query, query_batch
+from snapshot import load_snapshot
+from spatial import build_index, get_index
+from starcalcs import calculate_distances, filter_mask, lookup_refs
+
+# Neighbour census of the whole catalogue: for every star, the number of other stars within a radius, the nearest
+# other star and the nearest potentially habitable star (J2000.0 positions), stored in the census table.
+# Usage: python census.py --radius 5 --workers 8
+# Space is split into cubic blocks that are processed in parallel by worker processes, each memory-mapping the
+# catalogue snapshot (so the coordinate arrays are shared, not copied). Finished blocks are recorded as they are
+# written, so an interrupted census carries on where it stopped when run again with the same settings.
+
+this_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Average number of stars per block when no block size is given
+BLOCK_STARS = 4096
+
+# Stars searched together (stars in a block are in grid cell order, so each chunk covers a small part of space)
+CHUNK_STARS = 256
+
+# Memory allowed for the temporary arrays used to compare one chunk of stars with their candidates
+BLOCK_BYTES = 64 * 1024 * 1024
+
+# Rows written by each INSERT statement (7 values per row, to stay under the SQLite variable limit)
+INSERT_ROWS = 100
+
+CENSUS_TABLES = [
+    "CREATE TABLE IF NOT EXISTS census (catalogue_id TEXT NOT NULL PRIMARY KEY, neighbours INTEGER NOT NULL, "
+    "nearest_id TEXT, nearest_distance REAL, habitable_id TEXT, habitable_distance REAL, block TEXT NOT NULL);",
+    "CREATE TABLE IF NOT EXISTS census_blocks (block TEXT NOT NULL PRIMARY KEY, stars INTEGER NOT NULL, seconds REAL NOT NULL);",
+    "CREATE TABLE IF NOT EXISTS census_runs (radius REAL NOT NULL, block_size REAL NOT NULL, origin TEXT NOT NULL, "
+    "stars INTEGER NOT NULL, max_rowid INTEGER, started TEXT NOT NULL);"
+    ]
+
+# Database used by this worker process, and its habitable star mask over the spatial index
+worker = {}
+
+
+def block_keys(points, origin, block_size):
+# Returns the block (ix, iy, iz) of each point
+    return np.floor((points - origin) / block_size).astype(np.int64)
+
+
+def census_block(key, radius, origin, block_size):
+# Runs the census for the stars in one block (in a worker process).
+# Returns (block name, rows, seconds) with one (catalogue_id, neighbours, nearest_id, nearest_distance, habitable_id,
+# habitable_distance, block) row per star.
+    start = time.perf_counter()
+    db = worker["db"]
+    index = get_index(db)
+    key = np.asarray(key, dtype = np.int64)
+    name = ",".join(str(value) for value in key.tolist())
+
+    # Stars in the block (the box is widened slightly so rounding cannot lose any)
+    lower = origin + key * block_size
+    members = index.query_box(lower - 1e-6, lower + block_size + 1e-6)
+    members = members[np.all(block_keys(index.points[members], origin, block_size) == key, axis = 1)]
+
+    neighbours = count_neighbours(index, members, radius)
+    nearest, nearest_distances = nearest_neighbours(index, members, None, radius)
+    habitable, habitable_distances = nearest_neighbours(index, members, worker["habitable"], radius)
+
+    # Look up the IDs of the stars and their nearest neighbours in one go
+    found = np.concatenate([members, nearest[nearest >= 0], habitable[habitable >= 0]])
+    refs, ids = lookup_refs(db, index.rowids[found])
+    ids = dict(zip(found.tolist(), ids))
+
+    rows = []
+    for i, position in enumerate(members.tolist()):
+        nearest_id = ids[int(nearest[i])] if nearest[i] >= 0 else None
+        habitable_id = ids[int(habitable[i])] if habitable[i] >= 0 else None
+        rows.append((ids[position], int(neighbours[i]), nearest_id, finite(nearest_distances[i]), habitable_id,
+                     finite(habitable_distances[i]), name))
+    return name, rows, time.perf_counter() - start
+
+
+def chunk_rows(count):
+# Returns the number of stars to compare with count candidates at once so the temporary arrays fit in BLOCK_BYTES
+    return max(1, BLOCK_BYTES // max(1, count * 3 * 8))
+
+
+def count_neighbours(index, members, radius):
+# Returns the number of other stars within radius (pc) of each member star
+    counts = np.zeros(len(members), dtype = np.int64)
+    for start in range(0, len(members), CHUNK_STARS):
+        chunk = members[start:start + CHUNK_STARS]
+        points = index.points[chunk]
+        candidates = index.query_box(points.min(axis = 0) - radius, points.max(axis = 0) + radius)
+        step = chunk_rows(len(candidates))
+        for first in range(0, len(chunk), step):
+            distances = calculate_distances(points[first:first + step], index.points[candidates])
+            # The star itself is always found at distance zero
+            counts[start + first:start + first + len(distances)] = (distances <= radius).sum(axis = 1) - 1
+    return counts
+
+
+def finite(value):
+# Returns a distance as a float, or None if no star was found
+    return float(value) if np.isfinite(value) else None
+
+
+def init_worker(db):
+# Prepares a worker process: memory-maps the catalogue snapshot (or reads the catalogue if there is none) and
+# finds the potentially habitable stars
+    if load_snapshot(db) != True:
+        build_index(db)
+    index = get_index(db)
+    worker["db"] = db
+    worker["habitable"] = filter_mask(db, index, {"habitable": True})
+
+
+def nearest_neighbours(index, members, allowed, reach):
+# Returns the positions (into the spatial index) and distances of the nearest other star to each member star, or
+# -1 and infinity if there is none. allowed is None or a boolean array limiting the stars that can be chosen.
+# Each round searches a box reach (pc) around a chunk of nearby stars; a star closer than reach cannot have been
+# missed, so only the others are searched again with double the reach.
+    found = np.full(len(members), -1, dtype = np.int64)
+    distances = np.full(len(members), np.inf)
+    top = index.origin + index.dims * index.cell_size
+    for start in range(0, len(members), CHUNK_STARS):
+        pending = np.arange(start, min(start + CHUNK_STARS, len(members)))
+        radius = reach
+        while len(pending) > 0:
+            points = index.points[members[pending]]
+            lower = points.min(axis = 0) - radius
+            upper = points.max(axis = 0) + radius
+            candidates = index.query_box(lower, upper)
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+
+            step = chunk_rows(len(candidates))
+            best = np.full(len(pending), -1, dtype = np.int64)
+            best_distances = np.full(len(pending), np.inf)
+            if len(candidates) > 0:
+                for first in range(0, len(pending), step):
+                    block = calculate_distances(points[first:first + step], index.points[candidates])
+                    # Ignore each star's distance to itself
+                    block[members[pending[first:first + step], np.newaxis] == candidates[np.newaxis, :]] = np.inf
+                    closest = block.argmin(axis = 1)
+                    best[first:first + len(block)] = candidates[closest]
+                    best_distances[first:first + len(block)] = block[np.arange(len(block)), closest]
+                best[~np.isfinite(best_distances)] = -1
+
+            # Once the box covers the whole catalogue every result is final
+            done = best_distances <= radius
+            if np.all(lower <= index.origin) and np.all(upper >= top):
+                done[:] = True
+            found[pending[done]] = best[done]
+            distances[pending[done]] = best_distances[done]
+            pending = pending[~done]
+            radius *= 2
+    return found, distances
+
+
+def reset_census(db):
+# Removes the census tables, e.g. after the catalogue has been reloaded. Returns True or the error value.
+    results = query_batch(db, [(f"DROP TABLE IF EXISTS {name};", ()) for name in ["census", "census_blocks", "census_runs"]])
+    return True if isinstance(results, list) else results
+
+
+def run_census(db, radius, block_size = None, workers = None, restart = False, progress = None, cancelled = None):
+# Runs the neighbour census and stores the results in the census table. An unfinished census with the same settings
+# is carried on unless restart is True. progress(blocks done, blocks, stars done, stars) is called as blocks finish.
+# If cancelled is given, it is called as blocks finish and the census stops if it is true (finished blocks are kept,
+# so the census carries on from there when it is run again).
+# Returns the number of stars written, or the error value.
+    if load_snapshot(db) != True:
+        build_index(db)
+    index = get_index(db)
+    if len(index.rowids) == 0:
+        return 0
+
+    # Choose cubic blocks holding about BLOCK_STARS stars on average
+    origin = index.points.min(axis = 0)
+    if block_size == None:
+        volume = float(np.prod(np.maximum(index.points.max(axis = 0) - origin, 1e-3)))
+        block_size = max((volume * BLOCK_STARS / len(index.rowids)) ** (1 / 3), radius, 1e-3)
+    keys, counts = np.unique(block_keys(index.points, origin, block_size), axis = 0, return_counts = True)
+
+    # Start again if the settings or the catalogue have changed since the last run
+    stars = len(index.rowids)
+    top = query(db, "SELECT max(rowid) FROM catalogue;", ())
+    top = top[0][0] if isinstance(top, list) else None
+    settings = (radius, block_size, ",".join(repr(value) for value in origin.tolist()), stars, top)
+    runs = query(db, "SELECT radius, block_size, origin, stars, max_rowid FROM census_runs;", ())
+    if restart or not isinstance(runs, list) or tuple(runs[0]) != settings:
+        result = reset_census(db)
+        if result == True:
+            result = query_batch(db, [(statement, ()) for statement in CENSUS_TABLES] +
+                                 [("INSERT INTO census_runs (radius, block_size, origin, stars, max_rowid, started) VALUES (?, ?, ?, ?, ?, ?);",
+                                   settings + (time.strftime("%Y-%m-%dT%H:%M:%S"),))])
+        if not isinstance(result, list):
+            return result
+
+    done = query(db, "SELECT block, stars FROM census_blocks;", ())
+    if not isinstance(done, list) and done != None:
+        return done
+    finished = {row["block"]: row["stars"] for row in done or []}
+    pending = [(key, count) for key, count in zip(keys.tolist(), counts.tolist()) if ",".join(str(value) for value in key) not in finished]
+
+    # Largest blocks first, so the slowest ones do not finish last
+    pending.sort(key = lambda item: -item[1])
+    blocks_done = len(keys) - len(pending)
+    stars_done = sum(finished.values())
+    if progress != None:
+        progress(blocks_done, len(keys), stars_done, stars)
+
+    # Workers are started fresh rather than forked, as the census may be run from a thread of the web application
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers = workers, mp_context = context, initializer = init_worker, initargs = (db,)) as executor:
+        futures = [executor.submit(census_block, key, radius, origin, block_size) for key, count in pending]
+        for future in as_completed(futures):
+            name, rows, seconds = future.result()
+
+            # Write each block and mark it finished in one transaction
+            statements = []
+            for i in range(0, len(rows), INSERT_ROWS):
+                chunk = rows[i:i + INSERT_ROWS]
+                values = ", ".join(["(?, ?, ?, ?, ?, ?, ?)"] * len(chunk))
+                statements.append((f"INSERT OR REPLACE INTO census (catalogue_id, neighbours, nearest_id, nearest_distance, habitable_id, habitable_distance, block) VALUES {values};",
+                                   [value for row in chunk for value in row]))
+            statements.append(("INSERT OR REPLACE INTO census_blocks (block, stars, seconds) VALUES (?, ?, ?);", (name, len(rows), seconds)))
+            result = query_batch(db, statements)
+            if not isinstance(result, list):
+                for future in futures:
+                    future.cancel()
+                return result
+
+            blocks_done += 1
+            stars_done += len(rows)
+            if progress != None:
+                progress(blocks_done, len(keys), stars_done, stars)
+            if cancelled != None and cancelled():
+                for future in futures:
+                    future.cancel()
+                return f"Census cancelled after {blocks_done} of {len(keys)} blocks."
+    return stars_done
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Count the neighbours of every star in the catalogue.")
+    parser.add_argument("--radius", type = float, default = 5, help = "neighbour radius (pc)")
+    parser.add_argument("--block", type = float, help = "edge of the cubic blocks processed in parallel (pc)")
+    parser.add_argument("--workers", type = int, help = "worker processes (default: one per CPU)")
+    parser.add_argument("--restart", action = "store_true", help = "discard an unfinished census instead of carrying on")
+    parser.add_argument("--db", default = this_directory + r"\stars.db", help = "database location")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    def report(blocks_done, blocks, stars_done, stars):
+        seconds = time.perf_counter() - start
+        rate = stars_done / seconds if seconds > 0 else 0
+        print(f"\r{blocks_done}/{blocks} blocks, {stars_done}/{stars} stars ({rate:,.0f} stars/s)", end = "", file = sys.stderr, flush = True)
+
+    result = run_census(args.db, args.radius, args.block, args.workers, args.restart, report)
+    print(file = sys.stderr)
+    if not isinstance(result, int):
+        print(f"Census failed: {result}")
+        sys.exit(1)
+    print(f"Census of {result} stars finished in {time.perf_counter() - start:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import time
+
+import numpy as np
+
+from database import create_indexes, query, query_array, query_batch
+from spatial import gather_runs
+
+# The habitable table (APJ-HABCAT2) is matched to the catalogue once, when either table is loaded. Catalogue stars are
+# matched by HIP number first; habitable stars left over are then matched to the nearest catalogue star without a HIP
+# number in the same direction. The result is kept in the catalogue table itself, so habitability is read as a column.
+
+# Columns added to the catalogue table: 1 for potentially habitable stars (and Sol), the HIP number of the matching
+# habitable row, and how it was matched ("hip", "position" or "sol")
+MATCH_COLUMNS = {"habitable": "INTEGER NOT NULL DEFAULT 0", "habitable_hip": "INTEGER", "habitable_match": "TEXT"}
+
+# Largest angle (arcseconds) between a habitable star and its positional match
+MATCH_ARCSEC = 10.0
+
+# HABCAT positions are for the Hipparcos epoch, so catalogue positions are moved back to it using their proper motions
+HABCAT_EPOCH = 1991.25
+
+# A positional match must also agree with the habitable star's parallax to within this many standard errors, or
+# this fraction of the parallax (Hipparcos and Gaia parallaxes of binary stars often differ by more than their errors)
+PARALLAX_SIGMAS = 3.0
+PARALLAX_FRACTION = 0.25
+
+# Matches written by each INSERT statement (3 values per row, to stay under the SQLite variable limit)
+INSERT_ROWS = 300
+
+
+def cross_match(db, tolerance = MATCH_ARCSEC):
+# Matches the habitable table to the catalogue and stores the result in the MATCH_COLUMNS of the catalogue table.
+# Returns a report of {phase: {"rows": row count, "seconds": seconds taken}} or the error value.
+    report = {}
+
+    # Add the columns if the catalogue table was loaded without them
+    start = time.perf_counter()
+    columns = query(db, "SELECT name FROM pragma_table_info('catalogue');", ())
+    if not isinstance(columns, list):
+        return columns
+    names = [row[0] for row in columns]
+    for name, definition in MATCH_COLUMNS.items():
+        if name not in names:
+            result = query(db, f'ALTER TABLE catalogue ADD COLUMN "{name}" {definition};', ())
+            if result != True:
+                return result
+
+    # Habitable stars with the same HIP number as a catalogue star (text HIP numbers compare as integers)
+    matches = {}
+    rows = query(db, "SELECT c.rowid, h.HIP FROM catalogue c JOIN habitable h ON h.HIP = c.hip;", ())
+    if not isinstance(rows, list) and rows != None:
+        return rows
+    for row in rows or []:
+        matches[row[0]] = (row[1], "hip")
+    report["match hip"] = {"rows": len(matches), "seconds": time.perf_counter() - start}
+
+    # Nearest catalogue star without a HIP number in the direction of each habitable star left over
+    start = time.perf_counter()
+    result = match_positions(db, set(row[1] for row in rows or []), tolerance)
+    if not isinstance(result, dict):
+        return result
+    matches.update(result)
+    report["match position"] = {"rows": len(result), "seconds": time.perf_counter() - start}
+
+    # Sol is not in HABCAT but is always potentially habitable
+    rows = query(db, "SELECT rowid FROM catalogue WHERE proper = 'Sol';", ())
+    if isinstance(rows, list):
+        for row in rows:
+            matches.setdefault(row[0], (None, "sol"))
+
+    # Replace the previous matches in one transaction
+    start = time.perf_counter()
+    statements = [
+        ("UPDATE catalogue SET habitable = 0, habitable_hip = NULL, habitable_match = NULL WHERE habitable != 0 OR habitable_hip IS NOT NULL;", ()),
+        ("DROP TABLE IF EXISTS temp.habitable_matches;", ()),
+        ("CREATE TEMP TABLE habitable_matches (row INTEGER NOT NULL PRIMARY KEY, hip INTEGER, method TEXT NOT NULL);", ())
+        ]
+    items = [(rowid, hip, method) for rowid, (hip, method) in matches.items()]
+    for i in range(0, len(items), INSERT_ROWS):
+        chunk = items[i:i + INSERT_ROWS]
+        statements.append((f"INSERT INTO temp.habitable_matches VALUES {', '.join(['(?, ?, ?)'] * len(chunk))};", [value for item in chunk for value in item]))
+    statements.append(("UPDATE catalogue SET habitable = 1, habitable_hip = m.hip, habitable_match = m.method "
+                       "FROM temp.habitable_matches m WHERE catalogue.rowid = m.row;", ()))
+    statements.append(("DROP TABLE temp.habitable_matches;", ()))
+    result = query_batch(db, statements)
+    if not isinstance(result, list):
+        return result
+    report["store matches"] = {"rows": len(items), "seconds": time.perf_counter() - start}
+
+    timings = create_indexes(db, "catalogue", [("habitable",), ("habitable_hip",)])
+    if not isinstance(timings, dict):
+        return timings
+    for name, seconds in timings.items():
+        report[name] = {"rows": len(items), "seconds": seconds}
+    return report
+
+
+def has_cross_match(db):
+# Returns True if the catalogue table has the habitable cross-match columns
+    columns = query(db, "SELECT name FROM pragma_table_info('catalogue');", ())
+    if not isinstance(columns, list):
+        return False
+    names = [row[0] for row in columns]
+    return all(name in names for name in MATCH_COLUMNS)
+
+
+def match_positions(db, matched, tolerance):
+# Returns {catalogue rowid: (HIP, "position")} for habitable stars whose HIP numbers (not in matched) are missing from
+# the catalogue, matched to the nearest catalogue star without a HIP number within tolerance (arcseconds) whose
+# distance agrees with the habitable parallax. Each catalogue star is matched at most once, to the closest.
+    rows = query(db, "SELECT HIP, RA, DEC, PARX, SIGPX FROM habitable;", ())
+    if not isinstance(rows, list):
+        return {} if rows == None else rows
+    targets = []
+    for row in rows:
+        if row["HIP"] in matched:
+            continue
+        position = parse_position(row["RA"], row["DEC"])
+        if position != None:
+            targets.append((row["HIP"],) + position + (nan_if_none(row["PARX"]), nan_if_none(row["SIGPX"])))
+    if not targets:
+        return {}
+    hips = [target[0] for target in targets]
+    targets = np.array([target[1:] for target in targets], dtype = float)
+
+    # Candidates sorted by declination, so those within tolerance of each habitable star are one run
+    candidates = query_array(db, "SELECT rowid, ra, dec, dist, pm_ra, pm_dec FROM catalogue WHERE (hip IS NULL OR hip = '') "
+                                 "AND ra IS NOT NULL AND dec IS NOT NULL;", ())
+    if not isinstance(candidates, np.ndarray):
+        return candidates
+    if len(candidates) == 0:
+        return {}
+
+    # Proper motions are in mas per year, with pm_ra already multiplied by cos(dec)
+    years = HABCAT_EPOCH - 2000
+    candidates[:, 2] += np.nan_to_num(candidates[:, 5]) * years / 3.6e6
+    candidates[:, 1] += np.nan_to_num(candidates[:, 4]) * years / 3.6e6 / 15 / np.maximum(np.cos(np.radians(candidates[:, 2])), 1e-9)
+    candidates = candidates[np.lexsort((candidates[:, 0], candidates[:, 2]))]
+    band = tolerance / 3600
+    starts = np.searchsorted(candidates[:, 2], targets[:, 1] - band, side = "left")
+    ends = np.searchsorted(candidates[:, 2], targets[:, 1] + band, side = "right")
+    pairs = gather_runs(starts, ends)
+    owners = np.repeat(np.arange(len(targets)), ends - starts)
+
+    # Angle between each habitable star and each candidate in its band (the chord between unit vectors)
+    chords = np.sqrt(((unit_vectors(targets[owners, 0], targets[owners, 1]) -
+                       unit_vectors(candidates[pairs, 1], candidates[pairs, 2]))**2).sum(axis = 1))
+    separations = np.degrees(2 * np.arcsin(np.minimum(chords / 2, 1))) * 3600
+    keep = separations <= tolerance
+
+    # Skip stars whose distance disagrees with the parallax (when both are known)
+    parallax = targets[owners, 2]
+    error = targets[owners, 3]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        disagree = np.abs(1000 / candidates[pairs, 3] - parallax) > np.maximum(PARALLAX_SIGMAS * error, PARALLAX_FRACTION * parallax)
+    keep &= ~(disagree & (parallax > 0) & (candidates[pairs, 3] > 0))
+    pairs = pairs[keep]
+    owners = owners[keep]
+    separations = separations[keep]
+
+    # The closest candidate for each habitable star, then the closest habitable star for each catalogue star
+    order = np.lexsort((separations, owners))
+    first = order[np.unique(owners[order], return_index = True)[1]]
+    first = first[np.argsort(separations[first], kind = "stable")]
+    matches = {}
+    for pair, owner in zip(pairs[first].tolist(), owners[first].tolist()):
+        rowid = int(candidates[pair, 0])
+        if rowid not in matches:
+            matches[rowid] = (hips[owner], "position")
+    return matches
+
+
+def nan_if_none(value):
+# Returns a number as a float, or NaN if it is missing
+    return float("nan") if value == None else float(value)
+
+
+def parse_position(ra, dec):
+# Returns (RA in hours, Dec in degrees) from HABCAT sexagesimal coordinates ("hh mm ss.ss", "+dd mm ss.s"), or None
+    try:
+        hours, minutes, seconds = [float(value) for value in ra.split()]
+        degrees, arcminutes, arcseconds = [float(value) for value in dec.split()]
+    except (AttributeError, ValueError):
+        return None
+    sign = -1 if dec.strip().startswith("-") else 1
+    return hours + minutes / 60 + seconds / 3600, sign * (abs(degrees) + arcminutes / 60 + arcseconds / 3600)
+
+
+def unit_vectors(ra, dec):
+# Returns unit vectors (shape (n, 3)) pointing towards arrays of RA (hours) and Dec (degrees)
+    ra = np.radians(np.asarray(ra) * 15)
+    dec = np.radians(np.asarray(dec))
+    return np.stack([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)], axis = -1)
@@ -1,44 +1,224 @@
+import bz2
 import csv
 import glob
+import gzip
 import json
+import lzma
 import numpy as np
 import pandas as pd
 import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+# Pragmas applied to every pooled connection
+PRAGMAS = {
+    "journal_mode": "WAL",      # readers do not block the writer (persists in the database file)
+    "synchronous": "NORMAL",    # safe with WAL, fewer fsyncs than FULL
+    "mmap_size": 268435456,     # memory-map up to 256 MB of the database file
+    "cache_size": -65536,       # 64 MB page cache per connection
+    "temp_store": "MEMORY"
+    }
+
+# Number of prepared statements each connection keeps cached
+CACHED_STATEMENTS = 256
+
+# Seconds a connection waits for another connection's write to finish before giving up. Table loads hold the write
+# lock while they apply their changes, so notebook edits made during a load wait for it rather than failing.
+BUSY_TIMEOUT = 60
+
+# Rows read from csv files and inserted per transaction by upload_table
+CHUNK_ROWS = 50000
+
+# Csv file extensions accepted by upload_table, including compressed files
+CSV_EXTENSIONS = [".csv", ".csv.gz", ".csv.xz", ".csv.bz2"]
+
+# SQLite column types for the datatypes used in the DTypes.json files
+SQL_TYPES = {"string": "TEXT", "float": "REAL", "int": "INTEGER"}
+
+# Connection pools by database location
+pools = {}
+pools_lock = threading.Lock()
+
+# Optional function called after every query, query_batch and query_array call (see set_query_hook)
+query_hook = None
+
+
+class ConnectionPool:
+# Keeps open SQLite connections to one database for reuse.
+# Each connection is checked out by a single thread at a time and returned to the pool afterwards,
+# so connections (and their cached prepared statements) are reused across requests.
+    def __init__(self, database, max_idle = 8):
+        self.database = database
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        # Optional function called with the text of every statement run on the pool's connections
+        self.trace = None
+
+
+    def open(self):
+    # Opens a new connection with the pool settings
+        connection = sqlite3.connect(self.database, timeout = BUSY_TIMEOUT, check_same_thread = False, cached_statements = CACHED_STATEMENTS)
+        connection.row_factory = sqlite3.Row
+        for key, value in PRAGMAS.items():
+            connection.execute(f"PRAGMA {key} = {value};")
+        return connection
+
+
+    @contextmanager
+    def connection(self):
+    # Checks out a connection for the calling thread, rolling back anything left uncommitted on return
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection == None:
+            connection = self.open()
+        connection.set_trace_callback(self.trace)
+
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(connection)
+                    connection = None
+            if connection != None:
+                connection.close()
+
+
+    def set_trace(self, callback):
+    # Calls callback with each statement run on connections checked out from now on (None to stop)
+        self.trace = callback
+
+
+    def close(self):
+    # Closes all idle connections
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+def get_pool(database):
+# Returns the connection pool for the database, creating it on first use
+    with pools_lock:
+        pool = pools.get(database)
+        if pool == None:
+            pool = ConnectionPool(database)
+            pools[database] = pool
+    return pool
+
+
+def close_pool(database):
+# Closes and forgets the connection pool for the database
+    with pools_lock:
+        pool = pools.pop(database, None)
+    if pool != None:
+        pool.close()
+
+
+def run_statement(cursor, query, arguments):
+# Executes one statement and returns rows for SELECT queries (None if empty) or True otherwise
+    cursor.execute(query, arguments or ())
+    if query.split()[0] == "SELECT":
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        return rows
+    return True
+
+
+def fetch_array(cursor, query, arguments = None):
+# Runs a SELECT query on a cursor and returns the results as a 2D numpy array of floats (NULL becomes nan)
+    # Plain tuples convert to arrays much faster than Row objects
+    cursor.row_factory = None
+    cursor.execute(query, arguments or ())
+    rows = cursor.fetchall()
+    return np.array(rows, dtype = float) if rows else np.empty((0, len(cursor.description)))
+
+
+def set_query_hook(callback):
+# Calls callback(function name, seconds taken, rows returned, failed) after every query function call (None to stop)
+    global query_hook
+    query_hook = callback
+
+
+def report_query(function, start, result):
+# Passes the time taken and number of rows returned by a query function call to the query hook
+    if query_hook == None:
+        return
+    failed = isinstance(result, sqlite3.Error)
+    if isinstance(result, np.ndarray):
+        rows = len(result)
+    elif isinstance(result, list):
+        rows = sum(len(item) for item in result if isinstance(item, list)) if function == "query_batch" else len(result)
+    else:
+        rows = 0
+    query_hook(function, time.perf_counter() - start, rows, failed)
 
 
 def query(database, query, arguments = None):
 # Runs a query on the SQLite database link provided
-    # Get query type
-    query_type = query.split()[0]
-    
+    start = time.perf_counter()
     try:
-        with sqlite3.connect(database) as connection:
-            # Create row factory and cursor
-            connection.row_factory = sqlite3.Row
-            cursor = connection.cursor()
+        with get_pool(database).connection() as connection:
+            # Execute query and get results (SELECT) or confirmation (all other query types)
+            result = run_statement(connection.cursor(), query, arguments)
 
-            # Execute query
-            cursor.execute(query, arguments)
-
-            # If SELECT query, return results
-            if query_type == "SELECT":
-                rows = cursor.fetchall()
-                if not rows:
-                    return None
-                return rows
-            
-            else: # For all other query types
-                # Commit changes to database and return boolean confirmation
+            # Commit changes to database
+            if result == True:
                 connection.commit()
-                return True
             
     except sqlite3.Error as err:
             # Return the error value to mark function failed
-            return err
+            result = err
+
+    report_query("query", start, result)
+    return result
+
+
+def query_batch(database, statements):
+# Runs a list of (query, arguments) statements on one connection in a single transaction.
+# Returns a list with one result per statement, with the same values as query(). If any
+# statement fails, the whole batch is rolled back and the error is returned instead.
+    start = time.perf_counter()
+    try:
+        with get_pool(database).connection() as connection:
+            cursor = connection.cursor()
+            results = [run_statement(cursor, query, arguments) for query, arguments in statements]
+            connection.commit()
 
+    except sqlite3.Error as err:
+            # Return the error value to mark function failed
+            results = err
+
+    report_query("query_batch", start, results)
+    return results
+
+
+def query_array(database, query, arguments = None):
+# Runs a SELECT query and returns the results as a 2D numpy array of floats (NULL becomes nan)
+    start = time.perf_counter()
+    try:
+        with get_pool(database).connection() as connection:
+            result = fetch_array(connection.cursor(), query, arguments)
 
-def upload_table(database, file_path, table_name):
-# Uploads csv files from specified filepath to database as a table
+    except sqlite3.Error as err:
+            # Return the error value to mark function failed
+            result = err
+
+    report_query("query_array", start, result)
+    return result
+
+
+def upload_table(database, file_path, table_name, cancelled = None):
+# Uploads csv files from specified filepath to database as a table.
+# Files are streamed in chunks of CHUNK_ROWS rows, so memory use does not grow with the file size.
+# Plain .csv files and compressed .csv.gz, .csv.xz and .csv.bz2 files are accepted.
+# If cancelled is given, it is called before each chunk and the upload stops (leaving a partial table) if it is true.
     # Get datatypes from json file
     json_list = glob.glob(file_path + "/**.json", recursive = True)
     if len(json_list) == 1:
@@ -50,28 +230,217 @@ def upload_table(database, file_path, table_name):
     col_headers = list(data_types.keys())
 
     # Get CSV file list
-    csv_list = glob.glob(file_path + "/**.csv", recursive = True)
-
-    # Extract data from csv file
-    if len(csv_list) > 0:
-        data_frames = []
-        for file in csv_list:
-            with open(file, newline = '') as csvfile:
-                # Check for headers and read to dataframe
-                if csv.Sniffer().has_header(csvfile.readline()):
-                    data_frames.append(pd.read_csv(f"{file}", names = col_headers, header = 0, dtype = data_types))
-                else:
-                    data_frames.append(pd.read_csv(f"{file}", names = col_headers, dtype = data_types))
-        table_data = pd.DataFrame(np.concatenate(data_frames), columns = col_headers)
-    else:
+    csv_list = []
+    for extension in CSV_EXTENSIONS:
+        csv_list.extend(glob.glob(file_path + f"/**{extension}", recursive = True))
+    if len(csv_list) == 0:
         return ".csv files not found."
 
-    # Set connection to SQLite database
-    with sqlite3.connect(database) as connection:
+    # Table definition, keeping the "index" row number column previously written by pandas
+    columns = ", ".join(['"index" INTEGER'] + [f'"{key}" {SQL_TYPES.get(value, "TEXT")}' for key, value in data_types.items()])
+    placeholders = ", ".join("?" * (len(col_headers) + 1))
+    insert = f'INSERT INTO "{table_name}" VALUES ({placeholders});'
+
+    # Get connection to SQLite database
+    with get_pool(database).connection() as connection:
         try:
-            # Write to table using Pandas
-            table_data.to_sql(table_name, connection)
-        except ValueError:
-            return f"{table_name} table already exists in stars.db."
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (table_name,)).fetchone():
+                return f"{table_name} table already exists in stars.db."
+            connection.execute(f'CREATE TABLE "{table_name}" ({columns});')
+
+            # Skip fsyncs while bulk loading; a failed load is dropped and reloaded anyway
+            connection.execute("PRAGMA synchronous = OFF;")
+
+            row_number = 0
+            for file in csv_list:
+                # Check for headers
+                with open_csv(file) as csvfile:
+                    header = 0 if csv.Sniffer().has_header(csvfile.readline()) else None
+
+                # Read and insert one chunk at a time, one transaction per chunk
+                chunks = pd.read_csv(file, names = col_headers, header = header, dtype = data_types, chunksize = CHUNK_ROWS, compression = "infer")
+                for chunk in chunks:
+                    if cancelled != None and cancelled():
+                        return f"Upload of {table_name} table cancelled."
+                    chunk = chunk.astype(object).where(chunk.notna(), None)
+                    chunk.insert(0, "index", range(row_number, row_number + len(chunk)))
+                    row_number += len(chunk)
+                    with connection:
+                        connection.executemany(insert, chunk.itertuples(index = False, name = None))
+
+        except (sqlite3.Error, ValueError) as err:
+            return err
+
+        finally:
+            connection.execute(f"PRAGMA synchronous = {PRAGMAS['synchronous']};")
     
     return True
+
+
+def refresh_table(database, file_path, table_name, key, keep_columns = None, cancelled = None, prepare = None):
+# Refreshes a table from the csv files in file_path without dropping it. The files are loaded into a staging
+# table and compared with the live table by the key column, then the deletes, updates and inserts are applied
+# in a single transaction, so readers see either the old rows or the new ones and never a missing table.
+# Indexes on the table are updated with the rows. If the table does not exist yet or its columns have changed, the
+# staging table replaces it in a single transaction instead (phase "replace"), and its indexes need to be created
+# again. keep_columns is a dictionary of {name: column definition} for columns of the live table that are not in the
+# files (e.g. added by a later step): they are left unchanged on updated rows and take their default values on new
+# rows, and a replacement table gets them too, with the values of the rows with the same key.
+# If cancelled is given, it is checked while the staging table is loaded and before the live table is changed, and
+# the refresh stops without changing the live table if it is true.
+# If prepare is given, prepare(connection, replaced) is called in the transaction once the changes are made, to build
+# anything derived from the table before it is committed. Unless the table was replaced, the temp tables
+# refresh_old and refresh_new hold the deleted and updated rows as they were and the updated and inserted rows as
+# they are now, with their rowids as "row". It returns a function that is called as soon as the transaction has
+# committed (e.g. to swap in the new structures), or an error value to roll the refresh back.
+# Returns a report of {phase: {"rows": row count, "seconds": seconds taken}} or the error value.
+    staging = f"{table_name}_staging"
+    keep_columns = keep_columns or {}
+    report = {}
+
+    # Load the new files into the staging table
+    start = time.perf_counter()
+    result = query(database, f'DROP TABLE IF EXISTS "{staging}";', ())
+    if result == True:
+        result = upload_table(database, file_path, staging, cancelled)
+    if result != True:
+        query(database, f'DROP TABLE IF EXISTS "{staging}";', ())
+        return result
+    result = query_batch(database, [
+        (f'CREATE UNIQUE INDEX "idx_{staging}_{key}" ON "{staging}" ("{key}");', ()),
+        (f'SELECT count(*) FROM "{staging}";', ())
+        ])
+    if not isinstance(result, list):
+        query(database, f'DROP TABLE IF EXISTS "{staging}";', ())
+        return f"Could not index {key} in the new {table_name} data (is {key} unique?): {result}"
+    report["stage"] = {"rows": result[1][0][0], "seconds": time.perf_counter() - start}
+
+    # Last chance to stop: the live table is changed in one transaction from here
+    if cancelled != None and cancelled():
+        query(database, f'DROP TABLE IF EXISTS "{staging}";', ())
+        return f"Refresh of {table_name} table cancelled."
+
+    try:
+        with get_pool(database).connection() as connection:
+            table_columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{table_name}");')]
+            live_columns = [column for column in table_columns if column not in keep_columns]
+            staging_columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{staging}");')]
+
+            # Hold the write lock from the first change to the commit
+            connection.execute("BEGIN IMMEDIATE;")
+            replaced = live_columns != staging_columns
+
+            if replaced:
+                # Swap in the staging table when there is nothing to compare it with, keeping the values of the
+                # kept columns for rows that are in both
+                start = time.perf_counter()
+                for name, definition in keep_columns.items():
+                    connection.execute(f'ALTER TABLE "{staging}" ADD COLUMN "{name}" {definition};')
+                kept = [name for name in keep_columns if name in table_columns]
+                if kept:
+                    assignments = ", ".join(f'"{name}" = l."{name}"' for name in kept)
+                    connection.execute(f'UPDATE "{staging}" SET {assignments} FROM "{table_name}" l WHERE l."{key}" = "{staging}"."{key}";')
+                connection.execute(f'DROP TABLE IF EXISTS "{table_name}";')
+                connection.execute(f'ALTER TABLE "{staging}" RENAME TO "{table_name}";')
+                connection.execute(f'DROP INDEX IF EXISTS "idx_{staging}_{key}";')
+                report["replace"] = {"rows": report["stage"]["rows"], "seconds": time.perf_counter() - start}
+                changed_rows = report["stage"]["rows"]
+
+            else:
+                # Live rows missing from the new data, and live rows whose values have changed
+                start = time.perf_counter()
+                compared = [column for column in live_columns if column not in ["index", key]]
+                changed = " OR ".join(f's."{column}" IS NOT l."{column}"' for column in compared)
+                for name in ["refresh_deleted", "refresh_updated", "refresh_old", "refresh_new"]:
+                    connection.execute(f"DROP TABLE IF EXISTS temp.{name};")
+                connection.execute(f'CREATE TEMP TABLE refresh_deleted AS SELECT l.rowid AS row FROM "{table_name}" l '
+                                   f'WHERE NOT EXISTS (SELECT 1 FROM "{staging}" s WHERE s."{key}" = l."{key}");')
+                connection.execute(f'CREATE TEMP TABLE refresh_updated AS SELECT l.rowid AS row FROM "{table_name}" l '
+                                   f'JOIN "{staging}" s ON s."{key}" = l."{key}" WHERE {changed or "0"};')
+                if prepare != None:
+                    connection.execute(f'CREATE TEMP TABLE refresh_old AS SELECT rowid AS row, * FROM "{table_name}" '
+                                       f'WHERE rowid IN (SELECT row FROM temp.refresh_deleted UNION ALL SELECT row FROM temp.refresh_updated);')
+                report["compare"] = {"rows": report["stage"]["rows"], "seconds": time.perf_counter() - start}
+
+                start = time.perf_counter()
+                cursor = connection.execute(f'DELETE FROM "{table_name}" WHERE rowid IN (SELECT row FROM temp.refresh_deleted);')
+                report["delete"] = {"rows": cursor.rowcount, "seconds": time.perf_counter() - start}
+                last_rowid = connection.execute(f'SELECT coalesce(max(rowid), 0) FROM "{table_name}";').fetchone()[0]
+
+                start = time.perf_counter()
+                assignments = ", ".join(f'"{column}" = s."{column}"' for column in live_columns if column != key)
+                cursor = connection.execute(f'UPDATE "{table_name}" SET {assignments} FROM "{staging}" s '
+                                            f'WHERE s."{key}" = "{table_name}"."{key}" AND "{table_name}".rowid IN (SELECT row FROM temp.refresh_updated);')
+                report["update"] = {"rows": cursor.rowcount, "seconds": time.perf_counter() - start}
+
+                start = time.perf_counter()
+                column_list = ", ".join(f'"{column}"' for column in live_columns)
+                cursor = connection.execute(f'INSERT INTO "{table_name}" ({column_list}) SELECT {column_list} FROM "{staging}" s '
+                                            f'WHERE NOT EXISTS (SELECT 1 FROM "{table_name}" l WHERE l."{key}" = s."{key}") ORDER BY s.rowid;')
+                report["insert"] = {"rows": cursor.rowcount, "seconds": time.perf_counter() - start}
+                changed_rows = report["delete"]["rows"] + report["update"]["rows"] + report["insert"]["rows"]
+
+                # New rows are given rowids after the largest one left by the delete
+                if prepare != None:
+                    connection.execute(f'CREATE TEMP TABLE refresh_new AS SELECT rowid AS row, * FROM "{table_name}" '
+                                       f'WHERE rowid > ? OR rowid IN (SELECT row FROM temp.refresh_updated);', (last_rowid,))
+
+            # Build whatever depends on the table from the changes before they are committed
+            if prepare != None:
+                start = time.perf_counter()
+                finish = prepare(connection, replaced)
+                if not callable(finish):
+                    connection.rollback()
+                    query(database, f'DROP TABLE IF EXISTS "{staging}";', ())
+                    return finish
+                report["prepare"] = {"rows": changed_rows, "seconds": time.perf_counter() - start}
+
+            start = time.perf_counter()
+            connection.commit()
+            if prepare != None:
+                finish()
+            report["commit"] = {"rows": changed_rows, "seconds": time.perf_counter() - start}
+
+            for name in ["refresh_deleted", "refresh_updated", "refresh_old", "refresh_new"]:
+                connection.execute(f"DROP TABLE IF EXISTS temp.{name};")
+            connection.execute(f'DROP TABLE IF EXISTS "{staging}";')
+            connection.commit()
+
+    except sqlite3.Error as err:
+            # Return the error value to mark function failed (the live table is unchanged)
+            query(database, f'DROP TABLE IF EXISTS "{staging}";', ())
+            return err
+
+    return report
+
+
+def open_csv(file):
+# Opens a csv file as text, decompressing it if needed
+    if file.endswith(".gz"):
+        return gzip.open(file, "rt", newline = '')
+    elif file.endswith(".xz"):
+        return lzma.open(file, "rt", newline = '')
+    elif file.endswith(".bz2"):
+        return bz2.open(file, "rt", newline = '')
+    return open(file, newline = '')
+
+
+def create_indexes(database, table_name, indexes):
+# Creates indexes on a table, normally after a bulk insert. indexes is a list of column tuples.
+# Returns a dictionary of {index name: seconds taken to build} or the error value if a build failed.
+    timings = {}
+    for columns in indexes:
+        index_name = f"idx_{table_name}_{'_'.join(columns)}"
+        column_list = ", ".join(f'"{column}"' for column in columns)
+
+        start = time.perf_counter()
+        result = query(database, f'CREATE INDEX IF NOT EXISTS "{index_name}" ON "{table_name}" ({column_list});', ())
+        if result != True:
+            return result
+        timings[index_name] = time.perf_counter() - start
+
+    # Update the query planner statistics for the new indexes
+    result = query(database, f'ANALYZE "{table_name}";', ())
+    if result != True:
+        return result
+    return timings
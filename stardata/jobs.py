@@ -0,0 +1,170 @@
+import itertools
+import threading
+import time
+import traceback
+
+from collections import OrderedDict, deque
+from metrics import span
+
+# Long-running work (table loads, index builds and batch computations) runs on a background thread instead of inside
+# the request that asked for it, so pages and API requests keep being answered while it runs. Jobs run one at a time
+# in the order they were submitted, as they all write to the same database.
+
+# Finished jobs kept for status requests (the oldest are forgotten first)
+KEEP_FINISHED = 50
+
+# States of a job, in the order they happen
+JOB_STATES = ["queued", "running", "finished", "failed", "cancelled"]
+
+
+class Job:
+# One piece of background work. function(job, *args) returns a dictionary when it succeeds and anything else (a
+# message or error value) when it fails. It calls job.update to report progress and checks job.cancelled() between
+# steps, returning early if it is true.
+    def __init__(self, job_id, kind, description, key, function, args):
+        self.id = job_id
+        self.kind = kind
+        self.description = description
+        self.key = key
+        self.function = function
+        self.args = args
+        self.state = "queued"
+        self.message = "Waiting for earlier jobs to finish."
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+
+    def cancelled(self):
+    # Returns True once cancellation has been requested
+        return self.cancel_event.is_set()
+
+
+    def update(self, message, progress = None):
+    # Records what the job is doing now, and optionally how far through it is (0 to 1)
+        self.message = message
+        self.progress = progress
+
+
+    def status(self):
+    # Returns the state of the job as a dictionary that can be sent as JSON
+        now = self.finished if self.finished != None else time.time()
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "description": self.description,
+            "state": self.state,
+            "message": self.message,
+            "progress": self.progress,
+            "cancel_requested": self.cancelled(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.created)),
+            "seconds": now - self.started if self.started != None else 0.0,
+            "result": self.result,
+            "error": self.error
+            }
+
+
+class JobQueue:
+# Thread-safe queue of jobs run in order by one background thread, started when the first job is submitted
+    def __init__(self, keep = KEEP_FINISHED):
+        self.keep = keep
+        self.jobs = OrderedDict()
+        self.waiting = deque()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.thread = None
+
+
+    def submit(self, kind, description, function, *args, key = None):
+    # Adds a job to the queue and returns it. If a queued or running job has the same key (e.g. a load of the same
+    # table), that job is returned instead of adding another.
+        with self.lock:
+            if key != None:
+                for job in self.jobs.values():
+                    if job.key == key and job.state in ["queued", "running"] and not job.cancelled():
+                        return job
+            job = Job(next(self.ids), kind, description, key, function, args)
+            self.jobs[job.id] = job
+            self.waiting.append(job)
+            if self.thread == None:
+                self.thread = threading.Thread(target = self.run, name = "stardata-jobs", daemon = True)
+                self.thread.start()
+            self.ready.notify()
+            return job
+
+
+    def get(self, job_id):
+    # Returns the job with the given id, or None if there is no such job (or it has been forgotten)
+        with self.lock:
+            return self.jobs.get(job_id)
+
+
+    def list(self):
+    # Returns every job still kept, newest first
+        with self.lock:
+            return list(reversed(self.jobs.values()))
+
+
+    def cancel(self, job_id):
+    # Asks a job to stop and returns it, or None if there is no such job. A queued job is cancelled at once; a
+    # running job stops at its next check, and finishes as normal if it is past the point where it can stop.
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job == None or job.state not in ["queued", "running"]:
+                return job
+            job.cancel_event.set()
+            if job.state == "queued":
+                self.waiting.remove(job)
+                self.finish(job, "cancelled", "Cancelled before it started.")
+            else:
+                job.message = "Stopping at the next step."
+            return job
+
+
+    def finish(self, job, state, message):
+    # Marks a job as done and forgets the oldest finished jobs beyond the number kept (call with the lock held)
+        job.state = state
+        job.message = message
+        job.finished = time.time()
+        finished = [key for key, value in self.jobs.items() if value.state not in ["queued", "running"]]
+        for key in finished[:max(len(finished) - self.keep, 0)]:
+            del self.jobs[key]
+
+
+    def run(self):
+    # Runs queued jobs one at a time, for as long as the application runs
+        while True:
+            with self.lock:
+                while not self.waiting:
+                    self.ready.wait()
+                job = self.waiting.popleft()
+                job.state = "running"
+                job.message = "Starting."
+                job.started = time.time()
+
+            # Database queries made by the job are labelled with its kind in the metrics
+            try:
+                with span(f"job {job.kind}"):
+                    result = job.function(job, *job.args)
+            except Exception as err:
+                traceback.print_exc()
+                result = f"{type(err).__name__}: {err}"
+
+            with self.lock:
+                if isinstance(result, dict):
+                    job.result = result
+                    self.finish(job, "finished", result.get("message", "Finished."))
+                elif job.cancelled():
+                    self.finish(job, "cancelled", str(result))
+                else:
+                    job.error = str(result)
+                    self.finish(job, "failed", job.error)
+
+
+# Background jobs for the application
+job_queue = JobQueue()
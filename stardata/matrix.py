@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+import numpy as np
+
+from starcalcs import calculate_distances
+
+# Memory allowed for the temporary arrays used to calculate one block of rows of a distance matrix
+BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def block_rows(count):
+# Returns the number of matrix rows to calculate at once so that one block fits in BLOCK_BYTES
+    return max(1, min(count, BLOCK_BYTES // max(1, count * 3 * 8)))
+
+
+def distance_blocks(positions):
+# Yields (first row, block of rows) of the distance matrix between all positions, one block at a time,
+# so the full matrix never has to be held in memory
+    rows = block_rows(len(positions))
+    for start in range(0, len(positions), rows):
+        yield start, calculate_distances(positions[start:start + rows], positions)
+
+
+def distance_matrix(positions):
+# Returns the full distance matrix (pc) between all positions as a float64 array
+    matrix = np.empty((len(positions), len(positions)))
+    for start, block in distance_blocks(positions):
+        matrix[start:start + len(block)] = block
+    return matrix
+
+
+def format_rows(block, delimiter):
+# Formats each row of a block as text with six decimal places (about 0.2 AU), using NumPy's C formatting
+    buffer = io.StringIO()
+    np.savetxt(buffer, block, fmt = "%.6f", delimiter = delimiter)
+    return buffer.getvalue().splitlines()
+
+
+def matrix_csv(refs, positions):
+# Yields the distance matrix as csv text, one block of rows at a time, with star references as row and column labels
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator = "\n")
+    writer.writerow(["star"] + refs)
+    yield buffer.getvalue()
+
+    for start, block in distance_blocks(positions):
+        lines = []
+        for i, row in enumerate(format_rows(block, ",")):
+            # Quote the star reference if needed, then add the distances
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow([refs[start + i]])
+            lines.append(buffer.getvalue().rstrip("\n") + "," + row + "\n")
+        yield "".join(lines)
+
+
+def matrix_json(refs, ids, epoch, positions):
+# Yields the distance matrix as a JSON object, one block of rows at a time
+    yield '{"epoch": ' + json.dumps(epoch) + ', "stars": ' + json.dumps(refs) + ', "ids": ' + json.dumps(ids) + ', "distances": ['
+    separator = ""
+    for start, block in distance_blocks(positions):
+        yield separator + ", ".join("[" + row + "]" for row in format_rows(block, ", "))
+        separator = ", "
+    yield "]}"
+
+
+def matrix_npy(positions):
+# Yields the distance matrix in NumPy .npy format, one block of rows at a time
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {"descr": "<f8", "fortran_order": False, "shape": (len(positions), len(positions))})
+    yield header.getvalue()
+    for start, block in distance_blocks(positions):
+        yield block.astype("<f8").tobytes()
@@ -0,0 +1,214 @@
+import cProfile
+import io
+import os
+import pstats
+import tempfile
+import threading
+import time
+
+from cache import cache_stats
+from contextlib import contextmanager
+from database import set_query_hook
+from flask import g, request
+
+# Upper bounds (seconds) of the histogram buckets for request, span and query durations
+BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Set the environment variable STARDATA_PROFILE=1 to profile every request, or add ?profile=1 (or ?profile=text)
+# to a single request. Profiles are saved as .prof files in STARDATA_PROFILE_DIR.
+PROFILE_ALL = os.environ.get("STARDATA_PROFILE", "0") == "1"
+PROFILE_FOLDER = os.environ.get("STARDATA_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "stardata-profiles"))
+
+# Number of functions listed in text profiles
+PROFILE_LINES = 40
+
+# Metric name: (type, help text, label names)
+METRICS = {
+    "stardata_requests_total": ("counter", "Requests handled, by endpoint, method and status code.", ("endpoint", "method", "status")),
+    "stardata_request_seconds": ("histogram", "Time taken to handle requests (streamed responses only up to the first byte).", ("endpoint",)),
+    "stardata_span_seconds": ("histogram", "Time taken by each instrumented stage of a request.", ("span",)),
+    "stardata_db_queries_total": ("counter", "Calls to the database query functions, by function and the stage that made them.", ("function", "span")),
+    "stardata_db_query_seconds": ("histogram", "Time taken by database query function calls.", ("function", "span")),
+    "stardata_db_rows_total": ("counter", "Rows returned by database query function calls.", ("function", "span")),
+    "stardata_db_errors_total": ("counter", "Database query function calls that returned an error.", ("function", "span"))
+    }
+
+# Counters kept by the result caches, reported as (metric name, cache_stats key, type, help text)
+CACHE_METRICS = [
+    ("stardata_cache_hits_total", "hits", "counter", "Result cache lookups that found an entry."),
+    ("stardata_cache_misses_total", "misses", "counter", "Result cache lookups that found no entry."),
+    ("stardata_cache_evictions_total", "evictions", "counter", "Entries dropped from a full result cache."),
+    ("stardata_cache_invalidations_total", "invalidations", "counter", "Entries removed after the data they depend on changed."),
+    ("stardata_cache_entries", "size", "gauge", "Entries currently held in a result cache.")
+    ]
+
+
+class MetricsRegistry:
+# Thread-safe store of counters and histograms, keyed by metric name and label values
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.values = {name: {} for name in metrics}
+        self.lock = threading.Lock()
+
+
+    def increment(self, name, labels, amount = 1):
+    # Adds amount to a counter
+        with self.lock:
+            values = self.values[name]
+            values[labels] = values.get(labels, 0) + amount
+
+
+    def observe(self, name, labels, value):
+    # Adds one observation to a histogram
+        with self.lock:
+            values = self.values[name]
+            histogram = values.get(labels)
+            if histogram == None:
+                # Count per bucket (made cumulative when rendered), sum and count
+                histogram = values[labels] = [[0] * len(BUCKETS), 0.0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+
+    def render(self):
+    # Returns all metrics in the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            for name, (kind, description, label_names) in self.metrics.items():
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in sorted(self.values[name].items()):
+                    label_text = format_labels(label_names, labels)
+                    if kind != "histogram":
+                        lines.append(f"{name}{{{label_text}}} {value}")
+                        continue
+                    total = 0
+                    for bound, count in zip(BUCKETS, value[0]):
+                        total += count
+                        lines.append(f'{name}_bucket{{{label_text},le="{bound}"}} {total}')
+                    lines.append(f'{name}_bucket{{{label_text},le="+Inf"}} {value[2]}')
+                    lines.append(f"{name}_sum{{{label_text}}} {value[1]}")
+                    lines.append(f"{name}_count{{{label_text}}} {value[2]}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry(METRICS)
+
+# Stages currently running on each thread, innermost last, and the spans recorded for the current request
+current = threading.local()
+
+
+def format_labels(names, values):
+# Returns Prometheus label text such as endpoint="stardata",method="POST"
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return ",".join(pairs)
+
+
+def current_span():
+# Returns the name of the innermost stage running on this thread, or "none"
+    stack = getattr(current, "stack", None)
+    return stack[-1] if stack else "none"
+
+
+@contextmanager
+def span(name):
+# Times a stage of a request. Database queries made inside the stage are labelled with its name.
+    stack = getattr(current, "stack", None)
+    if stack == None:
+        stack = current.stack = []
+    stack.append(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        stack.pop()
+        registry.observe("stardata_span_seconds", (name,), seconds)
+        timings = getattr(current, "timings", None)
+        if timings != None:
+            timings.append((name, seconds))
+
+
+def record_query(function, seconds, rows, failed):
+# Query hook for database.py: counts each query function call against the stage that made it
+    labels = (function, current_span())
+    registry.increment("stardata_db_queries_total", labels)
+    registry.observe("stardata_db_query_seconds", labels, seconds)
+    registry.increment("stardata_db_rows_total", labels, rows)
+    if failed:
+        registry.increment("stardata_db_errors_total", labels)
+
+
+def render_metrics():
+# Returns the request, stage, query and result cache metrics in the Prometheus text exposition format
+    lines = [registry.render().rstrip("\n")]
+    stats = cache_stats()
+    for name, key, kind, description in CACHE_METRICS:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for cache_name, values in sorted(stats.items()):
+            lines.append(f'{name}{{cache="{cache_name}"}} {values[key]}')
+    return "\n".join(lines) + "\n"
+
+
+def start_request():
+# Starts timing (and profiling, if requested) the current request
+    g.metrics_start = time.perf_counter()
+    current.stack = []
+    current.timings = []
+    g.profiler = None
+    mode = request.args.get("profile")
+    if PROFILE_ALL or mode in ["1", "text"]:
+        try:
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+        except ValueError:
+            # Another profiler is already running on this thread
+            g.profiler = None
+
+
+def finish_request(response):
+# Records the request metrics, adds a Server-Timing header listing the stages and saves or returns the profile
+    start = g.get("metrics_start")
+    if start == None:
+        return response
+    seconds = time.perf_counter() - start
+    endpoint = request.endpoint or "unknown"
+    registry.increment("stardata_requests_total", (endpoint, request.method, response.status_code))
+    registry.observe("stardata_request_seconds", (endpoint,), seconds)
+
+    timings = getattr(current, "timings", None) or []
+    current.timings = None
+    if timings:
+        response.headers["Server-Timing"] = ", ".join(f"{name};dur={value * 1000:.2f}" for name, value in timings)
+
+    profiler = g.get("profiler")
+    if profiler != None:
+        profiler.disable()
+        g.profiler = None
+        if request.args.get("profile") == "text":
+            # Return the busiest functions as text instead of the page
+            buffer = io.StringIO()
+            pstats.Stats(profiler, stream = buffer).sort_stats("cumulative").print_stats(PROFILE_LINES)
+            response.set_data(buffer.getvalue())
+            response.mimetype = "text/plain"
+        else:
+            os.makedirs(PROFILE_FOLDER, exist_ok = True)
+            path = os.path.join(PROFILE_FOLDER, f"{endpoint}-{time.time_ns()}.prof")
+            profiler.dump_stats(path)
+            response.headers["X-Profile"] = path
+    return response
+
+
+def instrument(app):
+# Adds request timing, query counting and optional profiling to a Flask app
+    set_query_hook(record_query)
+    app.before_request(start_request)
+    app.after_request(finish_request)
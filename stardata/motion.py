@@ -0,0 +1,102 @@
+import numpy as np
+
+from spatial import get_index
+from starcalcs import KMS_TO_PCYR, lookup_refs, star_position
+
+# Stars move in straight lines at their catalogue velocities, the same model used by propagate_positions, so the
+# distance between two stars over time is the square root of a quadratic in the year with one minimum.
+
+# Most years in one distance curve, and most distances (stars x years) calculated for one request
+MAX_YEARS = 100001
+MAX_CELLS = 10000000
+
+# Stars checked at once by find_passes, to bound the size of the temporary arrays
+PASS_BLOCK = 500000
+
+
+def relative_motion(origin, targets):
+# Returns the J2000.0 offsets (pc) of targets from origin and their relative velocities (pc per year).
+# origin is a (position, velocity) pair and targets a (positions, velocities) pair, with velocities in km/s.
+    offsets = np.asarray(targets[0], dtype = float) - np.asarray(origin[0], dtype = float)
+    drifts = (np.nan_to_num(np.asarray(targets[1], dtype = float)) - np.nan_to_num(np.asarray(origin[1], dtype = float))) * KMS_TO_PCYR
+    return np.atleast_2d(offsets), np.atleast_2d(drifts)
+
+
+def closest_approach(origin, targets, start = None, end = None):
+# Returns the years and distances (pc) of closest approach between origin and each target, as two arrays.
+# With start and/or end, the closest approach within those years is returned instead.
+    offsets, drifts = relative_motion(origin, targets)
+
+    # The distance is smallest where the offset is at right angles to the relative velocity
+    speed2 = (drifts**2).sum(axis = 1)
+    moving = speed2 > 0
+    times = np.zeros(len(offsets))
+    times[moving] = -(offsets[moving] * drifts[moving]).sum(axis = 1) / speed2[moving]
+
+    # The distance only grows away from the minimum, so the closest year within a range is the nearest end
+    if start != None or end != None:
+        times = np.clip(times, -np.inf if start == None else start - 2000, np.inf if end == None else end - 2000)
+    distances = np.sqrt(((offsets + drifts * times[:, np.newaxis])**2).sum(axis = 1))
+    return times + 2000, distances
+
+
+def distance_curves(origin, targets, years):
+# Returns the distances (pc) between origin and each target in each year, as an array of shape (targets, years).
+    offsets, drifts = relative_motion(origin, targets)
+    times = np.asarray(years, dtype = float) - 2000
+
+    # |offset + drift * t|^2 = c + b t + a t^2, so only one (targets, years) array is needed
+    a = (drifts**2).sum(axis = 1)[:, np.newaxis]
+    b = 2 * (offsets * drifts).sum(axis = 1)[:, np.newaxis]
+    c = (offsets**2).sum(axis = 1)[:, np.newaxis]
+    return np.sqrt(np.maximum(c + times * (b + times * a), 0))
+
+
+def find_passes(star, within, start, end, db):
+# Returns the stars that come within the given distance (pc) of a Star object between two years, in one pass over
+# every star in the spatial index. The list holds (reference, year, distance, AT-HYG ID) tuples for each star's
+# closest approach in those years, sorted by distance.
+    index = get_index(db)
+    origin = star_motion(star)
+
+    positions = []
+    years = []
+    distances = []
+    for first in range(0, len(index.rowids), PASS_BLOCK):
+        block = slice(first, first + PASS_BLOCK)
+        block_years, block_distances = closest_approach(origin, (index.points[block], index.velocities[block]), start, end)
+        close = np.flatnonzero(block_distances <= within)
+        positions.append(close + first)
+        years.append(block_years[close])
+        distances.append(block_distances[close])
+
+    if not positions:
+        return []
+    positions = np.concatenate(positions)
+    years = np.concatenate(years)
+    distances = np.concatenate(distances)
+
+    # Sort by distance, with ties kept in catalogue order
+    order = np.lexsort((index.rowids[positions], distances))
+    refs, ids = lookup_refs(db, index.rowids[positions[order]])
+    passes = []
+    for ref, year, distance, star_id in zip(refs, years[order].tolist(), distances[order].tolist(), ids):
+        # Eliminate the origin star itself from the results
+        if star_id != star.ids["id"]:
+            passes.append((ref, year, distance, star_id))
+    return passes
+
+
+def star_motion(star):
+# Returns the J2000.0 position (pc) and velocity (km/s) of a Star object, as used by closest_approach
+    return star_position(star, 2000), np.nan_to_num(np.array([star.xyz[key] for key in ["vx", "vy", "vz"]], dtype = float))
+
+
+def year_range(start, end, step):
+# Returns the years from start to end (inclusive where it falls on a step) at the given interval, or raises ValueError
+    if not step > 0 or not end >= start:
+        raise ValueError("The end year must not be before the start year, and the step must be positive.")
+    count = int(np.floor((end - start) / step + 1e-9)) + 1
+    if count > MAX_YEARS:
+        raise ValueError(f"At most {MAX_YEARS} years can be calculated at once.")
+    return start + step * np.arange(count)
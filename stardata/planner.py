@@ -0,0 +1,150 @@
+import heapq
+import numpy as np
+import threading
+
+from database import query
+from spatial import SpatialIndex, get_index
+from starcalcs import lookup_refs, propagate_positions
+
+# Route graphs by (database location, epoch, habitable only), rebuilt when the catalogue index changes
+graphs = {}
+graphs_lock = threading.Lock()
+
+# Number of graphs kept for reuse (e.g. a few different epochs)
+MAX_GRAPHS = 4
+
+# Most stars expanded by one search before giving up, so unreachable destinations fail quickly
+MAX_EXPANSIONS = 200000
+
+
+def get_graph(db, epoch, habitable_only):
+# Returns a spatial index of the stars that can be used as stops, at their positions in the provided year.
+# Neighbours of each star are found from this index as the search reaches it.
+    base = get_index(db)
+
+    # Every star at its J2000.0 position is the catalogue index itself, so it is used without a copy
+    if epoch == 2000 and not habitable_only:
+        return base
+
+    key = (db, epoch, habitable_only)
+    with graphs_lock:
+        graph = graphs.get(key)
+    if graph != None and graph[0] is base:
+        return graph[1]
+
+    # Only keep habitable stars (and Sol) if requested
+    keep = np.ones(len(base.rowids), dtype = bool)
+    if habitable_only:
+        keep[:] = False
+        rows = query(db, "SELECT rowid FROM catalogue WHERE habitable = 1;", ())
+        if rows != None:
+            if not isinstance(rows, list):
+                raise rows
+            for row in rows:
+                position = base.position_of(row[0])
+                if position != None:
+                    keep[position] = True
+
+    # Move the stars to the provided year
+    points = propagate_positions(base.points[keep], base.velocities[keep], epoch)
+    index = SpatialIndex(base.rowids[keep], points, base.velocities[keep])
+
+    with graphs_lock:
+        graphs[key] = (base, index)
+        while len(graphs) > MAX_GRAPHS:
+            del graphs[next(iter(graphs))]
+    return index
+
+
+def plan_route(origin, destination, max_jump, db, epoch = 2000, habitable_only = False):
+# Returns the shortest route between two Star objects where no single jump is longer than max_jump parsecs,
+# using A* search with the straight-line distance to the destination as the heuristic.
+# The route is a list of (reference, jump distance, total distance, AT-HYG ID) tuples starting at the origin,
+# None if there is no route, or a message if the search gave up before finding one (see find_path).
+    graph = get_graph(db, epoch, habitable_only)
+
+    # Find the origin and destination in the graph, adding them if they are not habitable stops
+    ends = [origin.rowid, destination.rowid]
+    if any(graph.position_of(rowid) == None for rowid in ends):
+        graph = add_stops(graph, db, ends, epoch)
+    start = graph.position_of(ends[0])
+    goal = graph.position_of(ends[1])
+
+    stops = find_path(graph, start, goal, max_jump)
+    if not isinstance(stops, list):
+        return stops
+
+    # Assemble list to return
+    refs, ids = lookup_refs(db, graph.rowids[stops])
+    jumps = np.sqrt((np.diff(graph.points[stops], axis = 0)**2).sum(axis = 1))
+    totals = np.concatenate([[0.0], np.cumsum(jumps)])
+    jumps = np.concatenate([[0.0], jumps])
+    return list(zip(refs, jumps.tolist(), totals.tolist(), ids))
+
+
+def add_stops(graph, db, rowids, epoch):
+# Returns a copy of the graph index with extra catalogue rows added as stops
+    base = get_index(db)
+    positions = [base.position_of(rowid) for rowid in rowids]
+    if any(position == None for position in positions):
+        raise ValueError("Star has no catalogue position.")
+    extra = [position for position, rowid in zip(positions, rowids) if graph.position_of(rowid) == None]
+
+    rowids = np.concatenate([graph.rowids, base.rowids[extra]])
+    points = np.concatenate([graph.points, propagate_positions(base.points[extra], base.velocities[extra], epoch)])
+    velocities = np.concatenate([graph.velocities, base.velocities[extra]])
+    order = np.argsort(rowids, kind = "stable")
+    return SpatialIndex(rowids[order], points[order], velocities[order])
+
+
+def find_path(graph, start, goal, max_jump):
+# Returns the positions in the graph index of the stops on the shortest route from start to goal, None if there
+# is no route, or a message if the route was not found within MAX_EXPANSIONS stars (there may still be one)
+    # A* search over the stars, with best known distances and previous stops held in arrays
+    target = graph.points[goal]
+    best = np.full(len(graph.points), np.inf)
+    previous = np.full(len(graph.points), -1, dtype = np.int64)
+    done = np.zeros(len(graph.points), dtype = bool)
+    best[start] = 0.0
+    queue = [(float(np.linalg.norm(graph.points[start] - target)), start)]
+    expansions = 0
+
+    while queue:
+        estimate, current = heapq.heappop(queue)
+        if done[current]:
+            continue
+        if current == goal:
+            break
+        done[current] = True
+        expansions += 1
+        if expansions > MAX_EXPANSIONS:
+            return f"search limit reached after {MAX_EXPANSIONS} stars"
+
+        # Relax every star within one jump at once
+        neighbours, jumps = graph.query_radius(graph.points[current], max_jump)
+        distances = best[current] + jumps
+        better = (distances < best[neighbours]) & ~done[neighbours]
+        neighbours = neighbours[better]
+        distances = distances[better]
+        best[neighbours] = distances
+        previous[neighbours] = current
+        estimates = distances + np.sqrt(((graph.points[neighbours] - target)**2).sum(axis = 1))
+        for item in zip(estimates.tolist(), neighbours.tolist()):
+            heapq.heappush(queue, item)
+
+    if not np.isfinite(best[goal]):
+        return None
+
+    # Walk back from the destination to get the stops in order
+    stops = [goal]
+    while stops[-1] != start:
+        stops.append(int(previous[stops[-1]]))
+    stops.reverse()
+    return stops
+
+
+def reset_graphs(db):
+# Discards the stored route graphs for the database, e.g. after the habitable table is reloaded
+    with graphs_lock:
+        for key in [key for key in graphs if key[0] == db]:
+            del graphs[key]
@@ -0,0 +1,177 @@
+import csv
+import io
+import json
+import numpy as np
+
+from database import query
+from spatial import get_index
+from starcalcs import KMS_TO_PCYR, filter_mask, lookup_refs, propagate_positions
+
+# Direction of the north galactic pole (J2000.0) as RA (hours) and Dec (degrees), used for galactic plane slabs
+GALACTIC_POLE = (192.85948 / 15, 27.12825)
+
+# Columns of each result row, and the number of rows looked up and sent at once
+REGION_COLUMNS = ["id", "star", "x", "y", "z", "distance", "mag", "absmag", "spect", "dist_src"]
+STREAM_ROWS = 2000
+
+
+def direction(ra, dec):
+# Returns the unit vector pointing towards an RA (hours) and Dec (degrees), in the catalogue x, y, z axes
+    ra = np.radians(ra * 15)
+    dec = np.radians(dec)
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)])
+
+
+def read_vector(value):
+# Returns a position from a list of three numbers or text such as "1.5,-2,0"
+    if isinstance(value, str):
+        value = value.split(",")
+    vector = np.array([float(item) for item in value], dtype = float)
+    if vector.shape != (3,):
+        raise ValueError("Positions need three coordinates (x, y, z).")
+    return vector
+
+
+def read_shape(values):
+# Returns a region shape from JSON or query values, or raises ValueError. Shapes are:
+# {"type": "sphere", "centre": [x, y, z], "radius": pc} (or "star" and "cat" instead of "centre", set by the caller),
+# {"type": "box", "min": [x, y, z], "max": [x, y, z]},
+# {"type": "cone", "ra": hours, "dec": degrees, "angle": half-angle in degrees, "max_distance": pc (optional)},
+# {"type": "slab", "min_height": pc, "max_height": pc} (height above the galactic plane through Sol)
+    kind = values.get("type", values.get("shape"))
+    if kind == "sphere":
+        shape = {"type": kind, "radius": float(values["radius"])}
+        if values.get("star"):
+            if not isinstance(values["star"], (str, int)) or not isinstance(values.get("cat", "proper"), str):
+                raise ValueError("The sphere star must be a name or number and its cat a catalogue name.")
+            shape["star"] = (str(values["star"]), values.get("cat", "proper"))
+        else:
+            shape["centre"] = read_vector(values.get("centre", [0, 0, 0]))
+        if not shape["radius"] >= 0:
+            raise ValueError("The sphere radius must be zero or more.")
+    elif kind == "box":
+        shape = {"type": kind, "min": read_vector(values["min"]), "max": read_vector(values["max"])}
+        if np.any(shape["min"] > shape["max"]):
+            raise ValueError("The box minimum must not be above its maximum.")
+    elif kind == "cone":
+        shape = {"type": kind, "axis": direction(float(values["ra"]), float(values["dec"])), "angle": float(values["angle"])}
+        if values.get("max_distance") not in [None, ""]:
+            shape["max_distance"] = float(values["max_distance"])
+        if not 0 <= shape["angle"] <= 180:
+            raise ValueError("The cone angle must be between 0 and 180 degrees.")
+    elif kind == "slab":
+        shape = {"type": kind, "min_height": float(values.get("min_height", -np.inf)), "max_height": float(values.get("max_height", np.inf))}
+        if not shape["min_height"] <= shape["max_height"]:
+            raise ValueError("The slab minimum height must not be above its maximum.")
+    else:
+        raise ValueError(f"Unknown region shape {kind}.")
+    return shape
+
+
+def shape_bounds(shape):
+# Returns the (lower, upper) corners of a box around a shape, or None if the shape is unbounded
+    if shape["type"] == "sphere":
+        return shape["centre"] - shape["radius"], shape["centre"] + shape["radius"]
+    elif shape["type"] == "box":
+        return shape["min"], shape["max"]
+    elif shape["type"] == "cone" and shape.get("max_distance") != None:
+        return np.full(3, -shape["max_distance"]), np.full(3, shape["max_distance"])
+    return None
+
+
+def shape_mask(shape, points):
+# Returns a boolean array marking the points (pc, shape (n, 3)) inside a shape
+    if shape["type"] == "sphere":
+        return ((points - shape["centre"])**2).sum(axis = 1) <= shape["radius"]**2
+    elif shape["type"] == "box":
+        return np.all((points >= shape["min"]) & (points <= shape["max"]), axis = 1)
+    elif shape["type"] == "cone":
+        # Compare the cosine of the angle from the axis, so no trigonometry is needed per star (Sol itself is included)
+        distances = np.sqrt((points**2).sum(axis = 1))
+        mask = points @ shape["axis"] >= np.cos(np.radians(shape["angle"])) * distances
+        if shape.get("max_distance") != None:
+            mask &= distances <= shape["max_distance"]
+        return mask
+    heights = points @ direction(*GALACTIC_POLE)
+    return (heights >= shape["min_height"]) & (heights <= shape["max_height"])
+
+
+def region_query(db, shapes, filters, epoch = 2000):
+# Returns the positions (into the spatial index) of the stars inside every shape and matching the filters in the
+# given year, and their positions in that year, sorted by distance from Sol. All tests are NumPy masks; bounded shapes
+# first narrow the search to the grid cells around them.
+    index = get_index(db)
+
+    # Intersect the boxes around bounded shapes, widened by the furthest any star can move by the given year
+    drift = index.max_speed * abs(epoch - 2000) * KMS_TO_PCYR
+    lower = np.full(3, -np.inf)
+    upper = np.full(3, np.inf)
+    for shape in shapes:
+        bounds = shape_bounds(shape)
+        if bounds is not None:
+            lower = np.maximum(lower, bounds[0] - drift)
+            upper = np.minimum(upper, bounds[1] + drift)
+    if np.all(np.isfinite(lower)) and np.all(np.isfinite(upper)):
+        positions = index.query_box(lower, upper) if np.all(lower <= upper) else np.empty(0, dtype = np.int64)
+    else:
+        positions = np.arange(len(index.rowids))
+
+    # Apply the attribute filters, then each shape to the positions in the given year
+    mask = filter_mask(db, index, filters)
+    if mask is not None:
+        positions = positions[mask[positions]]
+    points = propagate_positions(index.points[positions], index.velocities[positions], epoch)
+    for shape in shapes:
+        inside = shape_mask(shape, points)
+        positions = positions[inside]
+        points = points[inside]
+
+    distances = np.sqrt((points**2).sum(axis = 1))
+    order = np.lexsort((index.rowids[positions], distances))
+    return positions[order], points[order]
+
+
+def region_rows(db, positions, points):
+# Yields the result rows for stars found by region_query as lists of REGION_COLUMNS values, STREAM_ROWS at a time
+    index = get_index(db)
+    for start in range(0, len(positions), STREAM_ROWS):
+        block = positions[start:start + STREAM_ROWS]
+        block_points = points[start:start + STREAM_ROWS]
+        refs, ids = lookup_refs(db, index.rowids[block])
+
+        # Magnitudes, spectral classes and distance sources, queried in chunks to stay under the SQLite variable limit
+        rowids = index.rowids[block].tolist()
+        details = {}
+        for i in range(0, len(rowids), 900):
+            chunk = rowids[i:i + 900]
+            result = query(db, f"SELECT rowid, mag, absmag, spect, dist_src FROM catalogue WHERE rowid IN ({', '.join('?' * len(chunk))});", chunk)
+            if isinstance(result, list):
+                for row in result:
+                    details[row["rowid"]] = row
+
+        rows = []
+        for i, rowid in enumerate(rowids):
+            row = details.get(rowid)
+            x, y, z = block_points[i].tolist()
+            rows.append([ids[i], refs[i], x, y, z, (x * x + y * y + z * z) ** 0.5] +
+                        ([row["mag"], row["absmag"], row["spect"], row["dist_src"]] if row != None else [None] * 4))
+        yield rows
+
+
+def region_csv(db, positions, points):
+# Yields the region results as csv text with a header row, one block of rows at a time
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator = "\n")
+    writer.writerow(REGION_COLUMNS)
+    yield buffer.getvalue()
+    for rows in region_rows(db, positions, points):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+
+def region_ndjson(db, positions, points):
+# Yields the region results as newline-delimited JSON, one object per star, one block of rows at a time
+    for rows in region_rows(db, positions, points):
+        yield "".join(json.dumps(dict(zip(REGION_COLUMNS, row))) + "\n" for row in rows)
@@ -0,0 +1,127 @@
+import re
+import threading
+
+from bisect import bisect_left
+from collections import Counter
+from database import query
+
+# Prefix search indexes by (database location, catalogue key), built on first use
+search_indexes = {}
+search_lock = threading.Lock()
+
+
+class PrefixIndex:
+# Identifiers for one catalogue sorted case-insensitively, so all matches for a prefix are one contiguous run.
+# presorted takes (keys, values) sequences already in this order, e.g. string columns from a catalogue snapshot.
+    def __init__(self, values, presorted = None):
+        if presorted != None:
+            self.keys, self.values = presorted
+            return
+        pairs = fold_pairs(values)
+        pairs.sort()
+        self.keys = [pair[0] for pair in pairs]
+        self.values = [pair[1] for pair in pairs]
+
+
+    def search(self, prefix, limit):
+    # Returns up to limit identifiers starting with prefix
+        prefix = prefix.casefold()
+        matches = []
+        for i in range(bisect_left(self.keys, prefix), len(self.keys)):
+            if len(matches) >= limit or not self.keys[i].startswith(prefix):
+                break
+            matches.append(self.values[i])
+        return matches
+
+
+    def changed(self, removed, added):
+    # Returns a new index with the identifiers in removed taken out and those in added put in, or this index if they
+    # cancel out (e.g. rows updated without changing this identifier). The new identifiers are added to the end of
+    # the sorted pairs, so sorting again only merges them in.
+        removed = Counter(str(value) for value in removed)
+        added = Counter(str(value) for value in added)
+        removed, added = removed - added, added - removed
+        if not removed and not added:
+            return self
+        pairs = []
+        for pair in zip(whole_column(self.keys), whole_column(self.values)):
+            if removed[pair[1]] > 0:
+                removed[pair[1]] -= 1
+            else:
+                pairs.append(pair)
+        pairs.extend(fold_pairs(added.elements()))
+        pairs.sort()
+        return PrefixIndex(None, presorted = ([pair[0] for pair in pairs], [pair[1] for pair in pairs]))
+
+
+def whole_column(column):
+# Returns every value of a list or snapshot string column, reading a snapshot column in one pass instead of value by value
+    if hasattr(column, "take"):
+        return column.take(range(len(column)))
+    return column
+
+
+def fold_pairs(values):
+# Returns (case-folded key, identifier) pairs for a list of identifiers
+    pairs = []
+    for value in values:
+        value = str(value)
+        key = value.casefold()
+        # Share the string when folding does not change it (e.g. numeric IDs)
+        pairs.append((value if key == value else key, value))
+    return pairs
+
+
+def get_search_index(db, key, catalogues):
+# Returns the prefix index for a catalogue key, building it from the catalogue list_query on first use
+    with search_lock:
+        index = search_indexes.get((db, key))
+    if index != None:
+        return index
+
+    rows = query(db, catalogues[key]["list_query"], ())
+    if rows == None:
+        rows = []
+    elif not isinstance(rows, list):
+        raise rows
+    index = PrefixIndex(row[0] for row in rows)
+
+    with search_lock:
+        search_indexes[(db, key)] = index
+    return index
+
+
+def set_search_index(db, key, index):
+# Stores a prefix index built elsewhere (e.g. from a catalogue snapshot) for a catalogue key
+    with search_lock:
+        search_indexes[(db, key)] = index
+
+
+def search_prefix(db, key, prefix, limit, catalogues):
+# Returns up to limit identifiers from the catalogue key that start with prefix
+    return get_search_index(db, key, catalogues).search(prefix, limit)
+
+
+def changed_search_indexes(db, catalogues, connection, old_table, new_table):
+# Returns {key: prefix index} for the catalogue keys whose prefix index has been built, with the identifiers of the
+# rows in old_table taken out and those in new_table put in (e.g. the refresh_old and refresh_new tables of
+# refresh_table). Each list_query is run on those tables in place of the catalogue, using connection.
+    with search_lock:
+        built = {key[1]: index for key, index in search_indexes.items() if key[0] == db and index != None}
+    changed = {}
+    for key, index in built.items():
+        if key not in catalogues:
+            continue
+        identifiers = []
+        for table in [old_table, new_table]:
+            list_query = re.sub(r"\bFROM catalogue\b", f"FROM {table}", catalogues[key]["list_query"])
+            identifiers.append([row[0] for row in connection.execute(list_query)])
+        changed[key] = index.changed(*identifiers)
+    return changed
+
+
+def reset_search(db):
+# Discards the prefix indexes for the database so they are rebuilt from the new catalogue on next use
+    with search_lock:
+        for key in [key for key in search_indexes if key[0] == db]:
+            del search_indexes[key]
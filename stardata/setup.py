@@ -1,7 +1,12 @@
+import json
 import os
 
+from crossmatch import cross_match
 from database import query, upload_table
 from pathlib import Path
+from snapshot import write_snapshot
+from starcalcs import index_table
+from tiles import write_tiles
 
 # Set database location
 this_directory = os.path.dirname(os.path.abspath(__file__))
@@ -17,11 +22,29 @@ else:
         "habitable": this_directory + r"\table_data\\habitable"
         }
 
-    # Create new tables
+    # Get catalogue information
+    with open(this_directory + r"\\catalogues.json", "r", encoding = "utf-8") as file:
+        catalogues = json.load(file)
+
+    # Create new tables and their indexes
     for key, value in file_paths.items():
         result = upload_table(db, value, key)
         if result != True:
             print(f"Could not upload {key} table: {result}")
+            continue
+        result = index_table(db, key, catalogues)
+        if not isinstance(result, dict):
+            print(f"Could not create indexes for {key} table: {result}")
+            continue
+        for name, seconds in result.items():
+            print(f"Built {name} in {seconds:.3f} s.")
+
+    # Match the habitable stars to the catalogue
+    result = cross_match(db)
+    if not isinstance(result, dict):
+        print(f"Could not match habitable stars to the catalogue: {result}")
+    else:
+        print(f"Matched {result['match hip']['rows']} habitable stars by HIP and {result['match position']['rows']} by position.")
 
     # Add notebook table
     notebook_create = """
@@ -35,5 +58,23 @@ else:
     result = query(db, notebook_create, ())
     if result != True:
         print(f"Could not create notebook table: {result}")
+    else:
+        result = index_table(db, "notebook", catalogues)
+        if not isinstance(result, dict):
+            print(f"Could not create indexes for notebook table: {result}")
+
+    # Write snapshot of the catalogue for fast startup
+    result = write_snapshot(db, catalogues)
+    if not isinstance(result, float):
+        print(f"Could not write catalogue snapshot: {result}")
+    else:
+        print(f"Wrote catalogue snapshot in {result:.3f} s.")
+
+    # Write star map tiles
+    result = write_tiles(db)
+    if not isinstance(result, dict):
+        print(f"Could not write star map tiles: {result}")
+    else:
+        print(f"Wrote {result['tiles']} star map tiles in {result['seconds']:.3f} s.")
 
     print(f"SQL database {db_name} successfully created.")
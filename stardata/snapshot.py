@@ -0,0 +1,367 @@
+import json
+import numpy as np
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from database import query, query_array
+from search import PrefixIndex, reset_search, set_search_index
+from spatial import SpatialIndex, build_index, set_index
+from starcalcs import select_id
+
+# Columnar snapshot of the catalogue, written by setup.py and /load and memory-mapped by the app at startup.
+# Each snapshot is a folder named after its version stamp, next to the database. The version of the current
+# snapshot is kept in the snapshots table of the database, so a snapshot left over from an earlier catalogue
+# is never used. A running process checks the stamp every SNAPSHOT_CHECK_SECONDS (see check_snapshot), so it picks up
+# a snapshot written by another process.
+
+# Changed whenever the layout of the snapshot files changes
+SNAPSHOT_FORMAT = 1
+
+# Catalogue rows read per query when writing the identifier columns
+SNAPSHOT_ROWS = 100000
+
+# Float columns stored for every star (x0/y0/z0 and vx/vy/vz are stored together as "points" and "velocities")
+FLOAT_COLUMNS = ["x0", "y0", "z0", "vx", "vy", "vz", "mag", "absmag"]
+
+# Identifier columns stored as strings, plus the display name chosen by select_id ("ref")
+STRING_COLUMNS = ["id", "tyc", "gaia", "hyg", "hip", "hd", "hr", "gl", "bayer", "flam", "con", "proper"]
+
+# Only stars with a position are included, in rowid order (the same rows as the spatial index)
+SNAPSHOT_WHERE = "x0 IS NOT NULL AND y0 IS NOT NULL AND z0 IS NOT NULL"
+
+# Seconds between checks that the loaded snapshot is still the current one
+SNAPSHOT_CHECK_SECONDS = 5
+
+# Open snapshots and the time their version stamp was last checked, by database location
+snapshots = {}
+checked = {}
+snapshots_lock = threading.Lock()
+
+
+class StringColumn:
+# Offset-encoded UTF-8 strings: value i is data[offsets[i]:offsets[i + 1]], with empty values read as None
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+        # Slicing a memoryview is much faster than slicing a memmap
+        self.buffer = memoryview(np.asarray(data))
+
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+    def __getitem__(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        if start == end:
+            return None
+        return str(self.buffer[start:end], "utf-8")
+
+
+    def take(self, positions):
+    # Returns the values at the given positions as a list
+        starts = self.offsets[positions].tolist()
+        ends = self.offsets[np.asarray(positions) + 1].tolist()
+        buffer = self.buffer
+        return [str(buffer[start:end], "utf-8") if end > start else None for start, end in zip(starts, ends)]
+
+
+class StringWriter:
+# Writes a string column to its .offsets and .data files a block of values at a time
+    def __init__(self, folder, name):
+        self.name = name
+        self.offsets = open(os.path.join(folder, name + ".offsets"), "wb")
+        self.data = open(os.path.join(folder, name + ".data"), "wb")
+        self.offsets.write(np.zeros(1, dtype = "<i8").tobytes())
+        self.rows = 0
+        self.size = 0
+
+
+    def write(self, values):
+    # Appends values to the column (None is stored as an empty string)
+        encoded = [b"" if value == None else str(value).encode("utf-8") for value in values]
+        lengths = np.fromiter(map(len, encoded), dtype = np.int64, count = len(encoded))
+        self.offsets.write((self.size + np.cumsum(lengths)).astype("<i8").tobytes())
+        self.data.write(b"".join(encoded))
+        self.rows += len(encoded)
+        self.size += int(lengths.sum())
+
+
+    def close(self):
+    # Closes the files and returns the column description for meta.json
+        self.offsets.close()
+        self.data.close()
+        return {"rows": self.rows, "bytes": self.size}
+
+
+class Snapshot:
+# Read-only catalogue columns memory-mapped from a snapshot folder. Worker processes opening the same
+# snapshot share one copy of the files through the operating system page cache.
+    def __init__(self, folder, meta):
+        self.folder = folder
+        self.meta = meta
+        self.version = meta["version"]
+        self.arrays = {name: open_array(os.path.join(folder, name + ".bin"), value["dtype"], value["shape"]) for name, value in meta["arrays"].items()}
+        self.strings = {}
+        self.lock = threading.Lock()
+
+        self.rowids = self.arrays["rowid"]
+        self.points = self.arrays["points"]
+        self.velocities = self.arrays["velocities"]
+
+
+    def column(self, name):
+    # Returns a float column (e.g. "mag") as an array or a string column (e.g. "ref") as a StringColumn
+        if name in self.arrays:
+            return self.arrays[name]
+        axes = {"x0": ("points", 0), "y0": ("points", 1), "z0": ("points", 2), "vx": ("velocities", 0), "vy": ("velocities", 1), "vz": ("velocities", 2)}
+        if name in axes:
+            return self.arrays[axes[name][0]][:, axes[name][1]]
+        with self.lock:
+            column = self.strings.get(name)
+            if column == None:
+                value = self.meta["strings"][name]
+                offsets = open_array(os.path.join(self.folder, name + ".offsets"), "<i8", [value["rows"] + 1])
+                data = open_array(os.path.join(self.folder, name + ".data"), "u1", [value["bytes"]])
+                column = self.strings[name] = StringColumn(offsets, data)
+        return column
+
+
+    def spatial_index(self):
+    # Returns a spatial index over the snapshot positions, using the grid saved with the snapshot
+        grid = dict(self.meta["grid"], order = self.arrays["grid_order"], keys = self.arrays["grid_keys"])
+        index = SpatialIndex(self.rowids, self.points, self.velocities, grid = grid)
+        index.snapshot = self
+        return index
+
+
+    def search_index(self, key):
+    # Returns the prefix search index for a catalogue key, or None if the snapshot does not have one
+        names = self.meta["search"].get(key)
+        if names == None:
+            return None
+        return PrefixIndex(None, presorted = (self.column(names["keys"]), self.column(names["values"])))
+
+
+def open_array(path, dtype, shape):
+# Memory-maps a binary array file (empty files cannot be mapped, so empty arrays are created instead)
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype = dtype)
+    return np.memmap(path, dtype = dtype, mode = "r", shape = tuple(shape))
+
+
+def snapshot_folder(db):
+# Returns the folder holding the snapshots for a database, e.g. stars-snapshot next to stars.db
+    return os.path.splitext(db)[0] + "-snapshot"
+
+
+def current_version(db):
+# Returns the version stamp of the current snapshot from the database, or None
+    rows = query(db, "SELECT version FROM snapshots WHERE name = 'catalogue';", ())
+    if not isinstance(rows, list):
+        return None
+    return rows[0]["version"]
+
+
+def max_rowid(db):
+# Returns the largest rowid in the catalogue table (a quick check that the table has not been replaced)
+    rows = query(db, "SELECT max(rowid) FROM catalogue;", ())
+    if not isinstance(rows, list):
+        return None
+    return rows[0][0]
+
+
+def write_snapshot(db, catalogues):
+# Writes a new snapshot of the catalogue table and marks it as current in the database.
+# Returns the time taken in seconds, or the error value if the snapshot could not be written (in which case the
+# files written so far are closed and the new folder is removed).
+    start = time.perf_counter()
+    version = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    base = snapshot_folder(db)
+    folder = os.path.join(base, version)
+    os.makedirs(folder)
+    meta = {"format": SNAPSHOT_FORMAT, "version": version, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "arrays": {}, "strings": {}, "search": {}}
+    writers = []
+    written = False
+
+    try:
+        # Float columns and the spatial grid over the positions
+        data = query_array(db, f"SELECT rowid, {', '.join(FLOAT_COLUMNS)} FROM catalogue WHERE {SNAPSHOT_WHERE} ORDER BY rowid;", ())
+        if not isinstance(data, np.ndarray):
+            return data
+        index = SpatialIndex(data[:, 0].astype(np.int64), np.ascontiguousarray(data[:, 1:4]), np.nan_to_num(data[:, 4:7]))
+        arrays = {
+            "rowid": index.rowids,
+            "points": index.points,
+            "velocities": index.velocities,
+            "mag": data[:, 7],
+            "absmag": data[:, 8],
+            "grid_order": index.order,
+            "grid_keys": index.keys
+            }
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array, dtype = "<i8" if array.dtype.kind in "iu" else "<f8")
+            array.tofile(os.path.join(folder, name + ".bin"))
+            meta["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+        meta["rows"] = len(index.rowids)
+        meta["max_rowid"] = max_rowid(db)
+        meta["grid"] = {"cell_size": index.cell_size, "origin": index.origin.tolist(), "dims": index.dims.tolist(), "max_speed": index.max_speed}
+        del data, index, arrays
+
+        # Identifier columns and display names, read a block of rows at a time
+        writers.extend(StringWriter(folder, name) for name in STRING_COLUMNS + ["ref"])
+        last = -1
+        while True:
+            rows = query(db, f"SELECT rowid, {', '.join(STRING_COLUMNS)} FROM catalogue WHERE {SNAPSHOT_WHERE} AND rowid > ? ORDER BY rowid LIMIT ?;", (last, SNAPSHOT_ROWS))
+            if rows == None:
+                break
+            if not isinstance(rows, list):
+                return rows
+            for i, name in enumerate(STRING_COLUMNS):
+                writers[i].write([row[name] for row in rows])
+            writers[-1].write([select_id(row) for row in rows])
+            last = rows[-1]["rowid"]
+        for writer in writers:
+            meta["strings"][writer.name] = writer.close()
+
+        # Sorted identifiers for the prefix search of each catalogue
+        for key, value in catalogues.items():
+            rows = query(db, value["list_query"], ())
+            if rows == None:
+                rows = []
+            elif not isinstance(rows, list):
+                return rows
+            search = PrefixIndex(row[0] for row in rows)
+            names = {"keys": f"search-{key}-values", "values": f"search-{key}-values"}
+            if search.keys != search.values:
+                names["keys"] = f"search-{key}-keys"
+            for name, values in [(names["values"], search.values), (names["keys"], search.keys)]:
+                if name not in meta["strings"]:
+                    writer = StringWriter(folder, name)
+                    writers.append(writer)
+                    writer.write(values)
+                    meta["strings"][name] = writer.close()
+            meta["search"][key] = names
+
+        # meta.json is written last, so a folder without one is an incomplete snapshot
+        with open(os.path.join(folder, "meta.json"), "w", encoding = "utf-8") as file:
+            json.dump(meta, file, indent = 1)
+        result = query(db, "CREATE TABLE IF NOT EXISTS snapshots (name TEXT NOT NULL PRIMARY KEY, version TEXT NOT NULL);", ())
+        if result == True:
+            result = query(db, "INSERT OR REPLACE INTO snapshots (name, version) VALUES ('catalogue', ?);", (version,))
+        if result != True:
+            return result
+        written = True
+
+    finally:
+        # Close any files left open by an error and remove the folder of a snapshot that was not marked as current
+        for writer in writers:
+            writer.close()
+        if not written:
+            shutil.rmtree(folder, ignore_errors = True)
+
+    # Remove older snapshots (files still mapped by another process are left for the next run to remove)
+    for name in os.listdir(base):
+        if name != version:
+            shutil.rmtree(os.path.join(base, name), ignore_errors = True)
+    return time.perf_counter() - start
+
+
+def open_snapshot(db):
+# Returns the current snapshot for the database, or a message explaining why there is no usable snapshot
+    version = current_version(db)
+    if version == None:
+        return "no snapshot has been written for this catalogue."
+    path = os.path.join(snapshot_folder(db), version, "meta.json")
+    if not os.path.isfile(path):
+        return f"snapshot {version} not found."
+    with open(path, "r", encoding = "utf-8") as file:
+        meta = json.load(file)
+    if meta.get("format") != SNAPSHOT_FORMAT:
+        return f"snapshot {version} has format {meta.get('format')}, expected {SNAPSHOT_FORMAT}."
+    if meta.get("version") != version or meta.get("max_rowid") != max_rowid(db):
+        return f"snapshot {version} does not match the catalogue table."
+    return Snapshot(os.path.dirname(path), meta)
+
+
+def load_snapshot(db):
+# Opens the current snapshot and uses it for the spatial and search indexes of the database.
+# Returns True, or a message explaining why the snapshot could not be used.
+    try:
+        snapshot = open_snapshot(db)
+    except (OSError, ValueError, KeyError) as err:
+        return f"could not open snapshot: {err}"
+    if not isinstance(snapshot, Snapshot):
+        return snapshot
+
+    set_index(db, snapshot.spatial_index())
+    for key in snapshot.meta["search"]:
+        set_search_index(db, key, snapshot.search_index(key))
+    with snapshots_lock:
+        snapshots[db] = snapshot
+    return True
+
+
+def check_snapshot(db):
+# Compares the version stamp in the database with the snapshot loaded for it, at most once every
+# SNAPSHOT_CHECK_SECONDS. A newer snapshot written by another process is loaded. If the stamp has been removed
+# (another process is changing the catalogue table), the spatial index is rebuilt from the table and the search
+# indexes are rebuilt on next use. Returns True if the indexes were replaced.
+    now = time.monotonic()
+    with snapshots_lock:
+        if now - checked.get(db, -SNAPSHOT_CHECK_SECONDS) < SNAPSHOT_CHECK_SECONDS:
+            return False
+        checked[db] = now
+        loaded = snapshots.get(db)
+
+    rows = query(db, "SELECT version FROM snapshots WHERE name = 'catalogue';", ())
+    if isinstance(rows, Exception) and "no such table" not in str(rows):
+        return False
+    version = rows[0]["version"] if isinstance(rows, list) else None
+    if version == (loaded.version if loaded != None else None):
+        return False
+
+    if version != None:
+        return load_snapshot(db) == True
+    try:
+        build_index(db)
+    except sqlite3.Error:
+        return False
+    reset_search(db)
+    forget_snapshot(db)
+    return True
+
+
+def get_snapshot(db):
+# Returns the snapshot loaded for the database, or None
+    with snapshots_lock:
+        return snapshots.get(db)
+
+
+def forget_snapshot(db):
+# Stops using the snapshot loaded for the database (indexes read from it are used until they are replaced)
+    with snapshots_lock:
+        snapshots.pop(db, None)
+
+
+def reset_snapshot(db, connection = None):
+# Marks the snapshot for the database as out of date, e.g. when the catalogue table is dropped. If connection is
+# given, the version stamp is removed in its open transaction, and the caller calls forget_snapshot once that has
+# committed.
+    if connection != None:
+        try:
+            connection.execute("DELETE FROM snapshots WHERE name = 'catalogue';")
+        except sqlite3.Error as err:
+            if "no such table" not in str(err):
+                return err
+        return True
+
+    forget_snapshot(db)
+    result = query(db, "DELETE FROM snapshots WHERE name = 'catalogue';", ())
+    if isinstance(result, Exception) and "no such table" not in str(result):
+        return result
+    return True
@@ -0,0 +1,183 @@
+import numpy as np
+import threading
+
+from database import query_array
+
+# Spatial indexes by database location, built once and replaced when the catalogue is reloaded
+indexes = {}
+index_lock = threading.Lock()
+
+# Columns read for the spatial index after the rowid, and the rows it includes (stars with a position, in rowid order)
+INDEX_COLUMNS = "x0, y0, z0, vx, vy, vz"
+INDEX_WHERE = "x0 IS NOT NULL AND y0 IS NOT NULL AND z0 IS NOT NULL"
+
+
+class SpatialIndex:
+# Uniform grid over the catalogue x0/y0/z0 positions.
+# Points are sorted by cell key, so every row of cells along z is one contiguous run of the sorted arrays.
+# Velocities (km/s) are kept alongside the J2000 positions so candidates can be moved to other epochs.
+    def __init__(self, rowids, points, velocities = None, cell_size = None, grid = None):
+        self.rowids = rowids
+        self.points = points
+        if velocities is None:
+            velocities = np.zeros_like(points)
+        self.velocities = velocities
+
+        # Catalogue snapshot the arrays were read from, if any (positions in the index are rows of the snapshot)
+        self.snapshot = None
+
+        if grid != None:
+            # Reuse a grid saved with a catalogue snapshot instead of sorting the points again
+            self.max_speed = grid["max_speed"]
+            self.cell_size = grid["cell_size"]
+            self.origin = np.array(grid["origin"], dtype = float)
+            self.dims = np.array(grid["dims"], dtype = np.int64)
+            self.order = grid["order"]
+            self.keys = grid["keys"]
+            return
+
+        # Fastest star in the index, used to widen searches at epochs other than J2000
+        if len(velocities) > 0:
+            self.max_speed = float(np.sqrt((velocities**2).sum(axis = 1)).max())
+        else:
+            self.max_speed = 0.0
+
+        if cell_size == None:
+            cell_size = choose_cell_size(points)
+        self.cell_size = cell_size
+
+        # Assign each point to a cell and sort the points by cell key
+        if len(points) > 0:
+            self.origin = points.min(axis = 0)
+            cells = np.floor((points - self.origin) / cell_size).astype(np.int64)
+            self.dims = cells.max(axis = 0) + 1
+        else:
+            self.origin = np.zeros(3)
+            cells = np.zeros((0, 3), dtype = np.int64)
+            self.dims = np.ones(3, dtype = np.int64)
+        keys = self.cell_keys(cells)
+        self.order = np.argsort(keys, kind = "stable")
+        self.keys = keys[self.order]
+
+
+    def cell_keys(self, cells):
+    # Converts (ix, iy, iz) cell coordinates to a single sortable key
+        return (cells[..., 0] * self.dims[1] + cells[..., 1]) * self.dims[2] + cells[..., 2]
+
+
+    def position_of(self, rowid):
+    # Returns the position in self.points of the catalogue row with the given rowid, or None (rowids are sorted)
+        position = int(np.searchsorted(self.rowids, rowid))
+        if position < len(self.rowids) and self.rowids[position] == rowid:
+            return position
+        return None
+
+
+    def query_box(self, lower, upper):
+    # Returns positions (into self.points) of all points inside the inclusive box [lower, upper]
+        lower = np.asarray(lower, dtype = float)
+        upper = np.asarray(upper, dtype = float)
+
+        # Range of occupied cells overlapping the box
+        lo = np.floor((lower - self.origin) / self.cell_size).astype(np.int64)
+        hi = np.floor((upper - self.origin) / self.cell_size).astype(np.int64)
+        if len(self.points) == 0 or np.any(hi < 0) or np.any(lo >= self.dims):
+            return np.empty(0, dtype = np.int64)
+        lo = np.clip(lo, 0, self.dims - 1)
+        hi = np.clip(hi, 0, self.dims - 1)
+
+        # Each (ix, iy) column of cells is one run of keys; scan everything if there are too many runs
+        runs = (hi[0] - lo[0] + 1) * (hi[1] - lo[1] + 1)
+        if runs * 16 > len(self.points):
+            candidates = np.arange(len(self.points))
+        else:
+            ix, iy = np.meshgrid(np.arange(lo[0], hi[0] + 1), np.arange(lo[1], hi[1] + 1), indexing = "ij")
+            columns = np.stack([ix.ravel(), iy.ravel(), np.zeros(runs, dtype = np.int64)], axis = 1)
+            columns[:, 2] = lo[2]
+            starts = np.searchsorted(self.keys, self.cell_keys(columns), side = "left")
+            columns[:, 2] = hi[2]
+            ends = np.searchsorted(self.keys, self.cell_keys(columns), side = "right")
+            candidates = self.order[gather_runs(starts, ends)]
+
+        # Keep only points actually inside the box
+        inside = np.all((self.points[candidates] >= lower) & (self.points[candidates] <= upper), axis = 1)
+        return candidates[inside]
+
+
+    def query_radius(self, centre, radius):
+    # Returns positions of points within radius of centre and their distances, sorted by distance
+        centre = np.asarray(centre, dtype = float)
+        candidates = self.query_box(centre - radius, centre + radius)
+        distances = np.sqrt(((self.points[candidates] - centre)**2).sum(axis = 1))
+        within = distances <= radius
+        candidates = candidates[within]
+        distances = distances[within]
+        order = np.argsort(distances, kind = "stable")
+        return candidates[order], distances[order]
+
+
+def choose_cell_size(points):
+# Picks a grid cell size giving roughly 16 points per cell over the bulk of the catalogue
+    if len(points) == 0:
+        return 1.0
+    # Measure the extent of the central 90% of the data on each axis, ignoring far outliers
+    span = np.percentile(points, 95, axis = 0) - np.percentile(points, 5, axis = 0)
+    span = np.maximum(span, 1e-3)
+    cell_size = float(np.cbrt(np.prod(span) * 16 / (len(points) * 0.9**3)))
+    # Keep the number of cells per axis small enough for int64 keys
+    extent = float((points.max(axis = 0) - points.min(axis = 0)).max())
+    return max(cell_size, extent / 1e6, 1e-3)
+
+
+def gather_runs(starts, ends):
+# Concatenates the index ranges [start, end) into a single array without a Python loop
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype = np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return offsets + np.arange(total)
+
+
+def build_index(db):
+# Builds the spatial index for the catalogue table and stores it for later queries
+    data = query_array(db, f"SELECT rowid, {INDEX_COLUMNS} FROM catalogue WHERE {INDEX_WHERE} ORDER BY rowid;", ())
+    if not isinstance(data, np.ndarray):
+        raise data
+
+    index = index_rows(data)
+    with index_lock:
+        indexes[db] = index
+    return index
+
+
+def index_rows(data):
+# Returns a spatial index over an array of (rowid, x0, y0, z0, vx, vy, vz) rows in rowid order
+    # Stars without a measured velocity are treated as stationary
+    velocities = np.nan_to_num(data[:, 4:7])
+    return SpatialIndex(data[:, 0].astype(np.int64), np.ascontiguousarray(data[:, 1:4]), np.ascontiguousarray(velocities))
+
+
+def changed_index(index, removed, data):
+# Returns a new spatial index with the rows of an existing one whose rowids are in removed taken out, and the
+# (rowid, x0, y0, z0, vx, vy, vz) rows in data added, so only the changed catalogue rows need to be read.
+# The grid is sorted again in memory.
+    keep = ~np.isin(index.rowids, removed)
+    rows = np.concatenate([np.column_stack([index.rowids[keep], index.points[keep], index.velocities[keep]]), data])
+    return index_rows(rows[np.argsort(rows[:, 0], kind = "stable")])
+
+
+def set_index(db, index):
+# Stores a spatial index built elsewhere (e.g. from a catalogue snapshot) for later queries
+    with index_lock:
+        indexes[db] = index
+
+
+def get_index(db):
+# Returns the spatial index for the database, building it on first use
+    with index_lock:
+        index = indexes.get(db)
+    if index == None:
+        index = build_index(db)
+    return index
+
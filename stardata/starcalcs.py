@@ -1,15 +1,72 @@
-from database import query
+import numpy as np
+import os
+import re
+
+from cache import filter_cache, nearby_cache, star_cache
+from database import create_indexes, query, query_array
 from decimal import Decimal as d
+from metrics import span
+from spatial import get_index
+
+# Conversion from km/s to parsecs per year
+KMS_TO_PCYR = 1.02271128e-6
+
+# Distances and positions use float64 NumPy arithmetic by default. Set the environment variable
+# STARDATA_EXACT_MATH=1 (or set EXACT_MATH = True) to use the original Decimal arithmetic instead.
+# For catalogue coordinates (under 100,000 pc) and years within 1,000,000 years of J2000.0 the two
+# agree to within 1e-9 parsecs.
+EXACT_MATH = os.environ.get("STARDATA_EXACT_MATH", "0") == "1"
+
+# Catalogue columns in each section of a Star
+IDS_COLUMNS = ["id", "tyc", "gaia", "hyg", "hip", "hd", "hr", "gl", "bayer", "flam", "con", "proper"]
+POS_COLUMNS = ["ra", "dec", "pos_src", "dist", "rv", "rv_src", "pm_ra", "pm_dec", "pm_src"]
+XYZ_COLUMNS = ["x0", "y0", "z0", "dist_src", "vx", "vy", "vz"]
+MAGSPEC_COLUMNS = ["mag", "absmag", "ci", "mag_src", "spect", "spect_src"]
+STAR_COLUMNS = IDS_COLUMNS + POS_COLUMNS + XYZ_COLUMNS + MAGSPEC_COLUMNS
 
 class Star:
-    def __init__(self, ref, ids, pos, xyz, magspec, habitable, notes):
+# Compact record for one catalogue star. The catalogue values are kept in one tuple (in STAR_COLUMNS order),
+# and the ids, pos, xyz and magspec dictionaries are only built the first time they are used (e.g. by a template).
+    __slots__ = ("ref", "values", "rowid", "habitable", "notes", "_ids", "_pos", "_xyz", "_magspec")
+
+    def __init__(self, ref, values, rowid, habitable, notes):
         self.ref = ref
-        self.ids = ids
-        self.pos = pos
-        self.xyz = xyz
-        self.magspec = magspec
+        self.values = values
+        self.rowid = rowid
         self.habitable = habitable
         self.notes = notes
+        self._ids = None
+        self._pos = None
+        self._xyz = None
+        self._magspec = None
+
+
+    @property
+    def ids(self):
+        if self._ids == None:
+            self._ids = dict(zip(IDS_COLUMNS, self.values[:12]))
+        return self._ids
+
+
+    @property
+    def pos(self):
+        if self._pos == None:
+            self._pos = dict(zip(POS_COLUMNS, self.values[12:21]))
+        return self._pos
+
+
+    @property
+    def xyz(self):
+        if self._xyz == None:
+            self._xyz = dict(zip(XYZ_COLUMNS, self.values[21:28]))
+        return self._xyz
+
+
+    @property
+    def magspec(self):
+        if self._magspec == None:
+            self._magspec = dict(zip(MAGSPEC_COLUMNS, self.values[28:34]))
+        return self._magspec
 
 
 def calculate_distance(xyz):
@@ -18,7 +75,18 @@ def calculate_distance(xyz):
     if len(xyz) != 2:
         print(len(xyz))
         return None
-    
+
+    # Use the original Decimal arithmetic if exact mode is switched on
+    if EXACT_MATH:
+        return calculate_distance_exact(xyz)
+
+    # Get cartesian coordinates of the positions and calculate the distance between them
+    positions = np.array([[position["x0"], position["y0"], position["z0"]] for position in xyz], dtype = float)
+    return float(calculate_distances(positions[0], positions[1:])[0])
+
+
+def calculate_distance_exact(xyz):
+# Calculate distance between the two supplied cartesian positions using Decimal arithmetic
     # Get cartesian coordinates of the positions
     x = (xyz[0]["x0"], xyz[1]["x0"])
     y = (xyz[0]["y0"], xyz[1]["y0"])
@@ -31,99 +99,421 @@ def calculate_distance(xyz):
         (d(z[0]) - d(z[1]))**2
         ).sqrt()
     return distance
-    
 
-def create_star(request, catalogues, db):
-# Returns a Star object for the provided information
-
-    # Get correct database query for catalogue
-    data_query = ""
-    for key, value in catalogues.items():
-        if key == request[1]:
-            data_query = value["data_query"]
-            append_cat = value["append_cat"]
-            # Split columns into (flam, bayer, con) for Bayer Flamsteed Combined
-            if key == "bf":
-                args = request[0].split()
-            else:
-                args = (request[0],)
-            break
-    
-    # Set reference name
-    if append_cat == True:
-        ref = f"{request[1]}: {request[0]}"
-    else:
-        ref = request[0]
 
-    # Run database query to get star AT-HYG ID
-    if data_query == "":
-        star_rows = None
+def calculate_distances(origins, targets):
+# Calculate distances between arrays of cartesian positions (pc) using float64.
+# One origin with shape (3,) against targets with shape (n, 3) returns n distances (one-to-many).
+# Origins with shape (m, 3) against targets with shape (n, 3) returns an (m, n) matrix (many-to-many).
+    origins = np.asarray(origins, dtype = float)
+    targets = np.asarray(targets, dtype = float)
+    if origins.ndim == 1:
+        difference = targets - origins
     else:
-        star_rows = query(db, data_query, args)[0]
+        difference = origins[:, np.newaxis, :] - targets[np.newaxis, :, :]
+    return np.sqrt((difference**2).sum(axis = -1))
     
-    # Convert star_data to dictionary and split into sections
-    star_dict = dict(star_rows)
 
-    ids_list = ["id", "tyc", "gaia", "hyg", "hip", "hd", "hr", "gl", "bayer", "flam", "con", "proper"]
-    ids = {key: star_dict[key] for key in ids_list}
-    
-    pos_list = ["ra", "dec", "pos_src", "dist", "rv", "rv_src", "pm_ra", "pm_dec", "pm_src"]
-    pos = {key: star_dict[key] for key in pos_list}
+def copy_star(star):
+# Returns a copy of a Star object that can be changed without affecting the original
+    copy = Star(star.ref, star.values, star.rowid, star.habitable, star.notes)
+    # Only the dictionaries already built need copying, the values tuple cannot be changed
+    for name in ["_ids", "_pos", "_xyz", "_magspec"]:
+        section = getattr(star, name)
+        if section != None:
+            setattr(copy, name, dict(section))
+    return copy
 
-    xyz_list = ["x0", "y0", "z0", "dist_src", "vx", "vy", "vz"]
-    xyz = {key: star_dict[key] for key in xyz_list}
 
-    magspec_list = ["mag", "absmag", "ci", "mag_src", "spect", "spect_src"]
-    magspec = {key: star_dict[key] for key in magspec_list}
+def create_star(request, catalogues, db):
+# Returns a Star object for the provided information
+    star = create_stars([request], catalogues, db)[0]
+    if star == None:
+        raise ValueError(f"{request[0]} not found in {request[1]} catalogue.")
+    return star
 
-    # Get notes and habitable status
-    if star_dict["proper"] == "Sol" or query(db, "SELECT * FROM habitable WHERE HIP = ?", (star_dict["hip"],)) != None:
-        habitable = True
-    else:
-        habitable = False
 
-    try:    
-        notes = dict(query(db, "SELECT notes FROM notebook WHERE catalogue_id = ?", (star_dict["id"],))[0])["notes"]
-    except:
-        notes = None
-    
-    # Create and returns Star object
-    star = Star(ref, ids, pos, xyz, magspec, habitable, notes)
-    return star
+def create_stars(requests, catalogues, db):
+# Returns Star objects for a list of (identifier, catalogue) requests, in the same order (None for stars not found).
+# Stars from each catalogue are found with one IN (...) query (in chunks of up to 900 values), then the habitable
+# status and notes of all of them with one joined query.
+    stars = [None] * len(requests)
+
+    # Use copies of stars resolved recently and group the rest by catalogue
+    keys = {}
+    for i, request in enumerate(requests):
+        cached = star_cache.get((db, request[1], str(request[0])))
+        if cached != None:
+            stars[i] = copy_star(cached)
+        elif request[1] in catalogues:
+            identifier = str(request[0])
+            # Split into (flam, bayer, con) for Bayer Flamsteed Combined
+            value = tuple(identifier.split()) if request[1] == "bf" else (identifier,)
+            keys.setdefault(request[1], {}).setdefault(value, []).append(i)
+
+    # Look up each catalogue's identifiers
+    column_list = ", ".join(STAR_COLUMNS)
+    rows = {}
+    for cat, values in keys.items():
+        for value, row in find_rows(db, catalogues, cat, list(values), f"rowid, {column_list}").items():
+            star_values = tuple(row)[1:len(STAR_COLUMNS) + 1]
+            for i in values[value]:
+                # Set reference name
+                ref = f"{cat}: {requests[i][0]}" if catalogues[cat]["append_cat"] == True else requests[i][0]
+                stars[i] = Star(ref, star_values, row["rowid"], False, None)
+            rows[row["rowid"]] = row
+
+    # Get notes and habitable status for all new stars in one query
+    rowids = list(rows)
+    lookups = {}
+    for i in range(0, len(rowids), 900):
+        chunk = rowids[i:i + 900]
+        result = query(db, "SELECT c.rowid, c.habitable, n.notes FROM catalogue c "
+                           "LEFT JOIN notebook n ON n.catalogue_id = c.id "
+                           f"WHERE c.rowid IN ({', '.join('?' * len(chunk))});", chunk)
+        if result == None:
+            continue
+        if not isinstance(result, list):
+            raise result
+        for row in result:
+            lookups.setdefault(row["rowid"], row)
+
+    for i in [i for values in keys.values() for indices in values.values() for i in indices]:
+        star = stars[i]
+        if star == None:
+            continue
+        lookup = lookups.get(star.rowid)
+        star.habitable = lookup != None and lookup["habitable"] == 1
+        star.notes = lookup["notes"] if lookup != None else None
+        star_cache.put((db, requests[i][1], str(requests[i][0])), copy_star(star))
+    return stars
+
+
+def filter_mask(db, index, filters):
+# Returns a boolean array marking the stars in the spatial index that match the star filters, or None if there are
+# no filters. Filters can be {"habitable": True, "spect": spectral class prefix, "min_mag"/"max_mag": apparent
+# magnitude range, "min_absmag"/"max_absmag": absolute magnitude range, "dist_src": tuple of distance sources}.
+    if not filters:
+        return None
+    cache_key = (db, tuple(sorted(filters.items())))
+    cached = filter_cache.get(cache_key)
+    if cached != None and cached[0] is index:
+        return cached[1]
+
+    mask = np.ones(len(index.rowids), dtype = bool)
+    for column in ["mag", "absmag"]:
+        limits = [(">=", filters.get("min_" + column)), ("<=", filters.get("max_" + column))]
+        limits = [(operator, value) for operator, value in limits if value != None]
+        if not limits:
+            continue
+        if index.snapshot != None:
+            # Magnitudes are already in memory in the snapshot (NaN never passes a limit)
+            values = index.snapshot.column(column)
+            for operator, value in limits:
+                mask &= values >= value if operator == ">=" else values <= value
+        else:
+            conditions = " AND ".join(f"{column} {operator} ?" for operator, value in limits)
+            mask &= rowid_mask(db, index, f"SELECT rowid FROM catalogue WHERE {conditions};", tuple(value for operator, value in limits))
+    if filters.get("dist_src"):
+        placeholders = ", ".join("?" * len(filters["dist_src"]))
+        mask &= rowid_mask(db, index, f"SELECT rowid FROM catalogue WHERE dist_src IN ({placeholders});", tuple(filters["dist_src"]))
+    if filters.get("spect"):
+        mask &= rowid_mask(db, index, "SELECT rowid FROM catalogue WHERE spect LIKE ?;", (filters["spect"] + "%",))
+    if filters.get("habitable"):
+        mask &= rowid_mask(db, index, "SELECT rowid FROM catalogue WHERE habitable = 1;", ())
+
+    filter_cache.put(cache_key, (index, mask))
+    return mask
+
+
+def find_rows(db, catalogues, cat, values, columns):
+# Returns {value: row} for the catalogue rows matching a list of identifier values for one catalogue, where each
+# value is a tuple of the columns compared by its data_query (e.g. (flam, bayer, con) for "bf").
+# Values are looked up with IN (...) queries of up to 900 variables, and the first row by rowid is kept for each.
+    lookup = lookup_columns(catalogues[cat]["data_query"])
+    values = [value for value in values if len(value) == len(lookup)]
+    lookup_list = ", ".join(lookup)
+    per_value = len(lookup)
+    found = {}
+    for i in range(0, len(values), 900 // per_value):
+        chunk = values[i:i + 900 // per_value]
+        if per_value == 1:
+            condition = f"{lookup_list} IN ({', '.join('?' * len(chunk))})"
+        else:
+            row_value = "(" + ", ".join("?" * per_value) + ")"
+            condition = f"({lookup_list}) IN (VALUES {', '.join([row_value] * len(chunk))})"
+        rows = query(db, f"SELECT {columns}, {lookup_list} FROM catalogue WHERE {condition} ORDER BY rowid;",
+                     [part for value in chunk for part in value])
+        if rows == None:
+            continue
+        if not isinstance(rows, list):
+            raise rows
+        for row in rows:
+            found.setdefault(tuple(str(row[column]) for column in lookup), row)
+    return found
+
+
+def get_nearby(star, radius, db, epoch = 2000, filters = None):
+# Returns a list of stars within the given radius of the requested star in the given year, optionally only those
+# matching filters (see filter_mask)
+    # Return the cached list if this search was made recently
+    cache_key = (db, star.ids["id"], radius, epoch, EXACT_MATH, tuple(sorted((filters or {}).items())))
+    nearby_list = nearby_cache.get(cache_key)
+    if nearby_list != None:
+        return list(nearby_list)
+
+    # Position of the origin star in the requested year
+    origin = star_position(star, epoch)
+
+    with span("get_nearby.box"):
+        # Calculate a "box" around the origin star, widened by the furthest any star could have moved since J2000
+        index = get_index(db)
+        mask = filter_mask(db, index, filters)
+        reach = radius + index.max_speed * abs(epoch - 2000) * KMS_TO_PCYR
+        in_box = index.query_box(origin - reach, origin + reach)
+        if mask is not None:
+            in_box = in_box[mask[in_box]]
+
+        # Move every candidate to the requested year in one batch and keep those actually within the radius
+        positions = propagate_positions(index.points[in_box], index.velocities[in_box], epoch)
+        distances = calculate_distances(origin, positions)
+        if EXACT_MATH:
+            # Leave a margin for stars on the boundary, which are rechecked with Decimal arithmetic
+            within = distances <= radius + 1e-6
+        else:
+            within = distances <= radius
+
+    nearby_list = list_nearby(star, db, index, in_box[within], distances[within], epoch, radius)
+    nearby_cache.put(cache_key, list(nearby_list))
+    return nearby_list
+
+
+def get_nearest(star, count, db, epoch = 2000, filters = None):
+# Returns a list of the count stars closest to the requested star in the given year, optionally only those
+# matching filters (see filter_mask). Searches spheres of increasing radius until enough stars are inside.
+    cache_key = (db, star.ids["id"], "nearest", count, epoch, EXACT_MATH, tuple(sorted((filters or {}).items())))
+    nearby_list = nearby_cache.get(cache_key)
+    if nearby_list != None:
+        return list(nearby_list)
+
+    origin = star_position(star, epoch)
+    index = get_index(db)
+    mask = filter_mask(db, index, filters)
+    available = len(index.rowids) if mask is None else int(mask.sum())
+
+    # Start from the radius expected to hold count + 1 matching stars (the origin star is found as well),
+    # using the grid's density of about 16 stars per cell
+    density = 16 / index.cell_size**3 * max(available, 1) / max(len(index.rowids), 1)
+    radius = float(np.cbrt(3 * (count + 1) / (4 * np.pi * density)))
+    drift = index.max_speed * abs(epoch - 2000) * KMS_TO_PCYR
+
+    with span("get_nearest.search"):
+        while True:
+            in_box = index.query_box(origin - radius - drift, origin + radius + drift)
+            if mask is not None:
+                in_box = in_box[mask[in_box]]
+            distances = calculate_distances(origin, propagate_positions(index.points[in_box], index.velocities[in_box], epoch))
+
+            # Every matching star is in the box, so the closest of them are the answer
+            if len(in_box) >= available:
+                within = np.ones(len(in_box), dtype = bool)
+                break
+            # Only stars within the radius are certain to be closer than every star outside the box
+            within = distances <= radius
+            found = int(within.sum())
+            if found >= count + 1:
+                break
+            # Grow the sphere by the volume still needed, at least doubling the radius when few stars were found
+            radius *= max(1.25, min(2.0, float(np.cbrt((count + 1) / max(found, 1)))))
+
+        # Keep the closest count + 1, with ties kept in catalogue order
+        in_box = in_box[within]
+        distances = distances[within]
+        order = np.lexsort((index.rowids[in_box], distances))[:count + 1]
+
+    nearby_list = list_nearby(star, db, index, in_box[order], distances[order], epoch)[:count]
+    nearby_cache.put(cache_key, list(nearby_list))
+    return nearby_list
 
 
-def get_nearby(star, radius, db):
-# Returns a list of stars within the given radius of the requested star
-    # Calculate max and min coordinates for a "box" around the origin star
-    x_max = star.xyz["x0"] + radius
-    x_min = star.xyz["x0"] - radius
-    y_max = star.xyz["y0"] + radius
-    y_min = star.xyz["y0"] - radius
-    z_max = star.xyz["z0"] + radius
-    z_min = star.xyz["z0"] - radius  
-
-    # Query database for list of stars
-    nearby_box = query(db, 
-                 "SELECT * FROM catalogue WHERE (x0 BETWEEN ? AND ?) AND (y0 BETWEEN ? AND ?) AND (z0 BETWEEN ? AND ?);", 
-                 (x_min, x_max, y_min, y_max, z_min, z_max))
-
-    # Calculate actual distances and assemble list to return
-    nearby_list = []
-    for candidate in nearby_box:
-        # Eliminate the origin star itself from the results
-        if candidate["id"] != star.ids["id"]:
-            # Calculate the distance and only include stars actually within the radius
-            distance = calculate_distance([star.xyz, candidate])
-            if distance <= radius:
+def get_rows(db, rowids):
+# Returns the catalogue rows with the given rowids, queried in chunks to stay under the SQLite variable limit.
+# Raises the error value if a query fails.
+    rows = []
+    rowids = [int(x) for x in rowids]
+    for i in range(0, len(rowids), 900):
+        chunk = rowids[i:i + 900]
+        placeholders = ", ".join("?" * len(chunk))
+        result = query(db, f"SELECT rowid, * FROM catalogue WHERE rowid IN ({placeholders});", chunk)
+        if result == None:
+            continue
+        if not isinstance(result, list):
+            raise result
+        rows.extend(result)
+    return rows
+
+
+def index_table(db, table_name, catalogues):
+# Creates the indexes used by the application lookups on a table after it has been loaded.
+# Returns a dictionary of {index name: seconds taken to build} or the error value if a build failed.
+    if table_name == "catalogue":
+        # One index per identifier lookup in catalogues.json, combined for multi-column lookups such as "bf"
+        indexes = []
+        for value in catalogues.values():
+            columns = lookup_columns(value["data_query"])
+            if columns and columns not in indexes:
+                indexes.append(columns)
+    elif table_name == "habitable":
+        indexes = [("HIP",)]
+    elif table_name == "notebook":
+        indexes = [("catalogue_id",)]
+    else:
+        return f"No indexes defined for {table_name} table."
+
+    timings = create_indexes(db, table_name, indexes)
+    if not isinstance(timings, dict):
+        return timings
+
+    # Box queries use the in-memory spatial index, so drop the R*Tree that earlier versions kept over the positions
+    if table_name == "catalogue":
+        result = query(db, 'DROP TABLE IF EXISTS "catalogue_rtree";', ())
+        if result != True:
+            return result
+
+    return timings
+
+
+def list_nearby(star, db, index, positions, distances, epoch, radius = None):
+# Returns (reference, distance, AT-HYG ID) tuples for stars at the given spatial index positions, sorted by
+# distance with ties kept in catalogue order and without the origin star itself.
+# In exact mode the distances are recalculated with Decimal arithmetic (and rechecked against radius if given).
+    rowids = index.rowids[positions]
+    order = np.lexsort((rowids, distances))
+    positions = positions[order]
+    rowids = rowids[order]
+    distances = distances[order]
+
+    # Read names and IDs from the catalogue snapshot if the index was loaded from one, without querying the database
+    if index.snapshot != None and not EXACT_MATH:
+        with span("get_nearby.snapshot"):
+            refs = index.snapshot.column("ref").take(positions)
+            ids = index.snapshot.column("id").take(positions)
+            return [(ref, distance, star_id) for ref, distance, star_id in zip(refs, distances.tolist(), ids) if star_id != star.ids["id"]]
+
+    with span("get_nearby.rows"):
+        rows = {row["rowid"]: row for row in get_rows(db, rowids)}
+
+    # Assemble list to return
+    with span("get_nearby.exact" if EXACT_MATH else "get_nearby.assemble"):
+        # In exact mode, positions are only moved for other years, so J2000.0 distances use the catalogue values as they are
+        if EXACT_MATH:
+            origin_exact = dict(star.xyz) if epoch == 2000 else update_position_exact(dict(star.xyz), epoch)
+        nearby_list = []
+        for rowid, distance in zip(rowids.tolist(), distances.tolist()):
+            candidate = rows.get(rowid)
+            # Eliminate the origin star itself from the results, and any row deleted by a refresh committed after the
+            # spatial index was read
+            if candidate != None and candidate["id"] != star.ids["id"]:
+                # In exact mode, recalculate the distance with Decimal arithmetic and recheck the radius
+                if EXACT_MATH:
+                    position = candidate if epoch == 2000 else update_position_exact(dict(candidate), epoch)
+                    distance = calculate_distance_exact([origin_exact, position])
+                    if radius != None and distance > radius:
+                        continue
                 # Select user-facing ID to use for star and add tuple to list
                 cand_ref = select_id(candidate)
                 nearby_list.append((cand_ref, distance, candidate["id"]))
-    
-    # Sort list by distance from origin and return it
-    nearby_list.sort(key=lambda x: x[1])
+
+    if EXACT_MATH:
+        nearby_list.sort(key=lambda x: x[1])
     return nearby_list
 
 
+def locate_stars(requests, catalogues, db, epoch = 2000):
+# Returns references, AT-HYG IDs and positions in the provided year for a list of (identifier, catalogue) pairs.
+# All stars from the same catalogue are found with one IN (...) query (split into chunks of up to 900 values).
+# Raises ValueError naming any stars that could not be found.
+    # Group requested identifiers by catalogue
+    keys = {}
+    for identifier, cat in requests:
+        if cat not in catalogues:
+            raise ValueError(f"Unknown catalogue {cat}.")
+        identifier = str(identifier)
+        # Split into (flam, bayer, con) for Bayer Flamsteed Combined
+        value = tuple(identifier.split()) if cat == "bf" else (identifier,)
+        keys.setdefault(cat, {})[value] = None
+
+    # Look up each catalogue's identifiers, keeping the first row found for each
+    found = {}
+    for cat, values in keys.items():
+        for value, row in find_rows(db, catalogues, cat, list(values), "rowid, id, x0, y0, z0, vx, vy, vz").items():
+            found[(cat, value)] = row
+
+    # Assemble results in the requested order
+    refs = []
+    ids = []
+    positions = np.empty((len(requests), 3))
+    velocities = np.empty((len(requests), 3))
+    missing = []
+    for i, (identifier, cat) in enumerate(requests):
+        identifier = str(identifier)
+        value = tuple(identifier.split()) if cat == "bf" else (identifier,)
+        row = found.get((cat, value))
+        if row == None:
+            missing.append(f"{cat}: {identifier}")
+            continue
+        refs.append(f"{cat}: {identifier}" if catalogues[cat]["append_cat"] == True else identifier)
+        ids.append(row["id"])
+        positions[i] = [row["x0"], row["y0"], row["z0"]]
+        velocities[i] = [row["vx"], row["vy"], row["vz"]]
+    if missing:
+        raise ValueError(f"Stars not found: {', '.join(missing)}.")
+
+    positions = propagate_positions(positions, np.nan_to_num(velocities), epoch)
+    return refs, ids, positions
+
+
+def lookup_columns(data_query):
+# Returns the catalogue columns compared in a data_query from catalogues.json, e.g. ("flam", "bayer", "con")
+    return tuple(re.findall(r"(\w+) = \?", data_query))
+
+
+def lookup_refs(db, rowids):
+# Returns the display names and AT-HYG IDs of the catalogue rows with the given rowids, in the same order.
+# Names come from the catalogue snapshot (chosen by select_id for every star when it was written) if one is
+# loaded, otherwise they are chosen from the catalogue rows.
+    rowids = np.asarray(rowids, dtype = np.int64)
+    index = get_index(db)
+    if index.snapshot != None and len(index.rowids) > 0:
+        positions = np.minimum(np.searchsorted(index.rowids, rowids), len(index.rowids) - 1)
+        if np.all(index.rowids[positions] == rowids):
+            return index.snapshot.column("ref").take(positions), index.snapshot.column("id").take(positions)
+
+    rows = {row["rowid"]: row for row in get_rows(db, rowids)}
+    rowids = rowids.tolist()
+    return [select_id(rows[rowid]) for rowid in rowids], [rows[rowid]["id"] for rowid in rowids]
+
+
+def propagate_positions(positions, velocities, epoch):
+# Moves J2000.0 cartesian positions (pc) to the provided year using cartesian velocities (km/s).
+# Works on single positions or arrays of positions with shape (..., 3).
+    return positions + velocities * ((epoch - 2000) * KMS_TO_PCYR)
+
+
+def rowid_mask(db, index, query, arguments):
+# Returns a boolean array marking the stars in the spatial index whose rowids are returned by a query
+    mask = np.zeros(len(index.rowids), dtype = bool)
+    rowids = query_array(db, query, arguments)
+    if not isinstance(rowids, np.ndarray):
+        raise rowids
+    rowids = rowids[:, 0].astype(np.int64)
+    positions = np.searchsorted(index.rowids, rowids)
+    found = positions < len(index.rowids)
+    positions = positions[found]
+    mask[positions[index.rowids[positions] == rowids[found]]] = True
+    return mask
+
+
 def select_id(ids):
 # Selects an ID from a dictionary of IDs to use as a reference.
     if ids["proper"] != None:
@@ -150,8 +540,30 @@ def select_id(ids):
     return prefer_id
 
 
+def star_position(star, epoch):
+# Returns the position (pc) of a Star object in the given year as an array
+    position = np.array([star.xyz[key] for key in ["x0", "y0", "z0"]], dtype = float)
+    motion = np.nan_to_num(np.array([star.xyz[key] for key in ["vx", "vy", "vz"]], dtype = float))
+    return propagate_positions(position, motion, epoch)
+
+
 def update_position(xyz, epoch):
 # Update stellar coordinates for provided year, based on cartesian coordinates for J2000.0 epoch in parsecs
+    # Use the original Decimal arithmetic if exact mode is switched on
+    if EXACT_MATH:
+        return update_position_exact(xyz, epoch)
+
+    # Cartesian position in parsecs and motion in km/s, with missing motion treated as zero
+    position = np.array([xyz["x0"], xyz["y0"], xyz["z0"]], dtype = float)
+    motion = np.nan_to_num(np.array([xyz["vx"], xyz["vy"], xyz["vz"]], dtype = float))
+
+    # Update and return position
+    xyz["x0"], xyz["y0"], xyz["z0"] = propagate_positions(position, motion, epoch).tolist()
+    return xyz
+
+
+def update_position_exact(xyz, epoch):
+# Update stellar coordinates for provided year using Decimal arithmetic, based on cartesian coordinates for J2000.0 epoch in parsecs
     # Yearly cartesian motion in km/s
     motion = {key: xyz[key] for key in ["vx", "vy", "vz"]}
     # Difference in years between J2000.0 epoch and supplied year
@@ -164,7 +576,7 @@ def update_position(xyz, epoch):
         # Multiply by difference in epoch
         motion[key] = d(motion[key]) * years
         # Convert km/s to pc/year
-        motion[key] = motion[key] * d(1.02271128e-6)
+        motion[key] = motion[key] * d(KMS_TO_PCYR)
     
     # Update and return position
     xyz["x0"] = d(xyz["x0"]) + motion["vx"]
@@ -0,0 +1,120 @@
+import os
+import re
+import sqlite3
+import unittest
+
+from unittest import mock
+
+# The application opens stars.db next to it when imported, so these tests need the database created by setup.py
+db = os.path.dirname(os.path.abspath(__file__)) + r"\stars.db"
+if os.path.isfile(db):
+    import app
+
+
+@unittest.skipUnless(os.path.isfile(db), "stars.db has not been created (run setup.py)")
+class TestIndex(unittest.TestCase):
+# Tests for the Calculate Distance page
+    def setUp(self):
+        self.client = app.app.test_client()
+
+
+    def closest(self, year):
+    # Returns the closest approach year and distance shown on the page for Sol and Sirius in the given year
+        form = {"starA": "Sol", "catA": "proper", "starB": "Sirius", "catB": "proper", "year": str(year)}
+        page = self.client.post("/", data = form).get_data(as_text = True)
+        match = re.search(r"closest in (-?\d+) at\s*(-?[\d.]+) parsecs", page)
+        self.assertIsNotNone(match, page)
+        return match.groups()
+
+
+    def test_closest_approach_does_not_depend_on_year(self):
+        # The closest approach is calculated from the J2000.0 positions whatever year the distance is shown for
+        expected = self.closest(2000)
+        for year in [12000, -50000, 2000]:
+            self.assertEqual(self.closest(year), expected)
+
+        # and matches the /approach route
+        result = self.client.get("/approach?starA=Sol&catA=proper&starB=Sirius&catB=proper&start=2000&end=2000&step=1").get_json()
+        self.assertEqual(f"{result['results'][0]['closest']['year']:.0f}", expected[0])
+
+
+
+@unittest.skipUnless(os.path.isfile(db), "stars.db has not been created (run setup.py)")
+class TestJobs(unittest.TestCase):
+# Tests for the background job routes
+    def setUp(self):
+        self.client = app.app.test_client()
+
+
+    def test_census_workers_are_checked(self):
+        # Bad worker counts are refused before a job is queued
+        jobs = len(self.client.get("/jobs").get_json())
+        for workers in [0, -1, (os.cpu_count() or 1) + 1, "many"]:
+            with self.subTest(workers = workers):
+                response = self.client.post("/jobs", json = {"kind": "census", "radius": 5, "workers": workers})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(self.client.get("/jobs").get_json()), jobs)
+
+
+
+@unittest.skipUnless(os.path.isfile(db), "stars.db has not been created (run setup.py)")
+class TestRegion(unittest.TestCase):
+# Tests for the /region route
+    def setUp(self):
+        self.client = app.app.test_client()
+
+
+    def sphere(self, **values):
+    # Posts a region query for a 3 pc sphere around a star and returns the response
+        return self.client.post("/region", json = {"shapes": [dict({"type": "sphere", "radius": 3}, **values)]})
+
+
+    def test_sphere_around_star(self):
+        response = self.sphere(star = "Sol", cat = "proper")
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response.headers["X-Total-Count"]), 0)
+
+
+    def test_bad_stars_are_refused(self):
+        for values, status in [({"star": ["Sol"]}, 400), ({"star": {"name": "Sol"}}, 400), ({"star": "Sol", "cat": 5}, 400),
+                               ({"star": "Sol", "cat": "nonexistent"}, 400), ({"star": "No Such Star", "cat": "proper"}, 404)]:
+            with self.subTest(values = values):
+                self.assertEqual(self.sphere(**values).status_code, status)
+
+
+    def test_lookup_errors_are_not_found(self):
+        # A failed lookup is reported like a missing star rather than as a server error
+        with mock.patch.object(app, "create_star", side_effect = sqlite3.OperationalError("database is locked")):
+            response = self.sphere(star = "Sol", cat = "proper")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.get_json()["error"], "Sol not found in proper catalogue.")
+
+
+
+@unittest.skipUnless(os.path.isfile(db), "stars.db has not been created (run setup.py)")
+class TestTiles(unittest.TestCase):
+# Tests for the star map tile routes
+    def setUp(self):
+        self.client = app.app.test_client()
+
+
+    def test_encodings_have_their_own_etags(self):
+        compressed = self.client.get("/tiles/r.bin", headers = {"Accept-Encoding": "gzip"})
+        plain = self.client.get("/tiles/r.bin", headers = {"Accept-Encoding": "identity"})
+        self.assertEqual(compressed.headers.get("Content-Encoding"), "gzip")
+        self.assertIsNone(plain.headers.get("Content-Encoding"))
+        self.assertNotEqual(compressed.headers["ETag"], plain.headers["ETag"])
+        for response in [compressed, plain]:
+            self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+
+        # Each ETag only matches its own encoding
+        for encoding, etag, status in [("gzip", compressed.headers["ETag"], 304), ("identity", plain.headers["ETag"], 304),
+                                       ("gzip", plain.headers["ETag"], 200), ("identity", compressed.headers["ETag"], 200)]:
+            with self.subTest(encoding = encoding, etag = etag):
+                response = self.client.get("/tiles/r.bin", headers = {"Accept-Encoding": encoding, "If-None-Match": etag})
+                self.assertEqual(response.status_code, status)
+                self.assertEqual(response.headers["Vary"], "Accept-Encoding")
+
+
+if __name__ == "__main__":
+    unittest.main()
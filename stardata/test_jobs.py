@@ -0,0 +1,117 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from database import close_pool, query, refresh_table
+from jobs import JobQueue
+
+# Seconds to wait for a background job before failing a test
+TIMEOUT = 10
+
+
+class TestJobQueue(unittest.TestCase):
+# Tests that jobs run one at a time in order and finish in the right state
+    def setUp(self):
+        self.queue = JobQueue(keep = 3)
+
+
+    def wait(self, job):
+    # Waits for a job to stop running and returns its state
+        for _ in range(TIMEOUT * 100):
+            if job.state not in ["queued", "running"]:
+                return job.state
+            threading.Event().wait(0.01)
+        self.fail(f"job {job.id} is still {job.state}")
+
+
+    def test_jobs_run_in_order(self):
+        order = []
+        jobs = [self.queue.submit("test", str(number), lambda job, number: order.append(number) or {"number": number}, number) for number in range(3)]
+        self.assertEqual([self.wait(job) for job in jobs], ["finished"] * 3)
+        self.assertEqual(order, [0, 1, 2])
+        self.assertEqual(jobs[2].status()["result"], {"number": 2})
+        self.assertEqual([job.id for job in self.queue.list()], [job.id for job in reversed(jobs)])
+
+
+    def test_failures_are_recorded(self):
+        message = self.queue.submit("test", "message", lambda job: "Table not found.")
+        error = self.queue.submit("test", "error", lambda job: 1 / 0)
+        self.assertEqual([self.wait(message), self.wait(error)], ["failed", "failed"])
+        self.assertEqual(message.error, "Table not found.")
+        self.assertTrue(error.error.startswith("ZeroDivisionError"))
+
+
+    def test_same_key_is_not_queued_twice(self):
+        release = threading.Event()
+        first = self.queue.submit("test", "first", lambda job: release.wait(TIMEOUT) and {}, key = "table")
+        second = self.queue.submit("test", "second", lambda job: {}, key = "table")
+        self.assertIs(first, second)
+        release.set()
+        self.assertEqual(self.wait(first), "finished")
+        self.assertIsNot(self.queue.submit("test", "third", lambda job: {}, key = "table"), first)
+
+
+    def test_cancel(self):
+        started = threading.Event()
+
+        def work(job):
+            started.set()
+            while not job.cancelled():
+                threading.Event().wait(0.01)
+            return "Stopped."
+
+        running = self.queue.submit("test", "running", work)
+        queued = self.queue.submit("test", "queued", lambda job: {})
+        self.assertTrue(started.wait(TIMEOUT))
+        self.assertEqual(self.queue.cancel(queued.id).state, "cancelled")
+        self.queue.cancel(running.id)
+        self.assertEqual(self.wait(running), "cancelled")
+        self.assertEqual(running.message, "Stopped.")
+        self.assertEqual(self.queue.cancel(12345), None)
+
+
+    def test_oldest_finished_jobs_are_forgotten(self):
+        jobs = [self.queue.submit("test", str(number), lambda job: {}) for number in range(5)]
+        for job in jobs:
+            self.wait(job)
+        self.assertEqual([job.id for job in self.queue.list()], [job.id for job in reversed(jobs[2:])])
+        self.assertEqual(self.queue.get(jobs[0].id), None)
+
+
+
+class TestCancelRefresh(unittest.TestCase):
+# Tests that a cancelled table load leaves the live table as it was
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = os.path.join(self.folder, "test.db")
+        self.files = os.path.join(self.folder, "stars")
+        os.mkdir(self.files)
+        with open(os.path.join(self.files, "DTypes.json"), "w", encoding = "utf-8") as file:
+            json.dump({"id": "int", "proper": "string"}, file)
+
+
+    def tearDown(self):
+        close_pool(self.db)
+        shutil.rmtree(self.folder)
+
+
+    def write_rows(self, rows):
+    # Replaces the csv file with the given rows
+        with open(os.path.join(self.files, "stars.csv"), "w", encoding = "utf-8") as file:
+            file.write("id,proper\n" + "".join(f"{number},{name}\n" for number, name in rows))
+
+
+    def test_cancelled_refresh_changes_nothing(self):
+        self.write_rows([(0, "Sol"), (1, "Sirius")])
+        refresh_table(self.db, self.files, "stars", "id")
+        self.write_rows([(0, "Sol"), (2, "Vega")])
+        self.assertIsInstance(refresh_table(self.db, self.files, "stars", "id", cancelled = lambda: True), str)
+        self.assertEqual([tuple(row) for row in query(self.db, "SELECT id, proper FROM stars ORDER BY id;", ())], [(0, "Sol"), (1, "Sirius")])
+        self.assertEqual(query(self.db, "SELECT name FROM sqlite_master WHERE name = 'stars_staging';", ()), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import json
+import os
+import unittest
+
+import planner
+
+from planner import get_graph, plan_route
+from spatial import get_index
+from starcalcs import create_star
+
+# Database created by setup.py
+this_directory = os.path.dirname(os.path.abspath(__file__))
+db = this_directory + r"\stars.db"
+
+
+@unittest.skipUnless(os.path.isfile(db), "stars.db has not been created (run setup.py)")
+class TestPlanner(unittest.TestCase):
+# Tests for the route planner
+    def setUp(self):
+        with open(os.path.join(this_directory, "catalogues.json"), "r", encoding = "utf-8") as file:
+            catalogues = json.load(file)
+        self.stars = [create_star((name, "proper"), catalogues, db) for name in ["Sol", "Sirius"]]
+        self.max_expansions = planner.MAX_EXPANSIONS
+
+
+    def tearDown(self):
+        planner.MAX_EXPANSIONS = self.max_expansions
+
+
+    def test_j2000_graph_is_the_spatial_index(self):
+        self.assertIs(get_graph(db, 2000, False), get_index(db))
+        self.assertIsNot(get_graph(db, 3000, False), get_index(db))
+
+
+    def test_route(self):
+        # Sol to Sirius takes four jumps of up to 2.5 parsecs, and there is no route with jumps of 2 parsecs
+        route = plan_route(self.stars[0], self.stars[1], 2.5, db)
+        self.assertIsInstance(route, list)
+        self.assertEqual(route[0][3], self.stars[0].ids["id"])
+        self.assertEqual(route[-1][3], self.stars[1].ids["id"])
+        self.assertTrue(all(jump <= 2.5 for ref, jump, total, star_id in route))
+        self.assertIsNone(plan_route(self.stars[0], self.stars[1], 2, db))
+
+
+    def test_search_limit_is_not_no_route(self):
+        # A search that gives up returns a message, while an impossible route returns None
+        planner.MAX_EXPANSIONS = 1
+        self.assertIsInstance(plan_route(self.stars[0], self.stars[1], 2.5, db), str)
+        planner.MAX_EXPANSIONS = self.max_expansions
+        self.assertIsInstance(plan_route(self.stars[0], self.stars[1], 2.5, db), list)
+
+
+if __name__ == "__main__":
+    unittest.main()
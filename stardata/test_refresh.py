@@ -0,0 +1,159 @@
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+from database import close_pool, query, refresh_table
+from search import PrefixIndex
+from spatial import changed_index, index_rows
+
+# Columns and data types of the small table refreshed by the tests
+DTYPES = {"id": "int", "proper": "string", "x0": "float", "y0": "float", "z0": "float"}
+
+
+class TestRefreshTable(unittest.TestCase):
+# Tests that refresh_table applies the differences between the live table and new csv files
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = os.path.join(self.folder, "test.db")
+        self.files = os.path.join(self.folder, "stars")
+        os.mkdir(self.files)
+
+
+    def tearDown(self):
+        close_pool(self.db)
+        shutil.rmtree(self.folder)
+
+
+    def write_rows(self, rows):
+    # Replaces the csv file with the given rows, and the data types file with DTYPES
+        with open(os.path.join(self.files, "DTypes.json"), "w", encoding = "utf-8") as file:
+            json.dump(DTYPES, file)
+        with open(os.path.join(self.files, "stars.csv"), "w", encoding = "utf-8") as file:
+            file.write(",".join(DTYPES) + "\n")
+            for row in rows:
+                file.write(",".join(str(value) for value in row) + "\n")
+
+
+    def read_rows(self):
+    # Returns {id: (rowid, proper, x0)} for the rows in the live table
+        return {row[1]: (row[0], row[2], row[3]) for row in query(self.db, "SELECT rowid, id, proper, x0 FROM stars;", ())}
+
+
+    def test_new_table_is_swapped_in(self):
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (1, "Sirius", -0.494, 2.477, -0.758)])
+        report = refresh_table(self.db, self.files, "stars", "id")
+        self.assertIn("replace", report)
+        self.assertEqual(report["replace"]["rows"], 2)
+        self.assertEqual(set(self.read_rows()), {0, 1})
+
+
+    def test_changes_are_applied_in_place(self):
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (1, "Sirius", -0.494, 2.477, -0.758), (2, "Vega", 0.961, -5.908, 4.81)])
+        refresh_table(self.db, self.files, "stars", "id")
+        before = self.read_rows()
+
+        # Sirius is removed, Vega moves and Altair is added
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (2, "Vega", 1.5, -5.908, 4.81), (3, "Altair", 4.899, 1.945, 0.141)])
+        report = refresh_table(self.db, self.files, "stars", "id")
+        self.assertNotIn("replace", report)
+        self.assertEqual([report[phase]["rows"] for phase in ["delete", "update", "insert"]], [1, 1, 1])
+
+        after = self.read_rows()
+        self.assertEqual(set(after), {0, 2, 3})
+        self.assertEqual(after[0], before[0])
+        self.assertEqual(after[2], (before[2][0], "Vega", 1.5))
+        self.assertEqual(after[3][1:], ("Altair", 4.899))
+        self.assertEqual(query(self.db, "SELECT name FROM sqlite_master WHERE name = 'stars_staging';", ()), None)
+
+
+    def test_duplicate_keys_leave_the_table_unchanged(self):
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (1, "Sirius", -0.494, 2.477, -0.758)])
+        refresh_table(self.db, self.files, "stars", "id")
+        before = self.read_rows()
+
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (0, "Sirius", -0.494, 2.477, -0.758)])
+        self.assertIsInstance(refresh_table(self.db, self.files, "stars", "id"), str)
+        self.assertEqual(self.read_rows(), before)
+        self.assertEqual(query(self.db, "SELECT name FROM sqlite_master WHERE name = 'stars_staging';", ()), None)
+
+
+    def test_kept_columns_survive_a_replace(self):
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (1, "Sirius", -0.494, 2.477, -0.758)])
+        refresh_table(self.db, self.files, "stars", "id")
+        query(self.db, "ALTER TABLE stars ADD COLUMN habitable INTEGER NOT NULL DEFAULT 0;", ())
+        query(self.db, "UPDATE stars SET habitable = 1 WHERE id = 0;", ())
+
+        # A new column in the files replaces the table, and the kept column comes with it
+        DTYPES["mag"] = "float"
+        try:
+            self.write_rows([(0, "Sol", 0.0, 0.0, 0.0, -26.7), (2, "Vega", 0.961, -5.908, 4.81, 0.03)])
+            report = refresh_table(self.db, self.files, "stars", "id", {"habitable": "INTEGER NOT NULL DEFAULT 0"})
+        finally:
+            del DTYPES["mag"]
+        self.assertIn("replace", report)
+        rows = query(self.db, "SELECT id, habitable FROM stars ORDER BY id;", ())
+        self.assertEqual([tuple(row) for row in rows], [(0, 1), (2, 0)])
+
+
+    def test_prepare_runs_before_the_commit(self):
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (1, "Sirius", -0.494, 2.477, -0.758), (2, "Vega", 0.961, -5.908, 4.81)])
+        refresh_table(self.db, self.files, "stars", "id")
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (2, "Vega", 1.5, -5.908, 4.81), (3, "Altair", 4.899, 1.945, 0.141)])
+        seen = {}
+
+        def prepare(connection, replaced):
+            seen["replaced"] = replaced
+            seen["old"] = sorted(tuple(row) for row in connection.execute("SELECT id, x0 FROM temp.refresh_old;"))
+            seen["new"] = sorted(tuple(row) for row in connection.execute("SELECT id, x0 FROM temp.refresh_new;"))
+            # Other connections still see the old rows
+            seen["before"] = len(query(self.db, "SELECT id FROM stars;", ()))
+            return lambda: seen.setdefault("after", len(query(self.db, "SELECT id FROM stars;", ())))
+
+        report = refresh_table(self.db, self.files, "stars", "id", prepare = prepare)
+        self.assertIn("prepare", report)
+        self.assertEqual(seen, {"replaced": False, "old": [(1, -0.494), (2, 0.961)], "new": [(2, 1.5), (3, 4.899)], "before": 3, "after": 3})
+
+
+    def test_prepare_error_rolls_back(self):
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (1, "Sirius", -0.494, 2.477, -0.758)])
+        refresh_table(self.db, self.files, "stars", "id")
+        before = self.read_rows()
+
+        self.write_rows([(0, "Sol", 0.0, 0.0, 0.0), (2, "Vega", 0.961, -5.908, 4.81)])
+        self.assertEqual(refresh_table(self.db, self.files, "stars", "id", prepare = lambda connection, replaced: "Could not build the index."), "Could not build the index.")
+        self.assertEqual(self.read_rows(), before)
+        self.assertEqual(query(self.db, "SELECT name FROM sqlite_master WHERE name = 'stars_staging';", ()), None)
+
+
+
+class TestChangedIndexes(unittest.TestCase):
+# Tests that indexes updated with the changed rows match indexes built from all of the new rows
+    def test_changed_spatial_index(self):
+        rng = np.random.default_rng(1)
+        rows = np.column_stack([np.arange(1, 1001), rng.normal(0, 20, (1000, 3)), rng.normal(0, 30, (1000, 3))])
+        new_rows = np.column_stack([np.arange(1001, 1011), rng.normal(0, 20, (10, 3)), rng.normal(0, 30, (10, 3))])
+        updated = rows[[4, 500]].copy()
+        updated[:, 1:4] += 1.0
+
+        # Rows 10 and 20 are deleted, 5 and 501 move and 1001 to 1010 are added
+        expected = np.concatenate([np.delete(rows, [4, 9, 19, 500], axis = 0), updated, new_rows])
+        expected = index_rows(expected[np.argsort(expected[:, 0])])
+        index = changed_index(index_rows(rows), [5, 10, 20, 501], np.concatenate([updated, new_rows]))
+        for name in ["rowids", "points", "velocities", "order", "keys"]:
+            np.testing.assert_array_equal(getattr(index, name), getattr(expected, name))
+        np.testing.assert_array_equal(index.query_box(np.full(3, -5.0), np.full(3, 5.0)), expected.query_box(np.full(3, -5.0), np.full(3, 5.0)))
+
+
+    def test_changed_search_index(self):
+        index = PrefixIndex(["Sirius", "Sol", "Vega", "vega", "Altair"])
+        changed = index.changed(["Sirius", "Vega", "Sol"], ["Sol", "Deneb", "Vega"])
+        expected = PrefixIndex(["Sol", "Vega", "vega", "Altair", "Deneb"])
+        self.assertEqual((changed.keys, changed.values), (expected.keys, expected.values))
+        self.assertIs(index.changed(["Sol"], ["Sol"]), index)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import snapshot
+
+from database import close_pool, query
+from snapshot import FLOAT_COLUMNS, STRING_COLUMNS, check_snapshot, get_snapshot, load_snapshot, snapshot_folder, write_snapshot
+from spatial import get_index
+from unittest import mock
+
+# Stars in the small catalogue used by the tests: (id, proper name, x0, y0, z0)
+STARS = [(1, "Sol", 0.000005, 0.0, 0.0), (2, "Proxima Centauri", -0.474, -0.363, -1.157), (3, "Sirius", -0.494, 2.477, -0.758)]
+
+
+class TestSnapshot(unittest.TestCase):
+# Tests that failed snapshots are cleaned up and that a process notices a snapshot written by another one
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db = os.path.join(self.folder, "test.db")
+        connection = sqlite3.connect(self.db)
+        columns = ", ".join(f'"{column}" REAL' for column in FLOAT_COLUMNS) + ", " + ", ".join(f'"{column}" TEXT' for column in STRING_COLUMNS)
+        connection.execute(f"CREATE TABLE catalogue ({columns});")
+        connection.executemany("INSERT INTO catalogue (id, proper, x0, y0, z0) VALUES (?, ?, ?, ?, ?);", STARS)
+        connection.commit()
+        connection.close()
+
+        # Check the version stamp on every call
+        self.check_seconds = snapshot.SNAPSHOT_CHECK_SECONDS
+        snapshot.SNAPSHOT_CHECK_SECONDS = 0
+
+
+    def tearDown(self):
+        snapshot.SNAPSHOT_CHECK_SECONDS = self.check_seconds
+        snapshot.snapshots.pop(self.db, None)
+        close_pool(self.db)
+        shutil.rmtree(self.folder)
+
+
+    def versions(self):
+    # Returns the snapshot folders on disk
+        base = snapshot_folder(self.db)
+        return sorted(os.listdir(base)) if os.path.isdir(base) else []
+
+
+    def test_failed_snapshot_is_removed(self):
+        opened = []
+        string_writer = snapshot.StringWriter
+
+        def record(*args):
+            writer = string_writer(*args)
+            opened.append(writer)
+            return writer
+
+        # Fail while the identifier columns are being written
+        with mock.patch.object(snapshot, "StringWriter", side_effect = record), mock.patch.object(snapshot, "select_id", side_effect = KeyError("proper")):
+            with self.assertRaises(KeyError):
+                write_snapshot(self.db, {})
+        self.assertTrue(opened)
+        self.assertTrue(all(writer.offsets.closed and writer.data.closed for writer in opened))
+        self.assertEqual(self.versions(), [])
+
+        # and when the query fails
+        query(self.db, "ALTER TABLE catalogue RENAME TO stars;", ())
+        self.assertIsInstance(write_snapshot(self.db, {}), sqlite3.Error)
+        self.assertEqual(self.versions(), [])
+
+
+    def test_newer_snapshot_is_loaded(self):
+        self.assertIsInstance(write_snapshot(self.db, {}), float)
+        self.assertEqual(load_snapshot(self.db), True)
+        first = get_snapshot(self.db)
+        self.assertFalse(check_snapshot(self.db))
+
+        # Another process writes a new snapshot
+        self.assertIsInstance(write_snapshot(self.db, {}), float)
+        self.assertTrue(check_snapshot(self.db))
+        self.assertNotEqual(get_snapshot(self.db).version, first.version)
+        self.assertIs(get_index(self.db).snapshot, get_snapshot(self.db))
+
+        # Another process starts changing the catalogue, so the table is read instead
+        query(self.db, "DELETE FROM snapshots;", ())
+        query(self.db, "DELETE FROM catalogue WHERE id = '3';", ())
+        self.assertTrue(check_snapshot(self.db))
+        self.assertEqual(get_snapshot(self.db), None)
+        self.assertEqual(get_index(self.db).snapshot, None)
+        self.assertEqual(len(get_index(self.db).rowids), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import itertools
+import json
+import os
+import unittest
+
+import starcalcs
+
+from database import query
+from starcalcs import calculate_distance, calculate_distance_exact, create_star, get_nearby, update_position, update_position_exact
+
+# Database created by setup.py, used by the tests that need catalogue rows
+this_directory = os.path.dirname(os.path.abspath(__file__))
+db = this_directory + r"\stars.db"
+
+# Catalogue positions (pc) and velocities (km/s) from AT-HYG, including Sol (no velocity), the fastest star in the
+# sample catalogue and one at the documented 100,000 pc limit (made up, as the sample catalogue reaches only 50 pc)
+STARS = {
+    "Sol": {"x0": 5e-06, "y0": 0.0, "z0": 0.0, "vx": None, "vy": None, "vz": None},
+    "Proxima Centauri": {"x0": -0.474, "y0": -0.363, "z0": -1.157, "vx": -9.547, "vy": 22.088, "vz": 21.675},
+    "Rigil Kentaurus": {"x0": -0.495, "y0": -0.414, "z0": -1.157, "vx": -7.058, "vy": 24.214, "vz": 24.353},
+    "Sirius": {"x0": -0.494, "y0": 2.477, "z0": -0.758, "vx": 9.317, "vy": -11.805, "vz": -11.941},
+    "Barnard's Star": {"x0": -0.017, "y0": -1.822, "z0": 0.15, "vx": -5.823, "vy": 117.507, "vz": 80.468},
+    "Vega": {"x0": 0.961, "y0": -5.908, "z0": 4.81, "vx": 4.657, "vy": 16.953, "vz": 0.578},
+    "1494280": {"x0": -19.021, "y0": -20.797, "z0": -8.329, "vx": -209.903, "vy": -22.902, "vz": -561.132},
+    "far": {"x0": 61234.567, "y0": -70321.125, "z0": 36210.875, "vx": 412.5, "vy": -380.25, "vz": 95.125}
+    }
+
+# Years compared, up to the documented 1,000,000 years either side of J2000.0
+EPOCHS = [-1000000, -50000, 0, 2000, 2024, 12000, 1000000]
+
+# Largest difference allowed between float64 and Decimal results (pc), as documented in starcalcs.py and the README
+TOLERANCE = 1e-9
+
+
+class TestFloatMatchesDecimal(unittest.TestCase):
+# Tests that the float64 positions and distances agree with the original Decimal arithmetic
+    def setUp(self):
+        # Compare the float64 functions whatever STARDATA_EXACT_MATH is set to
+        self.exact_math = starcalcs.EXACT_MATH
+        starcalcs.EXACT_MATH = False
+
+
+    def tearDown(self):
+        starcalcs.EXACT_MATH = self.exact_math
+
+
+    def test_update_position(self):
+        for (name, star), epoch in itertools.product(STARS.items(), EPOCHS):
+            position = update_position(dict(star), epoch)
+            exact = update_position_exact(dict(star), epoch)
+            for key in ["x0", "y0", "z0"]:
+                with self.subTest(star = name, year = epoch, axis = key):
+                    self.assertLessEqual(abs(position[key] - float(exact[key])), TOLERANCE)
+
+
+    def test_calculate_distance(self):
+        for (first, second), epoch in itertools.product(itertools.combinations(STARS, 2), EPOCHS):
+            distance = calculate_distance([update_position(dict(STARS[first]), epoch), update_position(dict(STARS[second]), epoch)])
+            exact = calculate_distance_exact([update_position_exact(dict(STARS[first]), epoch), update_position_exact(dict(STARS[second]), epoch)])
+            with self.subTest(stars = (first, second), year = epoch):
+                self.assertLessEqual(abs(distance - float(exact)), TOLERANCE)
+
+
+    def test_calculate_distance_j2000(self):
+        # At J2000.0 the catalogue values are used as they are
+        for first, second in itertools.combinations(STARS, 2):
+            with self.subTest(stars = (first, second)):
+                distance = calculate_distance([STARS[first], STARS[second]])
+                self.assertLessEqual(abs(distance - float(calculate_distance_exact([STARS[first], STARS[second]]))), TOLERANCE)
+
+
+@unittest.skipUnless(os.path.isfile(db), "stars.db has not been created (run setup.py)")
+class TestExactNearby(unittest.TestCase):
+# Tests that exact mode nearby star distances match the original Decimal calculation on the catalogue values
+    def setUp(self):
+        self.exact_math = starcalcs.EXACT_MATH
+        starcalcs.EXACT_MATH = True
+        with open(os.path.join(this_directory, "catalogues.json"), "r", encoding = "utf-8") as file:
+            self.catalogues = json.load(file)
+
+
+    def tearDown(self):
+        starcalcs.EXACT_MATH = self.exact_math
+
+
+    def test_j2000_distances_use_catalogue_values(self):
+        star = create_star(("Proxima Centauri", "proper"), self.catalogues, db)
+        nearby = get_nearby(star, 5, db)
+        self.assertTrue(nearby)
+        for ref, distance, star_id in nearby:
+            row = query(db, "SELECT x0, y0, z0 FROM catalogue WHERE id = ?;", (star_id,))[0]
+            with self.subTest(star = ref):
+                self.assertEqual(distance, calculate_distance_exact([star.xyz, row]))
+
+
+if __name__ == "__main__":
+    unittest.main()
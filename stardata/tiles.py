@@ -0,0 +1,236 @@
+import gzip
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from database import query_array
+from snapshot import get_snapshot
+from spatial import get_index
+
+# Star map tiles: an octree over the catalogue positions (J2000.0), where each node keeps the NODE_STARS most luminous
+# stars (lowest absolute magnitude) not kept by a node above it, so a client can draw the brightest stars first and
+# load more detail only for the nodes in view. Each node is written as one gzip-compressed binary tile:
+#   header: b"STAR", format (uint16), depth (uint16), star count (uint32), node corner x, y, z and edge (float64)
+#   then one array after another: x, y, z (uint16, position within the node quantized to 1/65535 of its edge),
+#   absolute magnitude (int16, hundredths), colour index ci (int16, thousandths; missing values are -32768)
+#   and catalogue rowid (uint32), all little-endian.
+# tiles.json lists every node with its star count, child octants and ETag. Node keys are "r" for the root followed by
+# one octant digit (0-7, x * 4 + y * 2 + z, 1 for the upper half) per level.
+TILE_FORMAT = 1
+TILE_HEADER = struct.Struct("<4sHHI4d")
+
+# Stars kept by each node, and the deepest level (nodes there keep all their stars)
+NODE_STARS = 4096
+MAX_DEPTH = 16
+
+# Value stored for a missing magnitude or colour index
+MISSING = -32768
+
+# Tile index for each database, read from tiles.json and replaced when the tiles are rebuilt
+tile_indexes = {}
+tiles_lock = threading.Lock()
+
+
+def build_octree(points, ranks, corner, edge):
+# Returns {node code: star positions} for the octree, with each node's stars in rank order. Node codes are
+# 1 for the root and code * 8 + octant for children. Each level is handled for all nodes at once.
+    nodes = {}
+    order = np.argsort(ranks, kind = "stable")
+    codes = np.ones(len(order), dtype = np.int64)
+    scaled = np.clip((points - corner) / edge, 0, np.nextafter(1, 0))
+    for depth in range(MAX_DEPTH + 1):
+        if len(order) == 0:
+            break
+
+        # Group the stars by node, keeping rank order within each node
+        grouping = np.argsort(codes, kind = "stable")
+        order = order[grouping]
+        codes = codes[grouping]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        sizes = np.diff(np.r_[starts, len(codes)])
+        places = np.arange(len(codes)) - np.repeat(starts, sizes)
+        keep = places < NODE_STARS if depth < MAX_DEPTH else np.ones(len(codes), dtype = bool)
+        for start, size in zip(starts.tolist(), sizes.tolist()):
+            nodes[int(codes[start])] = order[start:start + min(size, NODE_STARS if depth < MAX_DEPTH else size)]
+
+        # Pass the other stars down to the child octant containing them
+        order = order[~keep]
+        codes = codes[~keep]
+        bits = (np.floor(scaled[order] * 2**(depth + 1)).astype(np.int64) & 1)
+        codes = codes * 8 + bits[:, 0] * 4 + bits[:, 1] * 2 + bits[:, 2]
+    return nodes
+
+
+def encode_tile(code, positions, points, absmag, ci, rowids, corner, edge):
+# Returns the uncompressed binary tile for a node
+    depth = node_depth(code)
+    node_corner, node_edge = node_bounds(code, corner, edge)
+    quantized = np.clip(np.rint((points[positions] - node_corner) / node_edge * 65535), 0, 65535).astype("<u2")
+    header = TILE_HEADER.pack(b"STAR", TILE_FORMAT, depth, len(positions), *node_corner.tolist(), node_edge)
+    parts = [header] + [np.ascontiguousarray(quantized[:, axis]).tobytes() for axis in range(3)]
+    parts.append(quantize(absmag[positions], 100).tobytes())
+    parts.append(quantize(ci[positions], 1000).tobytes())
+    parts.append(rowids[positions].astype("<u4").tobytes())
+    return b"".join(parts)
+
+
+def get_tile(db, key):
+# Returns (gzip-compressed tile, ETag) for a node key, or None if there is no such tile
+    index = get_tile_index(db)
+    if index == None or key not in index["nodes"]:
+        return None
+    etag = index["nodes"][key]["etag"]
+    try:
+        with open(os.path.join(tiles_folder(db), tile_name(key, etag)), "rb") as file:
+            return file.read(), etag
+    except OSError:
+        return None
+
+
+def get_tile_index(db):
+# Returns the tile index (the contents of tiles.json) for the database, or None if no tiles have been written
+    with tiles_lock:
+        index = tile_indexes.get(db)
+    if index != None:
+        return index
+    try:
+        with open(os.path.join(tiles_folder(db), "tiles.json"), "r", encoding = "utf-8") as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if index.get("format") != TILE_FORMAT:
+        return None
+    with tiles_lock:
+        tile_indexes[db] = index
+    return index
+
+
+def node_bounds(code, corner, edge):
+# Returns the corner (pc) and edge length of a node from its code
+    depth = node_depth(code)
+    cell = np.zeros(3, dtype = np.int64)
+    for level in range(depth):
+        octant = (code >> (3 * (depth - 1 - level))) & 7
+        cell = cell * 2 + np.array([octant >> 2, (octant >> 1) & 1, octant & 1])
+    node_edge = edge / 2**depth
+    return np.asarray(corner, dtype = float) + cell * node_edge, node_edge
+
+
+def node_depth(code):
+# Returns the level of a node from its code (the root is level 0)
+    return (code.bit_length() - 1) // 3
+
+
+def node_key(code):
+# Returns the key of a node, e.g. "r" for the root and "r37" for its child 3's child 7
+    return "r" + format(code, "o")[1:]
+
+
+def quantize(values, scale):
+# Returns values as int16 in units of 1 / scale, with MISSING for NaN
+    values = np.asarray(values, dtype = float)
+    result = np.full(len(values), MISSING, dtype = "<i2")
+    present = np.isfinite(values)
+    result[present] = np.clip(np.rint(values[present] * scale), MISSING + 1, 32767)
+    return result
+
+
+def tile_name(key, etag):
+# Returns the file name of a tile. Each version of a tile has its own file, so its contents always match its ETag.
+    return f"{key}.{etag}.bin.gz"
+
+
+def tiles_folder(db):
+# Returns the folder holding the tiles for a database, e.g. stars-tiles next to stars.db
+    return os.path.splitext(db)[0] + "-tiles"
+
+
+def write_tiles(db):
+# Builds the octree from the spatial index and writes its tiles. Only tiles whose contents have changed since the
+# last build are written (unchanged tiles keep their files and ETags), tiles.json is replaced once they are all
+# written, and old tiles are removed after that.
+# Returns {"tiles": tile count, "written": tiles written, "seconds": seconds taken} or a message.
+    start = time.perf_counter()
+    index = get_index(db)
+    if len(index.rowids) == 0:
+        return "the catalogue has no stars with positions."
+
+    # Absolute magnitudes from the snapshot if loaded, and colour indexes from the catalogue
+    snapshot = get_snapshot(db)
+    if snapshot != None and index.snapshot is snapshot:
+        absmag = np.asarray(snapshot.column("absmag"))
+        columns = "ci"
+    else:
+        absmag = None
+        columns = "absmag, ci"
+    data = query_array(db, f"SELECT rowid, {columns} FROM catalogue WHERE x0 IS NOT NULL AND y0 IS NOT NULL AND z0 IS NOT NULL ORDER BY rowid;", ())
+    if not isinstance(data, np.ndarray):
+        return f"could not read the catalogue: {data}"
+    if len(data) != len(index.rowids) or not np.array_equal(data[:, 0].astype(np.int64), index.rowids):
+        return "the spatial index does not match the catalogue table."
+    if absmag is None:
+        absmag = data[:, 1]
+    ci = data[:, -1]
+
+    # Keep the previous bounds while every star is inside them, so unchanged parts of the tree keep their tiles
+    folder = tiles_folder(db)
+    previous = get_tile_index(db)
+    points = index.points
+    low = points.min(axis = 0)
+    high = points.max(axis = 0)
+    if previous != None and np.all(low >= previous["corner"]) and np.all(high < np.add(previous["corner"], previous["edge"])):
+        corner = np.array(previous["corner"], dtype = float)
+        edge = float(previous["edge"])
+    else:
+        corner = low
+        edge = float((high - low).max()) * (1 + 1e-9) or 1.0
+
+    # Most luminous first; stars without an absolute magnitude last
+    ranks = np.where(np.isfinite(absmag), absmag, np.inf)
+    nodes = build_octree(points, ranks, corner, edge)
+
+    os.makedirs(folder, exist_ok = True)
+    entries = {}
+    written = 0
+    for code in sorted(nodes):
+        key = node_key(code)
+        tile = encode_tile(code, nodes[code], points, absmag, ci, index.rowids, corner, edge)
+        etag = hashlib.sha1(tile).hexdigest()[:16]
+        entries[key] = {"count": len(nodes[code]), "children": 0, "etag": etag}
+        path = os.path.join(folder, tile_name(key, etag))
+        if os.path.isfile(path):
+            continue
+
+        # Write to a temporary file first so a tile is never read half-written
+        with open(path + ".tmp", "wb") as file:
+            file.write(gzip.compress(tile, mtime = 0))
+        os.replace(path + ".tmp", path)
+        written += 1
+
+    # Record which children each node has, so clients know where to stop
+    for code in nodes:
+        if code > 1:
+            entries[node_key(code >> 3)]["children"] |= 1 << (code & 7)
+
+    meta = {"format": TILE_FORMAT, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "stars": len(index.rowids),
+            "corner": corner.tolist(), "edge": edge, "node_stars": NODE_STARS, "nodes": entries}
+    with open(os.path.join(folder, "tiles.json.tmp"), "w", encoding = "utf-8") as file:
+        json.dump(meta, file)
+    os.replace(os.path.join(folder, "tiles.json.tmp"), os.path.join(folder, "tiles.json"))
+    with tiles_lock:
+        tile_indexes[db] = meta
+
+    # Remove tiles that have been replaced or whose nodes no longer exist
+    current = set(tile_name(key, entry["etag"]) for key, entry in entries.items())
+    for name in os.listdir(folder):
+        if name.endswith(".bin.gz") and name not in current:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+    return {"tiles": len(entries), "written": written, "seconds": time.perf_counter() - start}